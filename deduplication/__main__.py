@@ -1,25 +1,227 @@
 from deduplication.workflows import *
-from deduplication.args import parse_args
+from deduplication.args import COMMANDS, parse_args, parse_minhash_args, parse_evaluate_args
+from deduplication.planner import PLAN_NAME, calibrate, plan_index, format_plan, load_plan, save_plan
+from deduplication.output import write_deduplicated
+from deduplication.metrics import Metrics, NullMetrics, set_metrics
+from deduplication.memory import MemoryBudget, fit_bloom_fp, set_budget
+from deduplication.readahead import set_read_ahead
+from deduplication.inputs import set_block_reads, set_text_column
+import logging
+import json
+import sys
+
+# the index backends, and datasketch with them, are only imported by the workflows that use them
+command = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] in COMMANDS else None
+if command == "bench":
+	from deduplication.bench.__main__ import main
+	sys.argv = [f"{sys.argv[0]} bench"] + sys.argv[2:]
+	main()
+	sys.exit()
+
+def setup(args):
+	logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(message)s")
+	assert not args.trace_file or args.metrics_file, "--trace-file needs --metrics-file"
+	metrics = NullMetrics()
+	if args.metrics_file:
+		metrics = Metrics(args.metrics_file, args.metrics_interval, args.trace_file, args.trace_sample, labels={"worker": args.worker_id} if args.worker_id else None)
+	# every index, hasher and writer of the run records into these
+	set_metrics(metrics.start())
+	set_block_reads(args.read_block_size, args.open_files)
+	set_text_column(args.text_column)
+	budget = None
+	if args.memory_budget:
+		# worker pools and the documents in flight to them are sized from the budget as they are created
+		budget = MemoryBudget(args.memory_budget)
+		set_budget(budget)
+	return metrics, budget
+
+def finish(metrics, budget):
+	if budget is not None:
+		logging.info(f"Peak resident size {budget.peak / (1 << 30):.2f}G of the {budget.limit / (1 << 30):.2f}G memory budget")
+	metrics.close()
+
+if command == "minhash":
+	args = parse_minhash_args(sys.argv[2:])
+	metrics, budget = setup(args)
+	try:
+		if args.work_dir:
+			distributed_minhash(args.input, args.minhash_dir, args.work_dir, args.num_perm, args.worker_id, args.lease_ttl)
+		else:
+			from deduplication.minhash import MinHasher
+			for input_path, minhash_dir in zip(args.input, args.minhash_dir):
+				if os.path.isfile(input_path):
+					MinHasher(None, minhash_dir, args.num_perm).compute_minhash_for_file(input_path)
+				else:
+					MinHasher(input_path, minhash_dir, args.num_perm).process()
+	finally:
+		finish(metrics, budget)
+	sys.exit()
+
+if command == "evaluate":
+	args = parse_evaluate_args(sys.argv[2:])
+	metrics, budget = setup(args)
+	try:
+		from deduplication.evaluate import evaluate, format_report
+		plan = load_plan(args.plan_file or os.path.join(args.save_dir, PLAN_NAME)) if args.plan_file or args.save_dir else None
+		report = evaluate(args.name, args.input, args.minhash_dir, args.output_file, args.sim_threshold, args.num_perm, plan, args.layouts,
+			args.samples, args.top, args.confidence, args.num_workers, args.seed)
+		logging.info("\n" + format_report(report))
+		if args.report:
+			with open(args.report, "w") as fout:
+				json.dump(report, fout, indent=2)
+	finally:
+		finish(metrics, budget)
+	sys.exit()
 
 args = parse_args()
+metrics, budget = setup(args)
+set_read_ahead(args.read_ahead)
+local_dedup_workers = args.num_workers if args.local_dedup else 0
+assert not (args.verify and args.mode == "bloom"), "Bloom filters do not keep candidate keys, --verify is only supported in LSH and Sort mode"
+# one threshold keeps the plain output layout, several are deduplicated together and tagged
+sim_threshold = args.sim_threshold[0] if len(args.sim_threshold) == 1 else args.sim_threshold
+assert isinstance(sim_threshold, float) or (args.mode in ("lsh", "bloom") and not args.query_only and not args.cluster_dir), "Multiple thresholds are only supported in LSH and Bloom mode, without --query-only or --cluster-dir"
+assert not args.write_deduplicated or isinstance(sim_threshold, float), "--write-deduplicated needs a single threshold"
+assert not (args.write_deduplicated and args.work_dir and args.query_only), "--write-deduplicated is not supported for distributed --query-only runs"
+if budget is not None:
+	if args.prefetch_max_size is None:
+		args.prefetch_max_size = budget.prefetch_bytes()
+	if args.index_memory is None:
+		args.index_memory = budget.index_bytes()
+	if args.mode == "bloom" and not args.query_only and not args.auto_tune and args.num:
+		from datasketch.lsh import _optimal_param
+		thresholds = [sim_threshold] if isinstance(sim_threshold, float) else sim_threshold
+		bands = [_optimal_param(t, args.num_perm, 0.5, 0.5)[0] for t in thresholds]
+		fp = fit_bloom_fp(args.num, args.fp, bands, budget.index_bytes())
+		# beyond this nearly every document would collide in some band
+		assert fp <= 0.05, f"Bloom filters for {args.num:,} documents do not fit in half of the {args.memory_budget / (1 << 30):.2f}G memory budget even at --fp 0.05, raise --memory-budget or lower -n"
+		if fp > args.fp:
+			logging.warning(f"Bloom filters for {args.num:,} documents at --fp {args.fp} do not fit in half the memory budget, using --fp {fp:.2e}")
+			args.fp = fp
+if args.sort_memory is None:
+	args.sort_memory = budget.sort_bytes() if budget is not None else 4 << 30
 
-if args.mode == "bloom":
-	if args.single:
-		assert len(args.input) == 1 and len(args.minhash_dir) == 1 and len(args.name) == 1, "Expected single input argument but got a list" 
-		dedup_single_bloom(args.input[0], args.minhash_dir[0], args.num, args.fp, args.output_file, args.name[0], args.sim_threshold, args.num_perm, args.save_dir, not args.skip_minhashing)
-	elif args.multi:
-		dedup_multi_bloom(args.input, args.minhash_dir, args.num, args.fp, args.output_file, args.name, args.sim_threshold, args.num_perm, args.save_dir, not args.skip_minhashing)
-	else:
-		assert len(args.input) == 1 and len(args.minhash_dir) == 1 and len(args.name) == 1, "Expected single input argument but got a list" 
-		dedup_single_file_bloom(args.input[0], args.minhash_dir[0], args.num, args.fp, args.output_file, args.name[0], args.sim_threshold, args.num_perm, args.save_dir, not args.skip_minhashing)
-else:
-	if args.single:
-		assert len(args.input) == 1 and len(args.minhash_dir) == 1 and len(args.name) == 1, "Expected single input argument but got a list" 
-		dedup_single_lsh(args.input[0], args.minhash_dir[0], args.output_file, args.name[0], args.sim_threshold, args.num_perm, redis_port=args.redis_port, compute_minhashes=not args.skip_minhashing)
-	elif args.multi:
-		dedup_multi_lsh(args.input, args.minhash_dir, args.output_file, args.name, args.sim_threshold, args.num_perm, redis_port=args.redis_port, compute_minhashes=not args.skip_minhashing)
+signature_dir = None
+if args.verify and args.mode == "lsh":
+	signature_dir = args.signature_dir or os.path.join(os.path.dirname(args.output_file), "signatures")
+
+plan = None
+if args.auto_tune:
+	assert args.mode in ("lsh", "bloom") and not args.query_only and isinstance(sim_threshold, float), "--auto-tune plans a new LSH or Bloom index for a single threshold"
+	assert args.num, "--auto-tune needs the expected number of documents (-n)"
+	plan_file = args.plan_file or os.path.join(args.save_dir if args.mode == "bloom" else os.path.dirname(args.output_file), PLAN_NAME)
+	# an index keeps the layout it was planned with, so an existing plan is reused (--clear only empties a Bloom index)
+	plan = None if args.clear and args.mode == "bloom" else load_plan(plan_file)
+	if plan is None:
+		calibration = calibrate(args.mode, args.num_perm, redis_port=args.redis_port if args.mode == "lsh" else None)
+		plan = plan_index(args.mode, sim_threshold, args.num_perm, args.num, args.max_fp_rate, args.max_fn_rate, args.fp, args.index_memory, args.min_docs_per_sec, calibration)
+		if not args.dry_run:
+			save_plan(plan_file, plan)
+	logging.info(format_plan(plan))
+elif args.mode == "lsh" and (args.plan_file or isinstance(sim_threshold, float)):
+	# so does a Redis index without --auto-tune, the workflows apply its stored plan as well (see lsh_index_plan)
+	assert isinstance(sim_threshold, float), "A plan gives the layout of an index for a single threshold"
+	assert not args.plan_file or os.path.exists(args.plan_file), f"--plan-file {args.plan_file} does not exist"
+	plan = load_plan(args.plan_file or os.path.join(os.path.dirname(args.output_file), PLAN_NAME))
+	if plan is not None:
+		logging.info(format_plan(plan))
+
+if args.dry_run:
+	assert args.mode in ("lsh", "bloom") and not args.query_only, "--dry-run estimates a new LSH or Bloom run"
+	from deduplication.dryrun import dry_run, format_dry_run
+	estimate = dry_run(args.name, args.input, args.mode, sim_threshold, args.num_perm, args.num, args.fp, plan, args.redis_port,
+		args.dry_run_sample, args.stream, args.spill_dir)
+	logging.info(format_dry_run(estimate))
+	finish(metrics, budget)
+	sys.exit()
+
+exact = None
+if args.exact_dedup:
+	assert args.mode in ("lsh", "bloom") and not args.query_only and not args.work_dir, "--exact-dedup is only supported when minhashing for an LSH or Bloom index on a single node"
+	assert not (args.mode == "bloom" and (args.checkpoint_every or args.resume)), "--exact-dedup is not supported together with checkpointing"
+	exact = ExactFilter(args.spill_dir, capacity=args.num or 1 << 20)
+
+def run(compute_minhashes, resume):
+	if args.mode == "bloom" and args.query_only:
+		if args.single:
+			assert len(args.input) == 1 and len(args.minhash_dir) == 1 and len(args.name) == 1, "Expected single input argument but got a list" 
+			query_single_bloom(args.input[0], args.minhash_dir[0], args.output_file, args.name[0], sim_threshold, args.num_perm, args.save_dir, compute_minhashes, args.num_workers)
+		elif args.multi:
+			query_multi_bloom(args.input, args.minhash_dir, args.output_file, args.name, sim_threshold, args.num_perm, args.save_dir, compute_minhashes, args.num_workers)
+		else:
+			assert len(args.input) == 1 and len(args.minhash_dir) == 1 and len(args.name) == 1, "Expected single input argument but got a list" 
+			query_single_file_bloom(args.input[0], args.minhash_dir[0], args.output_file, args.name[0], sim_threshold, args.num_perm, args.save_dir, compute_minhashes)
+	elif args.mode == "bloom":
+		if args.single:
+			assert len(args.input) == 1 and len(args.minhash_dir) == 1 and len(args.name) == 1, "Expected single input argument but got a list" 
+			dedup_single_bloom(args.input[0], args.minhash_dir[0], args.num, args.fp, args.output_file, args.name[0], sim_threshold, args.num_perm, args.save_dir, compute_minhashes, clear=args.clear, checkpoint_every=args.checkpoint_every, resume=resume, stream=args.stream, save_minhashes=not args.no_save_minhashes, local_dedup_workers=local_dedup_workers, plan=plan, exact=exact)
+		elif args.multi:
+			dedup_multi_bloom(args.input, args.minhash_dir, args.num, args.fp, args.output_file, args.name, sim_threshold, args.num_perm, args.save_dir, compute_minhashes, clear=args.clear, checkpoint_every=args.checkpoint_every, resume=resume, stream=args.stream, save_minhashes=not args.no_save_minhashes, prefetch=args.prefetch, prefetch_bytes=args.prefetch_max_size, local_dedup_workers=local_dedup_workers, plan=plan, exact=exact)
+		else:
+			assert len(args.input) == 1 and len(args.minhash_dir) == 1 and len(args.name) == 1, "Expected single input argument but got a list" 
+			dedup_single_file_bloom(args.input[0], args.minhash_dir[0], args.num, args.fp, args.output_file, args.name[0], sim_threshold, args.num_perm, args.save_dir, compute_minhashes, clear=args.clear, checkpoint_every=args.checkpoint_every, resume=resume, plan=plan, exact=exact)
+	elif args.mode == "forest":
+		if args.single:
+			assert len(args.input) == 1 and len(args.minhash_dir) == 1 and len(args.name) == 1, "Expected single input argument but got a list" 
+			dedup_single_forest(args.input[0], args.minhash_dir[0], args.output_file, args.name[0], sim_threshold, args.num_perm, args.save_dir, compute_minhashes, clear=args.clear, num_workers=args.num_workers, top_k=args.top_k, num_trees=args.num_trees, query_only=args.query_only)
+		elif args.multi:
+			dedup_multi_forest(args.input, args.minhash_dir, args.output_file, args.name, sim_threshold, args.num_perm, args.save_dir, compute_minhashes, clear=args.clear, num_workers=args.num_workers, top_k=args.top_k, num_trees=args.num_trees, query_only=args.query_only)
+		else:
+			assert len(args.input) == 1 and len(args.minhash_dir) == 1 and len(args.name) == 1, "Expected single input argument but got a list" 
+			dedup_single_file_forest(args.input[0], args.minhash_dir[0], args.output_file, args.name[0], sim_threshold, args.num_perm, args.save_dir, compute_minhashes, clear=args.clear, top_k=args.top_k, num_trees=args.num_trees, query_only=args.query_only)
+	elif args.mode == "sort":
+		if args.single or args.multi:
+			if args.single:
+				assert len(args.input) == 1 and len(args.minhash_dir) == 1 and len(args.name) == 1, "Expected single input argument but got a list" 
+			dedup_sort(args.input, args.minhash_dir, args.output_file, args.name, sim_threshold, args.num_perm, args.spill_dir, args.sort_memory, args.num_workers, compute_minhashes, verify=args.verify)
+		else:
+			assert len(args.input) == 1 and len(args.minhash_dir) == 1 and len(args.name) == 1, "Expected single input argument but got a list" 
+			dedup_single_file_sort(args.input[0], args.minhash_dir[0], args.output_file, args.name[0], sim_threshold, args.num_perm, args.spill_dir, args.sort_memory, args.num_workers, compute_minhashes, verify=args.verify)
 	else:
-		assert len(args.input) == 1 and len(args.minhash_dir) == 1 and len(args.name) == 1, "Expected single input argument but got a list" 
-		dedup_single_file_lsh(args.input[0], args.minhash_dir[0], args.output_file, args.name[0], args.sim_threshold, args.num_perm, redis_port=args.redis_port, compute_minhashes=not args.skip_minhashing)
+		if args.single:
+			assert len(args.input) == 1 and len(args.minhash_dir) == 1 and len(args.name) == 1, "Expected single input argument but got a list" 
+			dedup_single_lsh(args.input[0], args.minhash_dir[0], args.output_file, args.name[0], sim_threshold, args.num_perm, redis_port=args.redis_port, compute_minhashes=compute_minhashes, stream=args.stream, save_minhashes=not args.no_save_minhashes, local_dedup_workers=local_dedup_workers, signature_dir=signature_dir, plan=plan, exact=exact, plan_file=args.plan_file)
+		elif args.multi:
+			dedup_multi_lsh(args.input, args.minhash_dir, args.output_file, args.name, sim_threshold, args.num_perm, redis_port=args.redis_port, compute_minhashes=compute_minhashes, stream=args.stream, save_minhashes=not args.no_save_minhashes, prefetch=args.prefetch, prefetch_bytes=args.prefetch_max_size, local_dedup_workers=local_dedup_workers, signature_dir=signature_dir, plan=plan, exact=exact, plan_file=args.plan_file)
+		else:
+			assert len(args.input) == 1 and len(args.minhash_dir) == 1 and len(args.name) == 1, "Expected single input argument but got a list" 
+			dedup_single_file_lsh(args.input[0], args.minhash_dir[0], args.output_file, args.name[0], sim_threshold, args.num_perm, redis_port=args.redis_port, compute_minhashes=compute_minhashes, signature_dir=signature_dir, plan=plan, exact=exact, plan_file=args.plan_file)
+
+	if args.cluster_dir:
+		assert args.mode in ("lsh", "sort", "forest"), "Clustering needs duplicate pairs, which are only written in LSH, Sort and Forest mode"
+		from deduplication.clustering import cluster_duplicates
+		cluster_duplicates([args.output_file], args.cluster_dir, spill_dir=args.spill_dir)
+
+	if args.write_deduplicated:
+		write_deduplicated(args.name, args.input, args.minhash_dir, [args.output_file], args.write_deduplicated, args.num_workers)
 
 
+def index_stage(takeover):
+	# only a journaled Bloom index can be picked up where a worker that died left it,
+	# any other index (and the csv) already holds part of that worker's results
+	if takeover and not (args.mode == "bloom" and args.checkpoint_every):
+		raise RuntimeError(f"The worker running the {args.mode} index stage of {args.work_dir} died and left no journal to resume from, "
+			f"clear the index and the output file, delete {os.path.join(args.work_dir, 'index')} and rerun")
+	run(False, args.resume or takeover)
+
+
+try:
+	if args.work_dir:
+		assert args.single or args.multi, "Distributed runs (--work-dir) are only supported for the --single and --multi workflows"
+		if args.mode == "bloom" and not args.query_only:
+			# a worker taking over the index stage resumes from the journal of the one that died
+			assert not local_dedup_workers and isinstance(sim_threshold, float), "Distributed Bloom runs journal their progress, which is not supported with --local-dedup or multiple thresholds"
+			args.checkpoint_every = args.checkpoint_every or 100000
+		# every worker joins the minhash stage, the index stage then runs on one worker at a time
+		if not args.skip_minhashing:
+			distributed_minhash(args.input, args.minhash_dir, args.work_dir, args.num_perm, args.worker_id, args.lease_ttl)
+		if args.mode == "bloom" and args.query_only:
+			distributed_query_bloom(args.minhash_dir, args.output_file, args.name, args.work_dir, sim_threshold, args.num_perm, args.save_dir, args.worker_id, args.lease_ttl)
+		else:
+			run_exclusive(args.work_dir, "index", index_stage, args.worker_id, args.lease_ttl)
+	else:
+		run(not args.skip_minhashing, args.resume)
+finally:
+	if exact is not None:
+		exact.close()
+	finish(metrics, budget)
@@ -1,11 +1,258 @@
-import sys
+from typing import List, Tuple, Optional
 import argparse
+import sys
+
+SIZE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def size_in_bytes(size: str) -> int:
+	"""
+	Parse a human readable size such as 512M, 200G or 1.5T (powers of 1024) into a number of bytes
+	"""
+	size = size.strip().upper().rstrip("B")
+	unit = size[-1] if size and size[-1] in SIZE_UNITS else ""
+	try:
+		return int(float(size[:len(size) - len(unit)]) * SIZE_UNITS[unit])
+	except ValueError:
+		raise argparse.ArgumentTypeError(f"Invalid size: {size}, expected e.g. 512M, 200G or 1.5T")
+
+
+# subcommands, each runs one stage on its own and imports only what that stage needs. Without a subcommand the
+# arguments are those of index, which minhashes the input and deduplicates it in one go
+COMMANDS = ("minhash", "index", "query", "evaluate", "bench")
+
+
+def add_common_arguments(parser: argparse.ArgumentParser):
+	"""
+	Arguments for resources, monitoring and distributed runs shared by the subcommands
+	"""
+	parser.add_argument(
+		"--worker-id",
+		help="<Distributed> Unique name of this worker. Default is <hostname>-<pid>",
+		default=None,
+	)
+	parser.add_argument(
+		"--lease-ttl",
+		help="<Distributed> Seconds after which work claimed by a worker that stopped sending heartbeats is handed to another worker. Default is 600",
+		type=float,
+		default=600,
+	)
+	parser.add_argument(
+		"--read-block-size",
+		help="Size of every read from an input file, rounded up to a multiple of the filesystem's preferred I/O size (the stripe size on Lustre), e.g. 16M. Default is 8M",
+		type=size_in_bytes,
+		default=8 << 20,
+	)
+	parser.add_argument(
+		"--open-files",
+		help="Number of input files read at the same time while minhashing: the one being hashed and the next ones, opened and read ahead. Default is 4",
+		type=int,
+		default=4,
+	)
+	parser.add_argument(
+		"--text-column",
+		help="<Parquet or Arrow input> Column holding the text of every document, the only column read for minhashing. Default is text",
+		default="text",
+	)
+	parser.add_argument(
+		"--memory-budget",
+		help="Memory the whole run (including its worker processes) may use, e.g. 64G. Sizes worker pools, documents in flight to the minhash workers, --prefetch-max-size, --sort-memory, --index-memory and the Bloom filters (raising --fp if the filters for -n documents would not fit in half the budget) from it, and makes the run back off (fewer documents in flight, no hashing ahead) when its resident size gets close to it. Default is unlimited",
+		type=size_in_bytes,
+		default=None,
+	)
+	parser.add_argument(
+		"--metrics-file",
+		help="Export counters, queue depths and per-stage latency histograms (parse, tokenize, hash, band hash, index query/insert, write) to this file every --metrics-interval seconds, as json lines or, if it ends in .prom, as a Prometheus textfile. Default is disabled",
+		default=None,
+	)
+	parser.add_argument(
+		"--metrics-interval",
+		help="<With --metrics-file> Seconds between metrics exports. Default is 30",
+		type=float,
+		default=30,
+	)
+	parser.add_argument(
+		"--trace-file",
+		help="<With --metrics-file> Also write a sample of the timed operations to this file as Chrome trace events, one per line",
+		default=None,
+	)
+	parser.add_argument(
+		"--trace-sample",
+		help="<With --trace-file> Fraction of timed operations written to the trace. Default is 0.001",
+		type=float,
+		default=0.001,
+	)
+	parser.add_argument(
+		"--log-level",
+		help="Level of the log messages to print, e.g. WARNING to only print problems. Progress bars are only shown on a terminal. Default is INFO",
+		default="INFO",
+	)
+
+
+def parse_minhash_args(argv: Optional[List[str]] = None):
+	"""
+	Arguments of the minhash subcommand, which only computes signatures (e.g. one input file per task of an array job)
+	"""
+	parser = argparse.ArgumentParser(
+		prog="python -m deduplication minhash",
+		description="Compute the minhash signatures of jsonl, Parquet or Arrow corpora, to be deduplicated later with --skip-minhashing",
+		formatter_class=argparse.RawTextHelpFormatter
+	)
+	parser.add_argument(
+		"--input",
+		help="Directories of jsonl, Parquet and Arrow files and/or single such files",
+		required=True,
+		nargs="+",
+	)
+	parser.add_argument(
+		"--minhash-dir",
+		help="Output directory of the pickled minhash signatures of each input",
+		required=True,
+		nargs="+",
+	)
+	parser.add_argument(
+		"--num-perm",
+		help="Number of hash functions for MinHashing. Default is 128",
+		type=int,
+		default=128,
+	)
+	parser.add_argument(
+		"--work-dir",
+		help="Shared directory to coordinate a distributed run: launch the same command on any number of nodes and every input file is hashed by whichever worker claims it. Inputs must then be directories",
+		default=None,
+	)
+	add_common_arguments(parser)
+	args = parser.parse_args(argv)
+	if len(args.input) != len(args.minhash_dir):
+		parser.error(f"Expected one --minhash-dir per --input, got {len(args.minhash_dir)} for {len(args.input)}")
+	return args
+
+
+def band_layout(layout: str) -> Tuple[int, int]:
+	"""
+	Parse a band layout given as BxR, e.g. 9x13 for 9 bands of 13 rows
+	"""
+	try:
+		b, r = (int(v) for v in layout.lower().split("x"))
+	except ValueError:
+		raise argparse.ArgumentTypeError(f"Invalid band layout: {layout}, expected bands x rows, e.g. 9x13")
+	return b, r
+
+
+def parse_evaluate_args(argv: Optional[List[str]] = None):
+	"""
+	Arguments of the evaluate subcommand, which estimates the precision and recall of a finished run from samples
+	"""
+	parser = argparse.ArgumentParser(
+		prog="python -m deduplication evaluate",
+		description="Estimate the precision and recall of a finished run, per corpus and threshold, by comparing samples of the reported and the kept documents with the most similar documents before them using the true Jaccard similarity of their texts",
+		formatter_class=argparse.RawTextHelpFormatter
+	)
+	parser.add_argument(
+		"--name",
+		help="Name(s) of the corpora of the run, in the order they were deduplicated",
+		required=True,
+		nargs="+",
+	)
+	parser.add_argument(
+		"--input",
+		help="Directories (or single files) of the corpora, to read the texts of the sampled documents from",
+		required=True,
+		nargs="+",
+	)
+	parser.add_argument(
+		"--minhash-dir",
+		help="Signature directories of the corpora",
+		required=True,
+		nargs="+",
+	)
+	parser.add_argument(
+		"--output-file",
+		help="Duplicate file(s) written by the run, csv or binary",
+		required=True,
+		nargs="+",
+	)
+	parser.add_argument(
+		"--sim-threshold",
+		help="Jaccard similarity threshold of the run, for output files without a threshold column. Default is 0.8",
+		type=float,
+		default=0.8,
+	)
+	parser.add_argument(
+		"--num-perm",
+		help="Number of hash functions of the signatures. Default is 128",
+		type=int,
+		default=128,
+	)
+	parser.add_argument(
+		"--save-dir",
+		help="Index directory of the run, whose stored plan (if any) gives the band layout of the run. Default is the layout datasketch picks for the threshold",
+		default=None,
+	)
+	parser.add_argument(
+		"--plan-file",
+		help="Plan of the run if it is not in save-dir, e.g. for LSH mode with --auto-tune",
+		default=None,
+	)
+	parser.add_argument(
+		"--layouts",
+		help="Other band layouts to report the expected precision and recall of, as bands x rows, e.g. 9x13 12x8",
+		type=band_layout,
+		nargs="+",
+		default=[],
+	)
+	parser.add_argument(
+		"--samples",
+		help="Number of reported and of kept documents sampled per corpus and threshold. Default is 500",
+		type=int,
+		default=500,
+	)
+	parser.add_argument(
+		"--top",
+		help="Number of most similar earlier documents (by signature) whose texts are compared with each sampled document. Default is 3",
+		type=int,
+		default=3,
+	)
+	parser.add_argument(
+		"--confidence",
+		help="Confidence level of the intervals. Default is 0.95",
+		type=float,
+		default=0.95,
+	)
+	parser.add_argument(
+		"--seed",
+		help="Seed of the samples. Default is 0",
+		type=int,
+		default=0,
+	)
+	parser.add_argument(
+		"--num-workers",
+		help="Number of processes scanning signature files and reading texts. Default is 1",
+		type=int,
+		default=1,
+	)
+	parser.add_argument(
+		"--report",
+		help="Also write the estimates to this json file",
+		default=None,
+	)
+	add_common_arguments(parser)
+	args = parser.parse_args(argv)
+	if not len(args.name) == len(args.input) == len(args.minhash_dir):
+		parser.error(f"Expected one --input and --minhash-dir per --name, got {len(args.input)} and {len(args.minhash_dir)} for {len(args.name)}")
+	return args
+
 
 # cmd arguments
-def parse_args():
-	cmd_args = " ".join(sys.argv)
+def parse_args(argv: Optional[List[str]] = None):
+	"""
+	Arguments of the index and query subcommands, or of a command line without a subcommand (same as index)
+	"""
+	argv = sys.argv[1:] if argv is None else list(argv)
+	command = argv.pop(0) if argv and argv[0] in ("index", "query") else None
 	parser = argparse.ArgumentParser(
-		description="CLI Tool for Text Deduplication using MinHashLSH",
+		prog=f"python -m deduplication {command}" if command else None,
+		description="CLI Tool for Text Deduplication using MinHashLSH" + (", query only: check the input against an existing index without modifying it" if command == "query" else ""),
 		formatter_class=argparse.RawTextHelpFormatter
 	)
 	group = parser.add_mutually_exclusive_group(required=True)
@@ -32,7 +279,7 @@ def parse_args():
 	)
 	parser.add_argument(
 		"--input",
-		help="<Single or Multi workflow> Directory or directories where jsonl data is stored\n<File workflow> JSONL file to deduplicate",
+		help="<Single or Multi workflow> Directory or directories where jsonl, Parquet or Arrow data is stored\n<File workflow> JSONL, Parquet or Arrow file to deduplicate",
 		required=True,
 		nargs="+",
 	)
@@ -44,36 +291,37 @@ def parse_args():
 	)
 	parser.add_argument(
 		"--output-file",
-		help="Path to csv file where duplicates will be logged",
+		help="Path to csv file where duplicates will be logged, a path ending in .dups is written in a compact binary columnar format instead",
 		required=True,
 	)
 	parser.add_argument(
 		"--sim-threshold",
-		help="Jaccard Similarity threshold for deduplication, should be in [0, 1]. Default is 0.8",
-		default=0.8,
+		help="Jaccard Similarity threshold for deduplication, should be in [0, 1]. Default is 0.8. <LSH or Bloom mode> Several thresholds may be given, one index per threshold is then built over a single read of the signatures and each duplicate is tagged with its threshold",
+		nargs="+",
+		type=float,
+		default=[0.8],
 	)
 	parser.add_argument(
 		"--num-perm",
 		help="Number of hash functions for MinHashing. Default is 128",
+		type=int,
 		default=128,
 	)
 	parser.add_argument(
 		"--mode",
 		default="bloom",
-		choices=["lsh", "bloom"],
-		help="Whether to use classic MinHashLSH or LSHBloom, default is LSHBloom",
+		choices=["lsh", "bloom", "sort", "forest"],
+		help="Whether to use classic MinHashLSH, LSHBloom, the offline sort engine (deduplicates a fixed set of corpora in one batch, no index is kept) or an LSH Forest (top-k queries), default is LSHBloom",
 	)
 	parser.add_argument(
 		"--save-dir",
-		help="<Bloom Mode (Required)> Directory where Bloom Index will be stored",
-		required=("--mode lsh" not in cmd_args)
+		help="<Bloom or Forest Mode (Required)> Directory where Bloom Index or LSH Forest will be stored",
 	)
 	parser.add_argument(
 		"-n",
 		"--num",
 		type=int,
-		help="<Bloom Mode (Required)> Total size of text dataset in number of documents",
-		required=("--mode lsh" not in cmd_args),
+		help="<Bloom Mode (Required except with --dry-run), or with --auto-tune> Total size of text dataset in number of documents",
 	)
 	parser.add_argument(
 		"--fp",
@@ -83,19 +331,180 @@ def parse_args():
 	)
 	parser.add_argument(
 		"--clear",
-		help="<Bloom Mode> If set, will remove the bloom filter index in save-dir as well as any results csv and start from scratch (Warning: this can not be undone)",
+		help="<Bloom or Forest Mode> If set, will remove the bloom filter index or LSH Forest in save-dir as well as any results csv and start from scratch (Warning: this can not be undone)",
 		action="store_true"
 	)
+	parser.add_argument(
+		"--checkpoint-every",
+		help="<Bloom Mode> If set, journal progress in save-dir and durably sync the Bloom Index every N documents so that an interrupted run can be resumed. Default is 0 (disabled)",
+		type=int,
+		default=0,
+	)
+	parser.add_argument(
+		"--resume",
+		help="<Bloom Mode> If set, resume an interrupted run from the last checkpoint journaled in save-dir (uses --checkpoint-every, or every 100000 documents if unset)",
+		action="store_true"
+	)
+	parser.add_argument(
+		"--query-only",
+		help="<Bloom or Forest Mode> If set, only check the input against the existing Bloom Index or LSH Forest in save-dir and log duplicates, without inserting anything. The index is opened read-only so many processes can query it at once",
+		action="store_true"
+	)
+	parser.add_argument(
+		"--num-workers",
+		help="Number of processes to use where a stage can run in parallel (e.g. --query-only, --local-dedup, --mode sort or forest). Default is 1",
+		type=int,
+		default=1,
+	)
 	parser.add_argument(
 		"--redis_port",
 		help="<LSH mode> The port that Redis server is listening on. Default is 6379",
 		type=int,
 		default=6379,
 	)
+	parser.add_argument(
+		"--spill-dir",
+		help="<Sort mode, --cluster-dir or --dry-run> Local directory for the intermediate sort files (or the sample of a dry run). Default is the system temp dir",
+		default=None,
+	)
+	parser.add_argument(
+		"--sort-memory",
+		help="<Sort mode> Approximate memory budget for all sort workers together, e.g. 64G. Default is half of --memory-budget, or 4G",
+		type=size_in_bytes,
+		default=None,
+	)
+	parser.add_argument(
+		"--top-k",
+		help="<Forest mode> Number of nearest neighbours to retrieve for each document before applying sim-threshold. Default is 5",
+		type=int,
+		default=5,
+	)
+	parser.add_argument(
+		"--num-trees",
+		help="<Forest mode> Number of prefix trees of a new LSH Forest, ignored if the forest in save-dir already exists. Default is 8",
+		type=int,
+		default=8,
+	)
+	parser.add_argument(
+		"--verify",
+		help="<LSH or Sort mode> If set, check every LSH candidate pair by estimating the Jaccard similarity of the two minhash signatures and only report pairs at or above sim-threshold, with the estimate in an extra similarity column",
+		action="store_true"
+	)
+	parser.add_argument(
+		"--signature-dir",
+		help="<LSH mode with --verify> Directory where the signatures of every indexed corpus are kept for verification, should be reused along with the index. Default is a signatures directory next to output-file",
+		default=None,
+	)
+	parser.add_argument(
+		"--cluster-dir",
+		help="<LSH, Sort or Forest mode> If set, group the duplicate pairs in output-file into clusters once deduplication is done and write cluster ids and one representative per cluster to this directory as numpy arrays",
+		default=None,
+	)
+	parser.add_argument(
+		"--write-deduplicated",
+		help="If set, once deduplication is done write every input corpus without the documents listed in output-file to this directory, one JSONL file per input file under a directory per corpus name. Kept lines are copied verbatim as byte ranges (using --num-workers processes), without parsing any JSON. Only jsonl inputs are written",
+		default=None,
+	)
+	parser.add_argument(
+		"--auto-tune",
+		help="<LSH or Bloom mode> If set, choose the number of bands and rows (and the Bloom filter sizes) of a new index from -n and the limits below, calibrated by a short benchmark of this machine. In Bloom mode --fp is then the rate at which new documents are flagged by the filters as a whole",
+		action="store_true"
+	)
+	parser.add_argument(
+		"--max-fp-rate",
+		help="<With --auto-tune> Largest acceptable chance that a pair below sim-threshold becomes a candidate (averaged over similarities in [0, sim-threshold])",
+		type=float,
+		default=None,
+	)
+	parser.add_argument(
+		"--max-fn-rate",
+		help="<With --auto-tune> Largest acceptable chance that a pair above sim-threshold is missed (averaged over similarities in [sim-threshold, 1])",
+		type=float,
+		default=None,
+	)
+	parser.add_argument(
+		"--index-memory",
+		help="<With --auto-tune> Largest acceptable size of the index once -n documents are inserted, e.g. 64G",
+		type=size_in_bytes,
+		default=None,
+	)
+	parser.add_argument(
+		"--min-docs-per-sec",
+		help="<With --auto-tune> Smallest acceptable index throughput in documents per second, as estimated by the benchmark",
+		type=float,
+		default=None,
+	)
+	parser.add_argument(
+		"--plan-file",
+		help="Where the --auto-tune plan is kept and reused by later runs, in LSH mode also without --auto-tune. Default is plan.json in save-dir (Bloom mode) or next to output-file (LSH mode)",
+		default=None,
+	)
+	parser.add_argument(
+		"--stream",
+		help="<Single or Multi workflow> If set, feed minhash signatures straight into the index as each input file is hashed, overlapping the minhashing and deduplication steps",
+		action="store_true"
+	)
+	parser.add_argument(
+		"--no-save-minhashes",
+		help="<Stream> If set, do not write the pickled minhash signatures to minhash-dir",
+		action="store_true"
+	)
+	parser.add_argument(
+		"--prefetch",
+		help="<Multi workflow> Number of corpora to minhash ahead of the corpus currently being deduplicated, so that minhashing of later corpora overlaps with indexing. Default is 0 (disabled)",
+		type=int,
+		default=0,
+	)
+	parser.add_argument(
+		"--prefetch-max-size",
+		help="<Multi workflow> Upper bound on the size of minhash signatures computed ahead of the index, e.g. 200G. Default is unbounded",
+		type=size_in_bytes,
+		default=None,
+	)
+	parser.add_argument(
+		"--read-ahead",
+		help="Number of signature files loaded (and unpickled) on background threads ahead of the index, so that reading overlaps with indexing. Files are still indexed in sorted order. 0 loads each file only when the index gets to it. Default is 2",
+		type=int,
+		default=2,
+	)
+	parser.add_argument(
+		"--local-dedup",
+		help="<Single or Multi workflow> If set, first deduplicate every minhash file against itself in parallel (using --num-workers processes) and only send the surviving documents to the index. Not supported with --checkpoint-every/--resume",
+		action="store_true"
+	)
+	parser.add_argument(
+		"--exact-dedup",
+		help="<LSH or Bloom mode> If set, hash the whitespace-normalized text of every document while minhashing and skip the signature (and the index) for exact repeats of a document seen earlier in the run, which are still reported as duplicates. Not supported with --checkpoint-every/--resume or --work-dir",
+		action="store_true"
+	)
+	parser.add_argument(
+		"--work-dir",
+		help="<Single or Multi workflow> Shared directory to coordinate a distributed run. Launch the same command on any number of nodes: input files are minhashed by whichever worker claims them and the deduplication step then runs on one worker, or with --query-only is also split over all workers by signature file",
+		default=None,
+	)
+	parser.add_argument(
+		"--dry-run",
+		help="<LSH or Bloom mode> If set, only estimate the run from a random sample of the input documents and log the estimate: documents, docs/sec of the minhash and index stages on this node, fraction of duplicates, size of the Bloom filters for -n at --fp (or of the Redis index) and wall time per number of --work-dir workers. Nothing of the run is written",
+		action="store_true"
+	)
+	parser.add_argument(
+		"--dry-run-sample",
+		help="<Dry run> Number of documents to sample across all inputs. Default is 10000",
+		type=int,
+		default=10000,
+	)
 	parser.add_argument(
 		"--skip-minhashing",
 		help="If set, will skip the minhashing step of each workflow (useful if minhashes have been precomputed at minhash_dir)",
 		action="store_true"
 	)
+	add_common_arguments(parser)
 
-	return parser.parse_args()
+	args = parser.parse_args(argv)
+	if command == "query":
+		args.query_only = True
+	if args.mode in ("bloom", "forest") and not args.save_dir:
+		parser.error("--save-dir is required in Bloom and Forest mode")
+	if args.mode == "bloom" and not args.query_only and not args.dry_run and not args.num:
+		parser.error("-n/--num is required in Bloom mode, except with --query-only or --dry-run")
+	return args
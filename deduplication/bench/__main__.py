@@ -0,0 +1,165 @@
+from deduplication.bench.corpus import CONFIG_NAME, generate_corpus
+from deduplication.bench.stages import STAGES, STARTUP_COMMANDS, measure, bench_minhash, bench_lsh, bench_bloom, bench_writers, bench_startup
+from typing import List, Dict, Optional
+from functools import partial
+import subprocess
+import statistics
+import platform
+import argparse
+import socket
+import json
+import time
+import sys
+import os
+
+# throughput metric of every stage, compared against a baseline
+RATES = {"docs": "docs_per_sec", "rows": "rows_per_sec", "runs": "runs_per_sec"}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the deduplication stages on a synthetic corpus with planted near-duplicates",
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--work-dir", help="Directory for the corpus, signatures and indexes", required=True)
+    parser.add_argument("--results", help="JSONL file the results are appended to, one line per stage and repetition. Default is results.jsonl in work-dir", default=None)
+    parser.add_argument("--stages", help=f"Stages to run, any of {', '.join(STAGES)}. Default is all but lsh-redis", nargs="+", choices=STAGES, default=[s for s in STAGES if s != "lsh-redis"])
+    parser.add_argument("--repeat", help="Number of times to run every stage. Default is 3", type=int, default=3)
+    parser.add_argument("--n-docs", help="Number of documents in the corpus. Default is 20000", type=int, default=20000)
+    parser.add_argument("--n-files", help="Number of JSONL files in the corpus. Default is 8", type=int, default=8)
+    parser.add_argument("--doc-len", help="Typical document length in tokens. Default is 300", type=int, default=300)
+    parser.add_argument("--vocab-size", help="Vocabulary size. Default is 50000", type=int, default=50000)
+    parser.add_argument("--skew", help="Zipf exponent of the token distribution. Default is 1.1", type=float, default=1.1)
+    parser.add_argument("--dup-rate", help="Fraction of documents that are planted near-duplicates. Default is 0.2", type=float, default=0.2)
+    parser.add_argument("--jaccard-levels", help="Jaccard similarities the near-duplicates are planted at. Default is 1.0 0.9 0.8 0.7 0.5", type=float, nargs="+", default=[1.0, 0.9, 0.8, 0.7, 0.5])
+    parser.add_argument("--seed", help="Seed of the corpus generator. Default is 0", type=int, default=0)
+    parser.add_argument("--sim-threshold", help="Jaccard similarity threshold of the indexes. Default is 0.8", type=float, default=0.8)
+    parser.add_argument("--num-perm", help="Number of hash functions for MinHashing. Default is 128", type=int, default=128)
+    parser.add_argument("--redis_port", help="<lsh-redis> Port of the Redis server to benchmark against. Default is 6379", type=int, default=6379)
+    parser.add_argument("--writer-rows", help="<writers> Number of duplicate rows to write. Default is 1000000", type=int, default=1000000)
+    parser.add_argument("--startup-runs", help="<startup> Number of times every command line is started. Default is 10", type=int, default=10)
+    parser.add_argument("--compare", help="Results file of an earlier run to compare throughput against, e.g. from another commit", default=None)
+    parser.add_argument("--tolerance", help="<With --compare> Slowdown beyond which a stage counts as a regression. Default is 0.1 (10%%)", type=float, default=0.1)
+    return parser.parse_args()
+
+
+def git_commit() -> Optional[str]:
+    try:
+        out = subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+
+def prepare_corpus(corpus_dir: str, config: Dict) -> Dict:
+    # the corpus is reused as long as it was generated with the same settings
+    path = os.path.join(corpus_dir, CONFIG_NAME)
+    if os.path.exists(path):
+        with open(path) as fin:
+            existing = json.load(fin)
+        if {k: existing.get(k) for k in config} == config:
+            return existing
+    print(f"Generating {config['n_docs']:,} documents in {corpus_dir}")
+    return generate_corpus(corpus_dir, **config)
+
+
+def stage_runs(args, corpus_dir: str, minhash_dir: str, docs: int) -> Dict:
+    return {
+        "minhash": partial(bench_minhash, corpus_dir, minhash_dir, args.num_perm, docs),
+        "lsh": partial(bench_lsh, corpus_dir, minhash_dir, args.sim_threshold, args.num_perm, docs),
+        "lsh-redis": partial(bench_lsh, corpus_dir, minhash_dir, args.sim_threshold, args.num_perm, docs, args.redis_port),
+        "bloom": partial(bench_bloom, corpus_dir, minhash_dir, os.path.join(args.work_dir, "bloom"), args.sim_threshold, args.num_perm, docs),
+        "writers": {
+            "writers-csv": partial(bench_writers, os.path.join(args.work_dir, "writers"), args.writer_rows, False),
+            "writers-binary": partial(bench_writers, os.path.join(args.work_dir, "writers"), args.writer_rows, True),
+        },
+        "startup": {name: partial(bench_startup, argv, args.startup_runs) for name, argv in STARTUP_COMMANDS.items()},
+    }
+
+
+def summarize(results: List[Dict]) -> Dict[str, float]:
+    """
+    Median throughput of every stage in a list of results, by stage, corpus and parameters
+    """
+    rates = {}
+    for result in results:
+        for unit, rate in RATES.items():
+            if rate in result:
+                rates.setdefault((result["stage"], json.dumps([result.get("corpus"), result.get("params")], sort_keys=True)), []).append(result[rate])
+    return {key: statistics.median(values) for key, values in rates.items()}
+
+
+def compare(results: List[Dict], baseline_path: str, tolerance: float) -> bool:
+    """
+    Print the throughput of every stage against the baseline results, returns whether any stage regressed
+    """
+    with open(baseline_path) as fin:
+        baseline = summarize([json.loads(line) for line in fin if line.strip()])
+    regressed = False
+    print(f"{'stage':<16}{'baseline':>14}{'current':>14}{'change':>10}")
+    for key, rate in sorted(summarize(results).items()):
+        stage = key[0]
+        if key not in baseline:
+            print(f"{stage:<16}{'-':>14}{rate:>14,.0f}")
+            continue
+        base = baseline[key]
+        change = rate / base - 1
+        flag = change < -tolerance
+        regressed |= flag
+        print(f"{stage:<16}{base:>14,.0f}{rate:>14,.0f}{change:>+10.1%}" + ("  REGRESSION" if flag else ""))
+    return regressed
+
+
+def main():
+    args = parse_args()
+    results_path = args.results or os.path.join(args.work_dir, "results.jsonl")
+    corpus_dir = os.path.join(args.work_dir, "corpus")
+    minhash_dir = os.path.join(args.work_dir, "minhash")
+    corpus = prepare_corpus(corpus_dir, {
+        "n_docs": args.n_docs, "n_files": args.n_files, "doc_len": args.doc_len, "vocab_size": args.vocab_size,
+        "skew": args.skew, "dup_rate": args.dup_rate, "jaccard_levels": args.jaccard_levels, "seed": args.seed,
+    })
+
+    stages = list(args.stages)
+    # the index stages read the signatures of the minhash stage
+    if "minhash" not in stages and any(s in stages for s in ("lsh", "lsh-redis", "bloom")) and not os.path.isdir(minhash_dir):
+        stages.insert(0, "minhash")
+
+    env = {
+        "commit": git_commit(),
+        "host": socket.gethostname(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+    }
+    params = {"sim_threshold": args.sim_threshold, "num_perm": args.num_perm}
+    runs = stage_runs(args, corpus_dir, minhash_dir, corpus["n_docs"])
+
+    results = []
+    with open(results_path, "a") as fout:
+        for stage in stages:
+            named = runs[stage] if isinstance(runs[stage], dict) else {stage: runs[stage]}
+            for name, fn in named.items():
+                for i in range(args.repeat):
+                    result = {"stage": name, "repeat": i, "timestamp": time.time(), **env, "params": params, "corpus": None if name.startswith(("writers-", "startup-")) else corpus}
+                    result.update(measure(fn))
+                    for unit, rate in RATES.items():
+                        if unit in result and result.get("seconds"):
+                            result[rate] = result[unit] / result["seconds"]
+                    results.append(result)
+                    fout.write(json.dumps(result) + "\n")
+                    fout.flush()
+                    if "error" in result:
+                        print(f"{name}: {result['error']}")
+                        break
+                    summary = ", ".join(f"{k}={result[k]:,.3f}" if isinstance(result[k], float) else f"{k}={result[k]:,}"
+                                        for k in ("seconds", "docs_per_sec", "rows_per_sec", "runs_per_sec", "import_seconds", "recall", "precision", "peak_rss_bytes") if k in result)
+                    print(f"{name} #{i}: {summary}")
+    print(f"Appended {len(results)} results to {results_path}")
+
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+from deduplication.signatures import jaccard
+from typing import List, Dict, Tuple, Iterable
+import numpy as np
+import json
+import os
+
+TRUTH_NAME = "truth.jsonl"
+CONFIG_NAME = "corpus.json"
+# documents go to a subdirectory so that truth.jsonl is not mistaken for part of the corpus
+DATA_NAME = "data"
+
+
+def token(i: int) -> str:
+    return f"w{i}"
+
+
+def zipf_probabilities(vocab_size: int, skew: float) -> np.ndarray:
+    """
+    Probability of every vocabulary rank under a Zipf law, p(rank) proportional to 1 / rank^skew
+    """
+    p = 1.0 / np.arange(1, vocab_size + 1) ** skew
+    return p / p.sum()
+
+
+def near_duplicate(rng: np.random.Generator, tokens: List[int], target: float, vocab_size: int) -> List[int]:
+    """
+    Copy of a document whose token set has Jaccard similarity target with the original's: of its n distinct tokens
+    d = n (1 - J) / (1 + J) are replaced, every occurrence of each by one fresh token, so the sets share n - d tokens
+    out of n + d
+    """
+    distinct = np.unique(tokens)
+    n = len(distinct)
+    d = int(round(n * (1 - target) / (1 + target)))
+    if d == 0:
+        return list(tokens)
+    dropped = rng.choice(distinct, size=d, replace=False)
+    # fresh tokens are drawn uniformly from the rest of the vocabulary, or made up if it is exhausted
+    pool = np.setdiff1d(np.arange(vocab_size), distinct, assume_unique=True)
+    if len(pool) >= d:
+        fresh = rng.choice(pool, size=d, replace=False)
+    else:
+        fresh = np.arange(vocab_size, vocab_size + d)
+    mapping = dict(zip(dropped.tolist(), fresh.tolist()))
+    return [mapping.get(t, t) for t in tokens]
+
+
+def generate_corpus(
+    out_dir: str,
+    n_docs: int = 20000,
+    n_files: int = 8,
+    doc_len: int = 300,
+    vocab_size: int = 50000,
+    skew: float = 1.1,
+    dup_rate: float = 0.2,
+    jaccard_levels: Tuple[float, ...] = (1.0, 0.9, 0.8, 0.7, 0.5),
+    seed: int = 0,
+) -> Dict:
+    """
+    Write a synthetic JSONL corpus with planted near-duplicates of known Jaccard similarity, reproducible from seed
+
+    Documents are drawn from a Zipf distributed vocabulary (skew) with lognormal lengths around doc_len tokens.
+    A dup_rate fraction of the documents are near-duplicates of an earlier original document, at a similarity chosen
+    uniformly from jaccard_levels. Every planted pair is recorded in truth.jsonl as {"key", "source", "jaccard"} with
+    the exact Jaccard similarity of the two token sets, using the same document keys as the minhash step.
+
+    out_dir - directory for the corpus, the documents are written to its data subdirectory as part-00000.jsonl and so on
+    n_files - number of JSONL files the documents are spread over, in order
+
+    returns the generator configuration, also stored in corpus.json
+    """
+    rng = np.random.default_rng(seed)
+    data_dir = os.path.join(out_dir, DATA_NAME)
+    os.makedirs(data_dir, exist_ok=True)
+    p = zipf_probabilities(vocab_size, skew)
+    lengths = np.maximum(rng.lognormal(np.log(doc_len), 0.5, size=n_docs).astype(np.int64), 5)
+    is_dup = rng.random(n_docs) < dup_rate
+    # the first document has nothing to copy
+    is_dup[0] = False
+
+    per_file = -(-n_docs // n_files)
+    originals: List[int] = []
+    docs: List[List[int]] = []
+    keys: List[str] = []
+    truth = []
+    for i in range(n_docs):
+        fname = f"part-{i // per_file:05d}.jsonl"
+        keys.append(f"{fname}-{i % per_file + 1}")
+        if is_dup[i]:
+            source = originals[rng.integers(len(originals))]
+            target = float(rng.choice(jaccard_levels))
+            tokens = near_duplicate(rng, docs[source], target, vocab_size)
+            truth.append({"key": keys[i], "source": keys[source], "jaccard": jaccard(tokens, docs[source])})
+        else:
+            tokens = rng.choice(vocab_size, size=lengths[i], p=p).tolist()
+            originals.append(i)
+        docs.append(tokens)
+
+    for start in range(0, n_docs, per_file):
+        with open(os.path.join(data_dir, f"part-{start // per_file:05d}.jsonl"), "w") as fout:
+            for tokens in docs[start:start + per_file]:
+                fout.write(json.dumps({"text": " ".join(token(t) for t in tokens)}) + "\n")
+
+    with open(os.path.join(out_dir, TRUTH_NAME), "w") as fout:
+        for row in truth:
+            fout.write(json.dumps(row) + "\n")
+
+    config = {
+        "n_docs": n_docs, "n_files": n_files, "doc_len": doc_len, "vocab_size": vocab_size, "skew": skew,
+        "dup_rate": dup_rate, "jaccard_levels": list(jaccard_levels), "seed": seed, "planted": len(truth),
+    }
+    with open(os.path.join(out_dir, CONFIG_NAME), "w") as fout:
+        json.dump(config, fout, indent=2)
+    return config
+
+
+def read_truth(corpus_dir: str) -> Dict[str, float]:
+    """
+    Planted near-duplicates of a generated corpus, as a dict mapping each copy's key to its Jaccard similarity
+    """
+    truth = {}
+    with open(os.path.join(corpus_dir, TRUTH_NAME)) as fin:
+        for line in fin:
+            row = json.loads(line)
+            truth[row["key"]] = row["jaccard"]
+    return truth
+
+
+def score(reported: Iterable[str], truth: Dict[str, float], threshold: float) -> Dict[str, float]:
+    """
+    Recall and precision of the reported duplicate keys against the planted copies with a similarity of at least
+    threshold. A reported copy planted below the threshold counts as a false positive, like any unplanted document.
+    """
+    reported = set(reported)
+    relevant = {key for key, sim in truth.items() if sim >= threshold}
+    hits = len(reported & relevant)
+    return {
+        "recall": hits / len(relevant) if relevant else 1.0,
+        "precision": hits / len(reported) if reported else 1.0,
+        "reported": len(reported),
+        "relevant": len(relevant),
+    }
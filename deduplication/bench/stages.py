@@ -0,0 +1,159 @@
+from deduplication.bench.corpus import DATA_NAME, read_truth, score
+from multiprocessing import get_context
+from typing import Callable, Dict, List, Optional
+import subprocess
+import resource
+import shutil
+import time
+import sys
+import os
+
+STAGES = ("minhash", "lsh", "lsh-redis", "bloom", "writers", "startup")
+
+# command lines whose startup is measured, each parses its arguments and exits before doing any work
+STARTUP_COMMANDS = {
+    "startup-index": ["--help"],
+    "startup-query": ["query", "--help"],
+    "startup-minhash": ["minhash", "--help"],
+    "startup-evaluate": ["evaluate", "--help"],
+    "startup-bench": ["bench", "--help"],
+}
+
+# top-level packages that must not be imported before a command has work to do: the index backends and what they pull in
+HEAVY_MODULES = ("datasketch", "scipy", "redis", "pybloomfilter")
+
+
+def io_counters() -> Optional[Dict[str, int]]:
+    """
+    Bytes read and written by this process so far (rchar and wchar, i.e. including page cache hits), Linux only
+    """
+    try:
+        with open("/proc/self/io") as fin:
+            counters = dict(line.split(": ") for line in fin.read().splitlines())
+    except OSError:
+        return None
+    return {"read_bytes": int(counters["rchar"]), "write_bytes": int(counters["wchar"])}
+
+
+def _run(fn: Callable[[], Dict], conn):
+    try:
+        before = io_counters()
+        start = time.perf_counter()
+        result = fn()
+        result["seconds"] = time.perf_counter() - start
+        after = io_counters()
+        if before is not None and after is not None:
+            result.update({k: after[k] - before[k] for k in after})
+        # ru_maxrss is in KiB on Linux, pool workers are reaped children by now
+        result["peak_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        result["peak_rss_children_bytes"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+        conn.send(result)
+    except BaseException as e:
+        conn.send({"error": f"{type(e).__name__}: {e}"})
+    finally:
+        conn.close()
+
+
+def measure(fn: Callable[[], Dict]) -> Dict:
+    """
+    Run fn in a fresh forked process so that its peak memory and I/O are not mixed up with earlier stages
+
+    fn - returns a dict of stage results, e.g. the number of documents processed
+
+    returns that dict with the elapsed seconds, bytes read and written, and the peak RSS of the process and of the
+    largest of its children, or {"error": ...} if fn raised
+    """
+    ctx = get_context("fork")
+    recv, send = ctx.Pipe(duplex=False)
+    # not a daemon, stages start their own process pools
+    p = ctx.Process(target=_run, args=(fn, send))
+    p.start()
+    send.close()
+    try:
+        result = recv.recv()
+    except EOFError:
+        result = None
+    p.join()
+    return result if result is not None else {"error": f"stage process died with exit code {p.exitcode}"}
+
+
+def bench_minhash(corpus_dir: str, minhash_dir: str, num_perm: int, docs: int) -> Dict:
+    from deduplication.minhash import MinHasher
+    shutil.rmtree(minhash_dir, ignore_errors=True)
+    MinHasher(os.path.join(corpus_dir, DATA_NAME), minhash_dir, num_perm).process()
+    return {"docs": docs}
+
+
+def _scored(duplicates, corpus_dir: str, threshold: float, docs: int) -> Dict:
+    result = score((dup[0] for dup in duplicates), read_truth(corpus_dir), threshold)
+    result["docs"] = docs
+    return result
+
+
+def bench_lsh(corpus_dir: str, minhash_dir: str, threshold: float, num_perm: int, docs: int, redis_port: Optional[int] = None) -> Dict:
+    from deduplication.lsh import LSHIndex
+    lsh_params = {"threshold": threshold, "num_perm": num_perm}
+    if redis_port is not None:
+        import redis
+        client = redis.Redis(host="localhost", port=redis_port)
+        client.ping()
+        # a fresh basename per run so that earlier runs do not count as existing documents
+        lsh_params["storage_config"] = {
+            "type": "redis",
+            "basename": f"bench-{os.getpid()}-{time.time_ns()}".encode(),
+            "redis": {"host": "localhost", "port": redis_port},
+        }
+    index = LSHIndex(minhash_dir, lsh_params)
+    try:
+        duplicates = index.deduplicate_corpus()
+    finally:
+        if redis_port is not None:
+            for key in client.scan_iter(match=lsh_params["storage_config"]["basename"] + b"*"):
+                client.delete(key)
+    return _scored(duplicates, corpus_dir, threshold, docs)
+
+
+def bench_bloom(corpus_dir: str, minhash_dir: str, save_dir: str, threshold: float, num_perm: int, docs: int, fp: float = 0.001) -> Dict:
+    from deduplication.lshbloom import LSHBloom
+    shutil.rmtree(save_dir, ignore_errors=True)
+    os.makedirs(save_dir)
+    index = LSHBloom(minhash_dir, {"threshold": threshold, "num_perm": num_perm, "n": docs, "fp": fp, "save_dir": save_dir})
+    duplicates = index.deduplicate_corpus()
+    result = _scored(duplicates, corpus_dir, threshold, docs)
+    result["index_bytes"] = sum(os.path.getsize(os.path.join(save_dir, f)) for f in os.listdir(save_dir))
+    return result
+
+
+def bench_writers(out_dir: str, rows: int, binary: bool) -> Dict:
+    from deduplication.writers import DuplicateWriter
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, "duplicates" + (".dups" if binary else ".csv"))
+    if os.path.exists(path):
+        os.remove(path)
+    with DuplicateWriter(path, "bench", header=["corpus", "key", "dup_key", "similarity"], binary=binary) as writer:
+        for i in range(rows):
+            writer.append((f"part-{i % 64:05d}.jsonl-{i + 1}", f"part-{i % 7:05d}.jsonl-{i // 2 + 1}", "0.8125"))
+    return {"rows": rows, "file_bytes": os.path.getsize(path)}
+
+
+def bench_startup(argv: List[str], runs: int) -> Dict:
+    """
+    Start python -m deduplication with argv runs times, with -X importtime
+
+    returns the number of runs and the import time of the last one, raises RuntimeError if the command imported any
+    of HEAVY_MODULES
+    """
+    cmd = [sys.executable, "-X", "importtime", "-m", "deduplication"] + argv
+    for _ in range(runs):
+        proc = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    # one line per module, "import time: <self us> | <cumulative us> | <name indented by nesting>"
+    imported = {}
+    for line in proc.stderr.splitlines():
+        fields = line.split("|")
+        if line.startswith("import time:") and len(fields) == 3 and fields[1].strip().isdigit():
+            name = fields[2][1:]
+            imported[name.strip()] = (int(fields[1]), name == name.lstrip())
+    heavy = sorted({name.split(".")[0] for name in imported} & set(HEAVY_MODULES))
+    if heavy:
+        raise RuntimeError(f"python -m deduplication {' '.join(argv)} imports {', '.join(heavy)}")
+    return {"runs": runs, "import_seconds": sum(us for us, top in imported.values() if top) / 1e6}
@@ -0,0 +1,158 @@
+from typing import Dict, List, Optional
+import json
+import os
+
+JOURNAL_NAME = "progress.journal"
+
+
+class ProgressJournal:
+    """
+    Append-only progress journal for resumable LSHBloom runs, stored next to the Bloom filters in save_dir
+
+    Work is committed in windows of `checkpoint_every` documents. Each window is written as a pair of records:
+    a "begin" record naming the window and the offsets of the documents that were found to be duplicates
+    (everything else in the window gets inserted), followed by a "commit" record once the window's inserts have
+    been applied, the filters have been synced to disk and its duplicates have been appended to the results csv.
+    Both records are fsync'd before the run moves on.
+
+    On resume a committed window is never processed again. A window with a "begin" but no "commit" is replayed from
+    its recorded verdicts, so its inserts are re-applied (Bloom filter inserts are idempotent) and its duplicates are
+    rewritten after truncating the csv back to the size it had before that window, rather than re-querying documents
+    whose bits may already be set by the interrupted run.
+
+    Example usage:
+    ```
+    journal = ProgressJournal(save_dir, csvfile, corpus_name, header=["dup_key"], checkpoint_every=100000)
+    journal.load() # or journal.reset() to start from scratch
+    index = LSHBloom(minhash_dir, lsh_params)
+    index.deduplicate_corpus(journal=journal)
+    ```
+    """
+    def __init__(self, save_dir: str, csvpath: str, corpus_name: str, header: Optional[List[str]] = None, checkpoint_every: int = 100000):
+        """
+        save_dir: directory of the Bloom index, the journal is stored here as progress.journal
+        csvpath: path to the csv file duplicates are appended to
+        corpus_name: name of the corpus currently being deduplicated, prepended to each csv row
+        header: optional header row for the csv file
+        checkpoint_every: number of documents per committed window
+        """
+        assert checkpoint_every > 0, f"checkpoint_every should be a positive number of documents, got {checkpoint_every}"
+        self.path = os.path.join(save_dir, JOURNAL_NAME)
+        self.csvpath = csvpath
+        self.corpus_name = corpus_name
+        self.header = header
+        self.checkpoint_every = checkpoint_every
+
+        self.offsets: Dict[str, int] = {}
+        self.done = set()
+        self.corpora = set()
+        self.pending: Optional[Dict] = None
+        os.makedirs(save_dir, exist_ok=True)
+
+    def reset(self):
+        """
+        Discard any existing progress and start a fresh journal
+        """
+        with open(self.path, "w") as fout:
+            fout.flush()
+            os.fsync(fout.fileno())
+        self.offsets, self.done, self.corpora, self.pending = {}, set(), set(), None
+
+    def load(self):
+        """
+        Rebuild progress from the journal on disk. A torn trailing record from a crash mid-write is ignored.
+        """
+        self.offsets, self.done, self.corpora, self.pending = {}, set(), set(), None
+        if not os.path.exists(self.path):
+            return
+        valid_size = 0
+        with open(self.path, "rb") as fin:
+            for line in fin:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                valid_size += len(line)
+                if record["op"] == "begin":
+                    self.pending = record
+                elif record["op"] == "commit":
+                    self.offsets[record["file"]] = record["end"]
+                    if record["done"]:
+                        self.done.add(record["file"])
+                    self.pending = None
+                elif record["op"] == "corpus":
+                    self.corpora.add(record["dir"])
+
+        # cut off the torn record so that new records are appended on a line of their own
+        if os.path.getsize(self.path) > valid_size:
+            with open(self.path, "r+b") as fout:
+                fout.truncate(valid_size)
+                fout.flush()
+                os.fsync(fout.fileno())
+
+    def _append(self, record: Dict):
+        with open(self.path, "a") as fout:
+            fout.write(json.dumps(record) + "\n")
+            fout.flush()
+            os.fsync(fout.fileno())
+
+    def csv_size(self) -> int:
+        return os.path.getsize(self.csvpath) if os.path.exists(self.csvpath) else 0
+
+    def truncate_csv(self, size: int):
+        """
+        Drop any csv rows appended after the given size, i.e. rows from a window that never committed
+        """
+        if os.path.exists(self.csvpath) and os.path.getsize(self.csvpath) > size:
+            with open(self.csvpath, "r+") as fout:
+                fout.truncate(size)
+                fout.flush()
+                os.fsync(fout.fileno())
+
+    def offset(self, fname: str) -> int:
+        """
+        Number of leading documents of fname that are already committed
+        """
+        return self.offsets.get(fname, 0)
+
+    def is_done(self, fname: str) -> bool:
+        return fname in self.done
+
+    def corpus_done(self, minhash_dir: str) -> bool:
+        return os.path.abspath(minhash_dir) in self.corpora
+
+    def pending_for(self, fname: str) -> Optional[Dict]:
+        """
+        The uncommitted window for fname left behind by an interrupted run, if any
+        """
+        if self.pending is not None and self.pending["file"] == fname:
+            return self.pending
+        return None
+
+    def begin(self, fname: str, start: int, end: int, dups: List[int]):
+        """
+        Record the verdicts for documents [start, end) of fname before their inserts are applied.
+        dups holds the offsets (relative to start) of documents that were duplicates and will not be inserted.
+        """
+        self.pending = {"op": "begin", "file": fname, "start": start, "end": end, "dups": dups, "csv_size": self.csv_size()}
+        self._append(self.pending)
+
+    def commit(self, fname: str, end: int, done: bool):
+        """
+        Mark the window ending at end as durable, must only be called once filters and csv have been synced
+        """
+        self._append({"op": "commit", "file": fname, "end": end, "done": done, "csv_size": self.csv_size()})
+        self.offsets[fname] = end
+        if done:
+            self.done.add(fname)
+        self.pending = None
+
+    def commit_corpus(self, minhash_dir: str):
+        """
+        Mark every signature file in minhash_dir as deduplicated, so a resumed multi-corpus run can skip it entirely
+        """
+        minhash_dir = os.path.abspath(minhash_dir)
+        self._append({"op": "corpus", "dir": minhash_dir})
+        self.corpora.add(minhash_dir)
@@ -0,0 +1,214 @@
+from tqdm.autonotebook import tqdm
+from deduplication.writers import read_duplicate_rows
+from typing import List, Iterator, Optional, Tuple
+import numpy as np
+import tempfile
+import hashlib
+import shutil
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+NODES_NAME = "nodes.npy"
+CLUSTERS_NAME = "clusters.npy"
+REPRESENTATIVES_NAME = "representatives.npy"
+
+
+def key_hash(key: str) -> int:
+    """
+    64-bit id of a document key, stable across runs and processes
+    """
+    return int.from_bytes(hashlib.blake2b(key.encode("utf8"), digest_size=8).digest(), "little")
+
+
+def read_pair_chunks(csvfiles: List[str], chunk_size: int) -> Iterator[np.ndarray]:
+    """
+    Stream (key, dup_key) pairs from duplicate csv files with a (corpus, key, dup_key) layout as hashed ids
+
+    yields arrays of shape (n, 2) holding (dup_key, key) ids, at most chunk_size rows each
+    """
+    for csvfile in csvfiles:
+        chunk = []
+        for row in read_duplicate_rows(csvfile):
+            if len(row) < 3 or row[:3] == ["corpus", "key", "dup_key"] or not row[2]:
+                continue
+            chunk.append((key_hash(row[2]), key_hash(row[1])))
+            if len(chunk) >= chunk_size:
+                yield np.array(chunk, dtype=np.uint64)
+                chunk = []
+        if chunk:
+            yield np.array(chunk, dtype=np.uint64)
+
+
+class DisjointSet:
+    """
+    Union-find over the integers [0, n) backed by numpy arrays, with union by rank and path compression.
+    Unions are applied a batch of edges at a time with vectorized operations rather than one edge at a time.
+    """
+    def __init__(self, n: int):
+        self.parent = np.arange(n, dtype=np.int64)
+        self.rank = np.zeros(n, dtype=np.int8)
+
+    def find(self, x: np.ndarray) -> np.ndarray:
+        """
+        Roots of the elements in x, every element on the way is pointed straight at its root
+        """
+        # the levels of the walk line up with x, union by rank keeps them to O(log n)
+        path = [x]
+        roots = self.parent[x]
+        while True:
+            up = self.parent[roots]
+            if np.array_equal(up, roots):
+                break
+            path.append(roots)
+            roots = up
+        for nodes in path:
+            self.parent[nodes] = roots
+        return roots
+
+    def union(self, a: np.ndarray, b: np.ndarray):
+        """
+        Merge the sets of a[i] and b[i] for every i
+        """
+        while len(a):
+            ra, rb = self.find(a), self.find(b)
+            pending = ra != rb
+            a, b, ra, rb = a[pending], b[pending], ra[pending], rb[pending]
+            if not len(a):
+                break
+            # attach the root with the lower (rank, id) below the other one, a strict total order so that
+            # the links written in one round can never form a cycle
+            swap = (self.rank[ra] > self.rank[rb]) | ((self.rank[ra] == self.rank[rb]) & (ra > rb))
+            child, root = np.where(swap, rb, ra), np.where(swap, ra, rb)
+            # several edges may link the same child in one round, only one write wins and the other edges
+            # are retried in the next round
+            self.parent[child] = root
+            np.maximum.at(self.rank, root, self.rank[child] + 1)
+
+    def roots(self) -> np.ndarray:
+        return self.find(np.arange(len(self.parent), dtype=np.int64))
+
+
+def cluster_duplicates(
+    csvfiles: List[str],
+    cluster_dir: str,
+    chunk_size: int = 10000000,
+    spill_dir: Optional[str] = None,
+) -> Tuple[int, int]:
+    """
+    Group the duplicate pairs written by the LSH or sort workflows into clusters of near-duplicate documents
+
+    Documents are identified by 64-bit hashes of their keys (which the indexes already require to be unique).
+    The pairs are streamed from the csv files in chunks and spilled to disk as integer ids, so memory use is bounded by
+    the number of distinct documents rather than the number of pairs. Each cluster's representative is the document that
+    appears first in the csv files, i.e. the one the index saw first, since dup_key always precedes key.
+
+    csvfiles - duplicate csv files with a (corpus, key, dup_key) layout
+    cluster_dir - output directory, see below
+    chunk_size - number of pairs handled at a time
+    spill_dir - directory for the intermediate files, defaults to the system temp dir
+
+    writes three numpy arrays to cluster_dir:
+    - nodes.npy: sorted uint64 key hashes of every document that has a duplicate or is one
+    - clusters.npy: int64 cluster id of every document in nodes.npy
+    - representatives.npy: uint64 key hash of each cluster's representative, indexed by cluster id
+
+    returns a tuple (number of documents, number of clusters)
+    """
+    os.makedirs(cluster_dir, exist_ok=True)
+    os.makedirs(spill_dir or tempfile.gettempdir(), exist_ok=True)
+    work_dir = tempfile.mkdtemp(prefix="clusters-", dir=spill_dir)
+    try:
+        # pass 1: spill the pairs as ids, and the distinct ids of each chunk with their first position in the input
+        edges_path = os.path.join(work_dir, "edges.bin")
+        seen_paths = []
+        n_edges = 0
+        with open(edges_path, "wb") as edges:
+            for chunk in tqdm(read_pair_chunks(csvfiles, chunk_size), desc="read pairs", disable=None):
+                chunk.tofile(edges)
+                ids, first = np.unique(chunk.ravel(), return_index=True)
+                seen = np.empty((len(ids), 2), dtype=np.uint64)
+                seen[:, 0], seen[:, 1] = ids, first.astype(np.uint64) + np.uint64(2 * n_edges)
+                seen_paths.append(os.path.join(work_dir, f"seen-{len(seen_paths)}.npy"))
+                np.save(seen_paths[-1], seen)
+                n_edges += len(chunk)
+
+        # pass 2: one sorted table of distinct documents and where each was first seen
+        if seen_paths:
+            seen = np.concatenate([np.load(path) for path in seen_paths])
+        else:
+            seen = np.empty((0, 2), dtype=np.uint64)
+        order = np.lexsort((seen[:, 1], seen[:, 0]))
+        seen = seen[order]
+        del order
+        distinct = np.empty(len(seen), dtype=bool)
+        distinct[:1] = True
+        np.not_equal(seen[1:, 0], seen[:-1, 0], out=distinct[1:])
+        nodes, first_seen = seen[distinct, 0], seen[distinct, 1]
+        del seen, distinct
+
+        # pass 3: union the spilled edges a chunk at a time
+        dsu = DisjointSet(len(nodes))
+        if n_edges:
+            edges = np.memmap(edges_path, dtype=np.uint64, mode="r", shape=(n_edges, 2))
+            for start in tqdm(range(0, n_edges, chunk_size), desc="union", disable=None):
+                chunk = np.searchsorted(nodes, edges[start:start + chunk_size])
+                dsu.union(chunk[:, 0], chunk[:, 1])
+            del edges
+
+        # pass 4: dense cluster ids, the earliest seen document of each cluster represents it
+        roots = dsu.roots()
+        del dsu
+        order = np.lexsort((first_seen, roots))
+        head = np.empty(len(order), dtype=bool)
+        head[:1] = True
+        np.not_equal(roots[order][1:], roots[order][:-1], out=head[1:])
+        clusters = np.empty(len(nodes), dtype=np.int64)
+        clusters[order] = np.cumsum(head) - 1
+        representatives = nodes[order[head]]
+
+        np.save(os.path.join(cluster_dir, NODES_NAME), nodes)
+        np.save(os.path.join(cluster_dir, CLUSTERS_NAME), clusters)
+        np.save(os.path.join(cluster_dir, REPRESENTATIVES_NAME), representatives)
+        logger.info(f"Grouped {len(nodes):,} documents into {len(representatives):,} clusters in {cluster_dir}")
+        return len(nodes), len(representatives)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+class Clusters:
+    """
+    Memory-mapped view of the output of cluster_duplicates, for filtering a corpus
+
+    Example usage:
+    ```
+    clusters = Clusters(cluster_dir)
+    keep = clusters.keep(keys) # False for every document that is in a cluster but does not represent it
+    ```
+    """
+    def __init__(self, cluster_dir: str):
+        self.nodes = np.load(os.path.join(cluster_dir, NODES_NAME), mmap_mode="r")
+        self.clusters = np.load(os.path.join(cluster_dir, CLUSTERS_NAME), mmap_mode="r")
+        self.representatives = np.load(os.path.join(cluster_dir, REPRESENTATIVES_NAME), mmap_mode="r")
+
+    def lookup(self, keys: List[str]) -> np.ndarray:
+        """
+        Cluster id of every key, -1 for documents that are not in any cluster
+        """
+        ids = np.array([key_hash(key) for key in keys], dtype=np.uint64)
+        if not len(self.nodes):
+            return np.full(len(ids), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.nodes, ids), len(self.nodes) - 1)
+        return np.where(self.nodes[pos] == ids, self.clusters[pos], -1)
+
+    def keep(self, keys: List[str]) -> np.ndarray:
+        """
+        Boolean mask of the keys to keep: documents without duplicates and cluster representatives
+        """
+        ids = np.array([key_hash(key) for key in keys], dtype=np.uint64)
+        cluster = self.lookup(keys)
+        in_cluster = cluster >= 0
+        keep = np.ones(len(keys), dtype=bool)
+        keep[in_cluster] = self.representatives[cluster[in_cluster]] == ids[in_cluster]
+        return keep
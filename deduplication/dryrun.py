@@ -0,0 +1,359 @@
+from deduplication.inputs import ColumnarReader, is_columnar, input_paths, read_texts
+from deduplication.planner import apply_plan, index_memory
+from deduplication.evaluate import wilson_interval
+from deduplication.memory import pool_size
+from multiprocessing import Pool
+from typing import List, Dict, Tuple, Optional, Union
+import numpy as np
+import tempfile
+import shutil
+import pickle
+import json
+import time
+import os
+
+# distributed worker counts (nodes running the same command with --work-dir) the wall time is estimated for
+WORKER_COUNTS = (1, 2, 4, 8, 16, 32, 64)
+
+# random offsets read to estimate the average document size of the jsonl inputs
+PILOT_SIZE = 200
+
+# draws of random offsets per jsonl file until its share of the sample is filled
+SAMPLE_ROUNDS = 4
+
+
+def sample_lines(path: str, offsets: List[int]) -> Dict[int, bytes]:
+    """
+    The line that starts after each offset of a jsonl file (the first line for offset 0), by its own start offset.
+    Its size does not bias the choice, only the size of the line before it does
+    """
+    lines = {}
+    with open(path, "rb") as fin:
+        for offset in sorted(offsets):
+            fin.seek(offset)
+            if offset > 0:
+                fin.readline()
+            start = fin.tell()
+            line = fin.readline()
+            if line.strip():
+                lines[start] = line
+    return lines
+
+
+def sample_rows(path: str, rows: List[int]) -> List[str]:
+    """
+    Texts of the given rows of a Parquet or Arrow file, reading only the row groups that hold them
+    """
+    reader = ColumnarReader(path).start()
+    starts = [first_row for _, _, first_row in reader.tasks()] + [reader.num_rows]
+    texts = []
+    for group, (first, end) in enumerate(zip(starts, starts[1:])):
+        wanted = [row - first for row in rows if first <= row < end]
+        if wanted:
+            group_texts, _ = read_texts(path, group, reader.text_column)
+            texts.extend(group_texts[i] for i in wanted)
+    return texts
+
+
+def estimate_documents(paths: List[str], rng: np.random.Generator) -> Tuple[List[float], int]:
+    """
+    Number of documents of every input file, exact for Parquet and Arrow files and estimated from the average size
+    of PILOT_SIZE randomly picked lines for jsonl files
+
+    returns a tuple (documents per file, total bytes)
+    """
+    sizes = [os.path.getsize(path) for path in paths]
+    jsonl = [i for i, path in enumerate(paths) if not is_columnar(path) and sizes[i] > 0]
+    line_bytes = 1.0
+    if jsonl:
+        total = sum(sizes[i] for i in jsonl)
+        picks = rng.choice(len(jsonl), size=PILOT_SIZE, p=[sizes[i] / total for i in jsonl])
+        lengths = []
+        for j, count in zip(*np.unique(picks, return_counts=True)):
+            path = paths[jsonl[j]]
+            lengths.extend(len(line) for line in sample_lines(path, rng.integers(0, sizes[jsonl[j]], size=count).tolist()).values())
+        line_bytes = float(np.mean(lengths)) if lengths else 1.0
+    counts = [float(ColumnarReader(path).start().num_rows) if is_columnar(path) else sizes[i] / line_bytes for i, path in enumerate(paths)]
+    return counts, sum(sizes)
+
+
+def write_sample(paths: List[str], counts: List[float], size: int, sample_dir: str, rng: np.random.Generator) -> int:
+    """
+    Write a random sample of about size documents of the input files to sample_dir as jsonl, one file per input file
+    with at least one sampled document, named so that they sort in input order
+
+    returns the number of documents written
+    """
+    total = sum(counts)
+    # largest remainder, so that the shares add up to size
+    shares = np.array(counts) * min(size, total) / max(total, 1)
+    taken = np.floor(shares).astype(int)
+    taken[np.argsort(taken - shares)[:int(round(shares.sum())) - taken.sum()]] += 1
+    written = 0
+    for i, (path, count) in enumerate(zip(paths, taken.tolist())):
+        if count <= 0:
+            continue
+        if is_columnar(path):
+            rows = rng.choice(int(counts[i]), size=min(count, int(counts[i])), replace=False).tolist()
+            lines = [(json.dumps({"text": text}) + "\n").encode("utf8") for text in sample_rows(path, rows)]
+        else:
+            # offsets landing in the same line pick it once, the rest is drawn again (a few times, in case the file is small)
+            picked = {}
+            for _ in range(SAMPLE_ROUNDS):
+                picked.update(sample_lines(path, rng.integers(0, os.path.getsize(path), size=count - len(picked)).tolist()))
+                if len(picked) >= count:
+                    break
+            lines = [line if line.endswith(b"\n") else line + b"\n" for line in list(picked.values())[:count]]
+        if not lines:
+            continue
+        with open(os.path.join(sample_dir, f"{i:06d}-{os.path.basename(path).rsplit('.', 1)[0]}.jsonl"), "wb") as fout:
+            fout.writelines(lines)
+        written += len(lines)
+    return written
+
+
+def sample_candidates(minhash_dir: str, b: int, r: int) -> set:
+    """
+    Keys of the sampled documents that share all r values of some band with an earlier sampled document, i.e. the
+    documents an exact LSH index of the same layout would report, in the order the index visits the signature files
+    """
+    seen = [set() for _ in range(b)]
+    candidates = set()
+    for fname in sorted(f for f in os.listdir(minhash_dir) if f.endswith(".pkl")):
+        with open(os.path.join(minhash_dir, fname), "rb") as fin:
+            minhash_list = pickle.load(fin)
+        for key, m in minhash_list:
+            bands = [m.hashvalues[i * r:(i + 1) * r].tobytes() for i in range(b)]
+            if any(band in seen[i] for i, band in enumerate(bands)):
+                candidates.add(key)
+            for i, band in enumerate(bands):
+                seen[i].add(band)
+    return candidates
+
+
+def time_index(mode: str, minhash_dir: str, save_dir: str, threshold: float, num_perm: int, n: int, fp: float,
+               plan: Optional[Dict], redis_port: int) -> Dict:
+    """
+    Deduplicate the sampled signatures with a scaled-down index of the run's mode and layout
+
+    n - number of sampled documents
+
+    returns a dict with the seconds taken, the near-duplicates found, the band layout and, for a Bloom index, the
+    documents its filters (or band hashes) flagged without an LSH candidate and the run's Bloom filter error rate,
+    for an LSH index in Redis the Redis memory it took
+    """
+    if mode == "bloom":
+        from deduplication.lshbloom import LSHBloom
+        os.makedirs(save_dir)
+        index = LSHBloom(minhash_dir, apply_plan({"threshold": threshold, "num_perm": num_perm, "n": max(n, 1), "fp": fp, "save_dir": save_dir}, plan))
+        start = time.perf_counter()
+        duplicates = index.deduplicate_corpus()
+        seconds = time.perf_counter() - start
+        # a near-duplicate is only found if its partner was sampled too, a false positive of the filters needs no
+        # partner, so the two are told apart and only the first are scaled up to the run
+        candidates = sample_candidates(minhash_dir, index.lsh.b, index.lsh.r)
+        found = sum(1 for row in duplicates if row[0] in candidates)
+        return {"seconds": seconds, "duplicates": found, "false_positives": len(duplicates) - found, "b": index.lsh.b,
+                "r": index.lsh.r, "fp": index.lsh_params["fp"], "storage": "bloom"}
+
+    from deduplication.lsh import LSHIndex
+    lsh_params = apply_plan({"threshold": threshold, "num_perm": num_perm}, plan)
+    client, used = None, None
+    try:
+        import redis
+        client = redis.Redis(host="localhost", port=redis_port)
+        used = client.info("memory")["used_memory"]
+        # a fresh basename so that the index of the run (or of an earlier dry run) is left alone
+        lsh_params["storage_config"] = {
+            "type": "redis",
+            "basename": f"dryrun-{os.getpid()}-{time.time_ns()}".encode(),
+            "redis": {"host": "localhost", "port": redis_port},
+        }
+    except Exception:
+        # the index is then timed in memory, without the Redis round trips
+        client = None
+    index = LSHIndex(minhash_dir, lsh_params)
+    try:
+        start = time.perf_counter()
+        duplicates = index.deduplicate_corpus()
+        result = {"seconds": time.perf_counter() - start, "duplicates": len(duplicates), "b": index.lsh.b, "r": index.lsh.r,
+                  "storage": "redis" if client is not None else "memory"}
+        if client is not None:
+            result["redis_bytes"] = max(client.info("memory")["used_memory"] - used, 0)
+    finally:
+        if client is not None:
+            for key in client.scan_iter(match=lsh_params["storage_config"]["basename"] + b"*"):
+                client.delete(key)
+    return result
+
+
+def dry_run(
+    corpus_names: List[str],
+    inputs: List[str],
+    mode: str,
+    sim_threshold: Union[float, List[float]],
+    num_perm: int = 128,
+    n: Optional[int] = None,
+    fp: float = 0.001,
+    plan: Optional[Dict] = None,
+    redis_port: int = 6379,
+    sample_size: int = 10000,
+    stream: bool = False,
+    spill_dir: Optional[str] = None,
+    confidence: float = 0.95,
+    seed: int = 0,
+) -> Dict:
+    """
+    Estimate what a run would take from a random sample of its documents, without touching its outputs
+
+    The sample is hashed with MinHasher and deduplicated with a scaled-down index of the same mode and band layout,
+    and the measurements are extrapolated to the estimated number of documents of the inputs:
+    - the number of documents (exact for Parquet and Arrow files, from the average sampled line size for jsonl files)
+    - documents per second of the minhash stage (on this node's pool) and of the index
+    - the fraction of duplicates: a duplicate is only seen in the sample if the document it duplicates is also sampled,
+    which happens for a fraction q = sample / documents of them, so the sample's duplicate rate is divided by q
+    (documents the sample's Bloom filters flag without an LSH candidate are left out, the run's filters are instead
+    taken to flag at most their full error rate, 1 - (1 - fp)^b, of the remaining documents)
+    - the size of the signatures, of the Bloom filters for n (or the estimated documents) at fp, or of the Redis index
+    - the wall time of the run for every count of distributed workers sharing the minhash stage
+
+    corpus_names, inputs - the corpora of the run, inputs are directories of input files or single input files
+    mode - "bloom" or "lsh"
+    n - number of documents the Bloom filters are sized for, by default the estimated number of documents
+    plan - plan of the run (with --auto-tune), otherwise the default band layout is used
+    stream - whether the run overlaps the minhash and index stages
+    spill_dir - directory for the sample, its signatures and the scaled-down index, by default the system temp dir
+
+    returns the estimates as a dict, see format_dry_run
+    """
+    from deduplication.minhash import MinHasher
+    thresholds = [sim_threshold] if isinstance(sim_threshold, float) else list(sim_threshold)
+    rng = np.random.default_rng(seed)
+    paths, corpora = [], []
+    for name, input_path in zip(corpus_names, inputs):
+        files = [input_path] if os.path.isfile(input_path) else input_paths(input_path)
+        paths.extend(files)
+        corpora.append({"name": name, "files": len(files)})
+    counts, total_bytes = estimate_documents(paths, rng)
+    i = 0
+    for corpus in corpora:
+        corpus["documents"] = int(round(sum(counts[i:i + corpus["files"]])))
+        i += corpus["files"]
+    documents = int(round(sum(counts)))
+
+    work_dir = tempfile.mkdtemp(prefix="dedup-dry-run-", dir=spill_dir)
+    try:
+        sample_dir = os.path.join(work_dir, "sample")
+        minhash_dir = os.path.join(work_dir, "minhash")
+        os.makedirs(sample_dir)
+        sample = write_sample(paths, counts, sample_size, sample_dir, rng)
+
+        # workers are started before the clock, a run pays for that once
+        workers = pool_size(32)
+        with Pool(workers) as p:
+            start = time.perf_counter()
+            MinHasher(sample_dir, minhash_dir, num_perm).process(p)
+            minhash_seconds = time.perf_counter() - start
+        signature_bytes = sum(os.path.getsize(os.path.join(minhash_dir, f)) for f in os.listdir(minhash_dir) if f.endswith(".pkl"))
+
+        indexes = []
+        for j, threshold in enumerate(thresholds):
+            index = time_index(mode, minhash_dir, os.path.join(work_dir, f"index-{j}"), threshold, num_perm, sample, fp, plan, redis_port)
+            index["threshold"] = threshold
+            indexes.append(index)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    scale = documents / max(sample, 1)
+    q = min(sample / max(documents, 1), 1.0)
+    minhash_rate = sample / max(minhash_seconds, 1e-9)
+    index_seconds = sum(index["seconds"] for index in indexes)
+    index_rate = sample / max(index_seconds, 1e-9)
+    for index in indexes:
+        low, high = wilson_interval(index["duplicates"], sample, confidence)
+        # full filters flag a new document if any of its b bands hits a false positive
+        flagged = 1 - (1 - index["fp"]) ** index["b"] if mode == "bloom" else 0.0
+        index["false_positive_fraction"] = flagged
+        near = min(index["duplicates"] / max(sample, 1) / q, 1.0)
+        low, high = min(low / q, 1.0), min(high / q, 1.0)
+        index["duplicate_fraction"] = near + (1 - near) * flagged
+        index["duplicate_fraction_ci"] = [low + (1 - low) * flagged, high + (1 - high) * flagged]
+        if mode == "bloom":
+            index["index_bytes"] = index_memory("bloom", n or documents, index["b"], index["r"], index["fp"])
+        elif "redis_bytes" in index:
+            index["index_bytes"] = int(index["redis_bytes"] * scale)
+        else:
+            # no Redis to measure, the planner's model of the Redis footprint
+            index["index_bytes"] = index_memory("lsh", documents, index["b"], index["r"])
+
+    wall = []
+    for count in WORKER_COUNTS:
+        minhash_total = documents / minhash_rate / count
+        index_total = documents / index_rate
+        wall.append({
+            "workers": count,
+            "minhash_seconds": minhash_total,
+            "index_seconds": index_total,
+            # a streaming run overlaps the two stages, distributed runs index once every file is hashed
+            "seconds": max(minhash_total, index_total) if stream and count == 1 else minhash_total + index_total,
+        })
+    return {
+        "mode": mode,
+        "corpora": corpora,
+        "files": len(paths),
+        "input_bytes": total_bytes,
+        "documents": documents,
+        "sample": sample,
+        "minhash_workers": workers,
+        "minhash_docs_per_sec": minhash_rate,
+        "index_docs_per_sec": index_rate,
+        "signature_bytes": int(signature_bytes * scale),
+        "n": n or documents,
+        "confidence": confidence,
+        "indexes": indexes,
+        "wall_time": wall,
+    }
+
+
+def format_duration(seconds: float) -> str:
+    minutes = int(round(seconds / 60))
+    if minutes < 1:
+        return f"{seconds:.0f}s"
+    return f"{minutes // 60}h {minutes % 60:02d}m" if minutes >= 60 else f"{minutes}m"
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:,.1f} {unit}"
+        size /= 1024
+    return f"{size:,.1f} TiB"
+
+
+def format_dry_run(estimate: Dict) -> str:
+    level = f"{estimate['confidence']:.0%}"
+    lines = [
+        f"Dry run on a sample of {estimate['sample']:,} of about {estimate['documents']:,} documents in {estimate['files']:,} files ({format_size(estimate['input_bytes'])}):",
+    ]
+    for corpus in estimate["corpora"]:
+        lines.append(f"  {corpus['name']}: about {corpus['documents']:,} documents in {corpus['files']:,} files")
+    lines += [
+        f"  minhash: {estimate['minhash_docs_per_sec']:,.0f} docs/sec on {estimate['minhash_workers']} processes, about {format_size(estimate['signature_bytes'])} of signatures",
+        f"  index: {estimate['index_docs_per_sec']:,.0f} docs/sec",
+    ]
+    for index in estimate["indexes"]:
+        lines.append(
+            f"  threshold {index['threshold']}: bands (b) = {index['b']}, rows per band (r) = {index['r']}, "
+            f"duplicates = {index['duplicate_fraction']:.2%} ({level} CI {index['duplicate_fraction_ci'][0]:.2%} - {index['duplicate_fraction_ci'][1]:.2%}) "
+            f"from {index['duplicates']:,} in the sample"
+        )
+        if estimate["mode"] == "bloom":
+            lines.append(f"    Bloom filters for {estimate['n']:,} documents at fp {index['fp']}: {index['b']} x {format_size(index['index_bytes'] / index['b'])} = {format_size(index['index_bytes'])}, "
+                         f"flagging up to {index['false_positive_fraction']:.2%} of new documents (included above, {index['false_positives']:,} flagged without an LSH candidate in the sample)")
+        else:
+            source = "measured on the sample" if index["storage"] == "redis" else "modelled, Redis was not reachable so the index was timed in memory"
+            lines.append(f"    Redis memory: {format_size(index['index_bytes'])} ({source})")
+    lines.append("  estimated wall time:")
+    for row in estimate["wall_time"]:
+        lines.append(f"    {row['workers']:>3} worker{'s' if row['workers'] > 1 else ' '}: {format_duration(row['seconds'])} (minhash {format_duration(row['minhash_seconds'])}, index {format_duration(row['index_seconds'])})")
+    return "\n".join(lines)
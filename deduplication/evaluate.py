@@ -0,0 +1,450 @@
+from deduplication.inputs import column_strings, read_column, is_columnar, input_stem, get_text_column
+from deduplication.writers import is_binary, read_duplicate_blocks, read_duplicate_rows
+from deduplication.exact import EXACT_SUFFIX, read_exact_file
+from deduplication.readahead import load_minhash_file
+from deduplication.output import HEADERS, read_offsets
+from deduplication.signatures import jaccard
+from deduplication.memory import pool_size
+from multiprocessing import Pool
+from statistics import NormalDist
+from typing import List, Dict, Tuple, Iterator, Optional
+import numpy as np
+import logging
+import random
+import json
+import math
+import os
+
+logger = logging.getLogger(__name__)
+
+# the sampled documents are compared in full only with the documents that share one of their bands of 2 rows,
+# a pair of similarity 0.3 shares one of 64 such bands with probability 0.998
+PREFILTER_ROWS = 2
+
+# upper bound on the comparison matrix of one chunk of documents against the sampled ones
+CHUNK_BYTES = 32 << 20
+
+# kept documents drawn per sampled kept document wanted, before those that turn out to be reported are dropped
+KEPT_OVERSAMPLE = 4
+
+
+def wilson_interval(successes: int, n: int, confidence: float = 0.95) -> Tuple[float, float]:
+    """
+    Wilson score interval of a binomial proportion, which stays within [0, 1] and holds up for proportions
+    close to 0 or 1 and for small samples, unlike the normal approximation
+    """
+    if n == 0:
+        return 0.0, 1.0
+    z = NormalDist().inv_cdf(1 - (1 - confidence) / 2)
+    p = successes / n
+    denominator = 1 + z * z / n
+    centre = (p + z * z / (2 * n)) / denominator
+    half = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+    return max(0.0, centre - half), min(1.0, centre + half)
+
+
+def candidate_probability(similarity, b: int, r: int):
+    """
+    Probability that a pair of the given Jaccard similarity shares at least one of b bands of r rows
+    """
+    return 1 - (1 - np.asarray(similarity, dtype=np.float64) ** r) ** b
+
+
+def estimate_recall(reported: int, kept: int, precision: float, miss_rate: float) -> float:
+    """
+    Share of the true duplicates that were reported: reported * precision of them were found, kept * miss_rate missed
+    """
+    found = reported * precision
+    missed = kept * miss_rate
+    return found / (found + missed) if found + missed > 0 else 1.0
+
+
+def run_layout(threshold: float, num_perm: int, plan: Optional[Dict] = None) -> Tuple[int, int]:
+    """
+    Band layout (b, r) an index used at threshold: the stored plan's, or the default one
+    """
+    if plan is not None and plan["threshold"] == threshold:
+        return plan["b"], plan["r"]
+    # without limits the planner picks the same layout as datasketch
+    from deduplication.planner import plan_index
+    plan = plan_index("lsh", threshold, num_perm, 1)
+    return plan["b"], plan["r"]
+
+
+def duplicate_records(path: str) -> Iterator[Tuple[str, Optional[float], str, Optional[str]]]:
+    """
+    Reported documents of a duplicate file in either format, as (corpus, threshold, key, partner) tuples: key is the
+    removed document, partner the earlier document it matched if the file records it (LSH and Sort mode) and threshold
+    the threshold of the row in a multi-threshold file
+    """
+    header = None
+    if is_binary(path):
+        header = next(read_duplicate_blocks(path), ({}, None))[0].get("header")
+    for row in read_duplicate_rows(path):
+        if len(row) < 2:
+            continue
+        if row[0] in HEADERS or row[0] == "similarity":
+            header = row
+            continue
+        names = header or (["dup_key"] if len(row) == 2 else ["key", "dup_key"])
+        # some workflows name the corpus column in the header, the others only the columns after it
+        values = dict(zip(names if names[0] == "corpus" else ["corpus"] + list(names), row))
+        threshold = float(values["threshold"]) if values.get("threshold") else None
+        if "key" in values:
+            yield row[0], threshold, values["key"], values.get("dup_key")
+        else:
+            yield row[0], threshold, values["dup_key"], None
+
+
+class Reservoir:
+    """
+    Uniform random sample of a fixed size from a stream of unknown length (Algorithm R)
+    """
+    def __init__(self, size: int, rng: random.Random):
+        self.size = size
+        self.rng = rng
+        self.items = []
+        self.seen = 0
+
+    def add(self, item):
+        self.seen += 1
+        if len(self.items) < self.size:
+            self.items.append(item)
+            return
+        i = self.rng.randrange(self.seen)
+        if i < self.size:
+            self.items[i] = item
+
+
+def key_line(key: str) -> int:
+    return int(key.rsplit("-", 1)[1])
+
+
+def band_hashes(signatures: np.ndarray) -> np.ndarray:
+    """
+    Hash of every band of 2 rows of each signature, hashvalues fit in 32 bits so a band packs into one uint64
+    """
+    signatures = signatures.astype(np.uint64)
+    k = signatures.shape[1] // PREFILTER_ROWS * PREFILTER_ROWS
+    return (signatures[:, 0:k:2] << np.uint64(32)) | signatures[:, 1:k:2]
+
+
+def _sample_file(task: Tuple[str, int, int, set]) -> Tuple[int, List[Tuple[str, np.ndarray]], Dict[str, np.ndarray]]:
+    """
+    Number of documents of a signature file, a random sample of size documents in random order and the signatures
+    of the wanted keys
+    """
+    minhash_file, size, seed, wanted = task
+    minhash_list = load_minhash_file(minhash_file)
+    rng = np.random.default_rng(seed)
+    picked = rng.choice(len(minhash_list), size=min(size, len(minhash_list)), replace=False)
+    sample = [(minhash_list[i][0], minhash_list[i][1].hashvalues) for i in picked.tolist()]
+    found = {key: m.hashvalues for key, m in minhash_list if key in wanted}
+    return len(minhash_list), sample, found
+
+
+# signatures of the sampled documents, their position in index order and their band hashes, set in every search worker
+_queries = None
+
+
+def _init_search(signatures: np.ndarray, ordinals: np.ndarray, lines: np.ndarray):
+    global _queries
+    _queries = (signatures.astype(np.uint64), ordinals, lines, band_hashes(signatures))
+
+
+def _search_file(task: Tuple[str, int, int, int]) -> Dict[int, List[Tuple[int, int, str]]]:
+    """
+    Documents of one signature file most similar to each sampled document that comes after them in index order
+
+    returns a dict mapping sampled documents to at most top (matching hashvalues, corpus, key) tuples
+    """
+    minhash_file, ordinal, corpus, top = task
+    signatures, ordinals, lines, bands = _queries
+    active = np.flatnonzero(ordinals >= ordinal)
+    if not len(active):
+        return {}
+    minhash_list = load_minhash_file(minhash_file)
+    if not minhash_list:
+        return {}
+    keys = [key for key, _ in minhash_list]
+    doc_lines = np.array([key_line(key) for key in keys], dtype=np.int64)
+    docs = np.stack([m.hashvalues for _, m in minhash_list]).astype(np.uint64)
+    doc_bands = band_hashes(docs)
+    hit = np.zeros(len(docs), dtype=bool)
+    for i in range(doc_bands.shape[1]):
+        hit |= np.isin(doc_bands[:, i], bands[active, i])
+    picked = np.flatnonzero(hit)
+
+    query_signatures = signatures[active]
+    same_file = ordinals[active] == ordinal
+    chunk = max(1, CHUNK_BYTES // (len(active) * docs.shape[1]))
+    results = {}
+    for start in range(0, len(picked), chunk):
+        rows = picked[start:start + chunk]
+        matches = (query_signatures[:, None, :] == docs[rows][None, :, :]).sum(axis=2)
+        # only the documents before a sampled one can be what it duplicates
+        matches[same_file[:, None] & (doc_lines[rows][None, :] >= lines[active][:, None])] = -1
+        for qi, q in enumerate(active.tolist()):
+            for j in np.argsort(-matches[qi])[:top].tolist():
+                if matches[qi, j] > 0:
+                    results.setdefault(q, []).append((int(matches[qi, j]), corpus, keys[rows[j]]))
+    return {q: sorted(found, reverse=True)[:top] for q, found in results.items()}
+
+
+def _read_tokens(task: Tuple[str, str, List[int]]) -> Tuple[str, Dict[int, frozenset]]:
+    """
+    Token sets of some documents of an input file by line (row) number, tokenized as the minhash stage does
+    """
+    infile, minhash_file, lines = task
+    tokens = {}
+    if not os.path.exists(infile):
+        return infile, tokens
+    if is_columnar(infile):
+        texts = column_strings(read_column(infile, get_text_column()))
+        for line in lines:
+            tokens[line] = frozenset(texts[line - 1].split())
+        return infile, tokens
+    offsets = read_offsets(minhash_file, infile)
+    fd = os.open(infile, os.O_RDONLY)
+    try:
+        for line in lines:
+            data = os.pread(fd, int(offsets[line] - offsets[line - 1]), int(offsets[line - 1]))
+            tokens[line] = frozenset(json.loads(data).get("text", "").split())
+    finally:
+        os.close(fd)
+    return infile, tokens
+
+
+def evaluate(
+    corpus_names: List[str],
+    inputs: List[str],
+    minhash_dirs: List[str],
+    output_files: List[str],
+    threshold: float = 0.8,
+    num_perm: int = 128,
+    plan: Optional[Dict] = None,
+    layouts: Optional[List[Tuple[int, int]]] = None,
+    samples: int = 500,
+    top: int = 3,
+    confidence: float = 0.95,
+    num_workers: int = 1,
+    seed: int = 0,
+) -> List[Dict]:
+    """
+    Estimate the precision and recall of a finished run from samples, per corpus and threshold, against the true Jaccard
+    similarity of the token sets of the original texts
+
+    A sample of the reported documents and one of the kept documents are drawn, and for each sampled document the top
+    documents before it in index order (corpora in the given order, signature files sorted) with the most similar
+    signatures are found by a parallel scan of the signature files, one file per worker at a time. A reported document
+    is a true duplicate if one of those, or the partner recorded in the output, is at least threshold similar to it;
+    a kept document is a missed duplicate if one of those is. Recall follows from the two rates and the numbers of
+    reported and kept documents. For each band layout (the run's first, then layouts) the expected precision and recall
+    are derived from the most similar document found for each sampled one, which leaves out Bloom filter errors.
+
+    corpus_names, inputs, minhash_dirs - the corpora of the run, as given to it
+    output_files - duplicate files of the run, csv or binary, with or without a threshold column
+    threshold - threshold of the run, for files without a threshold column
+    plan - plan the index was built with, if any, otherwise the default layout is assumed
+    samples - number of reported and of kept documents sampled per corpus and threshold
+    top - number of most similar documents checked against the texts for each sampled document
+    confidence - confidence level of the intervals
+
+    returns one dict per corpus and threshold
+    """
+    rng = random.Random(seed)
+    corpus_ids = {name: i for i, name in enumerate(corpus_names)}
+    minhash_files = [sorted(os.path.join(d, f) for f in os.listdir(d) if f.endswith(".pkl")) for d in minhash_dirs]
+    ordinals, file_corpus = {}, {}
+    for corpus, files in enumerate(minhash_files):
+        for f in files:
+            ordinals[f] = len(ordinals)
+            file_corpus[f] = corpus
+
+    def minhash_file_of(corpus: int, key: str) -> str:
+        return os.path.join(minhash_dirs[corpus], input_stem(key.rsplit("-", 1)[0]) + ".pkl")
+
+    def resolve(corpus: int, key: str) -> Tuple[int, str]:
+        # a partner may be in an earlier corpus (exact repeats are found run-wide), keys do not name their corpus
+        if minhash_file_of(corpus, key) not in ordinals:
+            corpus = next((c for c in range(len(minhash_dirs)) if minhash_file_of(c, key) in ordinals), corpus)
+        return corpus, key
+
+    # reported documents, counted and sampled per corpus and threshold in one pass over the output
+    reported = {}
+    for path in output_files:
+        for corpus_name, t, key, partner in duplicate_records(path):
+            if corpus_name not in corpus_ids:
+                continue
+            group = (corpus_ids[corpus_name], threshold if t is None else t)
+            reported.setdefault(group, Reservoir(samples, rng)).add((key, partner))
+    thresholds = sorted({t for _, t in reported}) or [threshold]
+    groups = [(corpus, t) for corpus in range(len(corpus_names)) for t in thresholds]
+    for group in groups:
+        reported.setdefault(group, Reservoir(samples, rng))
+
+    # exact repeats have no signature, the first copy they were matched with is their partner
+    wanted = {}
+    partners = {}
+    exact_counts = [0] * len(corpus_names)
+    for corpus, t in groups:
+        for key, partner in reported[(corpus, t)].items:
+            wanted.setdefault(minhash_file_of(corpus, key), set()).add(key)
+            if partner is not None:
+                partners[(corpus, key)] = resolve(corpus, partner)
+    for corpus, d in enumerate(minhash_dirs):
+        for f in sorted(os.listdir(d)):
+            if f.endswith(EXACT_SUFFIX):
+                for key, first in read_exact_file(os.path.join(d, f)):
+                    exact_counts[corpus] += 1
+                    partners.setdefault((corpus, key), resolve(corpus, first))
+
+    # document counts, a sample of every signature file and the signatures of the sampled reported documents
+    counts, file_samples, signatures = {}, {}, {}
+    with Pool(pool_size(max(num_workers, 1))) as p:
+        tasks = [(f, samples * KEPT_OVERSAMPLE, seed + ordinals[f], wanted.get(f, set())) for f in ordinals]
+        for (f, _, _, _), (n, sample, found) in zip(tasks, p.imap(_sample_file, tasks)):
+            counts[f] = n
+            file_samples[f] = sample
+            for key, hashvalues in found.items():
+                signatures[(file_corpus[f], key)] = hashvalues
+
+    # kept candidates: a uniform sample of all documents of each corpus, drawn from the per-file samples
+    np_rng = np.random.default_rng(seed)
+    totals = [sum(counts[f] for f in files) + exact_counts[corpus] for corpus, files in enumerate(minhash_files)]
+    candidates = {}
+    for corpus, files in enumerate(minhash_files):
+        if not files:
+            continue
+        most = max(reported[(corpus, t)].seen for t in thresholds)
+        size = min(sum(counts[f] for f in files), samples * KEPT_OVERSAMPLE,
+                   math.ceil(samples * totals[corpus] / max(totals[corpus] - most, 1)))
+        drawn = np_rng.multivariate_hypergeometric([counts[f] for f in files], size)
+        for f, n in zip(files, drawn.tolist()):
+            for key, hashvalues in file_samples[f][:n]:
+                candidates[(corpus, key)] = set(thresholds)
+                signatures[(corpus, key)] = hashvalues
+    del file_samples
+
+    # a second pass over the output drops the candidates that were reported
+    for path in output_files:
+        for corpus_name, t, key, _ in duplicate_records(path):
+            if corpus_name in corpus_ids and (corpus_ids[corpus_name], key) in candidates:
+                candidates[(corpus_ids[corpus_name], key)].discard(threshold if t is None else t)
+
+    # most similar earlier documents of every sampled document, one signature file per task
+    queries = sorted(signatures)
+    matches = {query: [] for query in queries}
+    if queries:
+        query_signatures = np.stack([signatures[query] for query in queries])
+        query_ordinals = np.array([ordinals[minhash_file_of(corpus, key)] for corpus, key in queries], dtype=np.int64)
+        query_lines = np.array([key_line(key) for _, key in queries], dtype=np.int64)
+        with Pool(pool_size(max(num_workers, 1)), initializer=_init_search, initargs=(query_signatures, query_ordinals, query_lines)) as p:
+            tasks = [(f, ordinals[f], file_corpus[f], top) for f in ordinals]
+            for found in p.imap_unordered(_search_file, tasks):
+                for q, best in found.items():
+                    matches[queries[q]].extend(best)
+        for query in queries:
+            matches[query] = sorted(matches[query], reverse=True)[:top]
+
+    # texts of the sampled documents and of their matches and partners, read by input file
+    needed = {}
+    for query in queries:
+        needed.setdefault(query[0], set()).add(query[1])
+        for _, corpus, key in matches[query]:
+            needed.setdefault(corpus, set()).add(key)
+    for corpus, t in groups:
+        for key, _ in reported[(corpus, t)].items:
+            needed.setdefault(corpus, set()).add(key)
+            if (corpus, key) in partners:
+                partner_corpus, partner = partners[(corpus, key)]
+                needed.setdefault(partner_corpus, set()).add(partner)
+    by_file = {}
+    for corpus, keys in needed.items():
+        for key in keys:
+            fname = key.rsplit("-", 1)[0]
+            infile = inputs[corpus] if os.path.isfile(inputs[corpus]) else os.path.join(inputs[corpus], fname)
+            by_file.setdefault((corpus, infile, minhash_file_of(corpus, key)), []).append(key)
+    tokens = {}
+    with Pool(pool_size(max(num_workers, 1))) as p:
+        tasks = [(infile, minhash_file, sorted({key_line(key) for key in keys})) for (_, infile, minhash_file), keys in by_file.items()]
+        for ((corpus, infile, _), keys), (_, found) in zip(by_file.items(), p.imap(_read_tokens, tasks)):
+            if not found:
+                logger.warning(f"Could not read the documents of {infile}, they are left out of the evaluation")
+            for key in keys:
+                if key_line(key) in found:
+                    tokens[(corpus, key)] = found[key_line(key)]
+
+    def best_similarity(corpus: int, key: str) -> Optional[float]:
+        # a document with neither a signature to search with nor a partner can not be judged
+        if (corpus, key) not in tokens or ((corpus, key) not in signatures and (corpus, key) not in partners):
+            return None
+        others = [(c, k) for _, c, k in matches.get((corpus, key), [])]
+        if (corpus, key) in partners:
+            others.append(partners[(corpus, key)])
+        return max([jaccard(tokens[(corpus, key)], tokens[other]) for other in others if other in tokens], default=0.0)
+
+    report = []
+    for corpus, t in groups:
+        layout = [run_layout(t, num_perm, plan)] + list(layouts or [])
+        sampled = reported[(corpus, t)]
+        reported_sims = [s for s in (best_similarity(corpus, key) for key, _ in sampled.items) if s is not None]
+        kept_sims = [s for s in (best_similarity(c, key) for (c, key), kept in candidates.items() if c == corpus and t in kept) if s is not None]
+        n_reported = sampled.seen
+        n_kept = totals[corpus] - n_reported
+        correct = sum(s >= t for s in reported_sims)
+        missed = sum(s >= t for s in kept_sims)
+        precision = correct / len(reported_sims) if reported_sims else 1.0
+        miss_rate = missed / len(kept_sims) if kept_sims else 0.0
+        precision_ci = wilson_interval(correct, len(reported_sims), confidence)
+        miss_rate_ci = wilson_interval(missed, len(kept_sims), confidence)
+
+        # every sampled document stands for its share of the reported or kept documents
+        sims = np.array(reported_sims + kept_sims, dtype=np.float64)
+        weights = np.array([n_reported / max(len(reported_sims), 1)] * len(reported_sims) + [n_kept / max(len(kept_sims), 1)] * len(kept_sims))
+        duplicate = sims >= t
+        expected = []
+        for b, r in layout:
+            found = weights * candidate_probability(sims, b, r)
+            true_found = found[duplicate].sum()
+            expected.append({
+                "b": b,
+                "r": r,
+                "precision": float(true_found / found.sum()) if found.sum() > 0 else 1.0,
+                "recall": float(true_found / weights[duplicate].sum()) if duplicate.any() else 1.0,
+            })
+        report.append({
+            "corpus": corpus_names[corpus],
+            "threshold": t,
+            "documents": totals[corpus],
+            "reported": n_reported,
+            "kept": n_kept,
+            "reported_sample": len(reported_sims),
+            "kept_sample": len(kept_sims),
+            "precision": precision,
+            "precision_ci": list(precision_ci),
+            "miss_rate": miss_rate,
+            "miss_rate_ci": list(miss_rate_ci),
+            "recall": estimate_recall(n_reported, n_kept, precision, miss_rate),
+            # recall grows with precision and shrinks with the miss rate
+            "recall_ci": [estimate_recall(n_reported, n_kept, precision_ci[0], miss_rate_ci[1]),
+                          estimate_recall(n_reported, n_kept, precision_ci[1], miss_rate_ci[0])],
+            "confidence": confidence,
+            "layouts": expected,
+        })
+    return report
+
+
+def format_report(report: List[Dict]) -> str:
+    lines = []
+    for group in report:
+        level = f"{group['confidence']:.0%}"
+        lines += [
+            f"Corpus {group['corpus']} at threshold {group['threshold']}: {group['documents']:,} documents, {group['reported']:,} reported, {group['kept']:,} kept",
+            f"  precision = {group['precision']:.4f} ({level} CI {group['precision_ci'][0]:.4f} - {group['precision_ci'][1]:.4f}) from {group['reported_sample']:,} sampled reported documents",
+            f"  miss rate = {group['miss_rate']:.4f} ({level} CI {group['miss_rate_ci'][0]:.4f} - {group['miss_rate_ci'][1]:.4f}) from {group['kept_sample']:,} sampled kept documents",
+            f"  recall = {group['recall']:.4f} ({level} CI {group['recall_ci'][0]:.4f} - {group['recall_ci'][1]:.4f})",
+        ]
+        for i, layout in enumerate(group["layouts"]):
+            lines.append(f"  bands (b) = {layout['b']}, rows per band (r) = {layout['r']}{' (run)' if i == 0 else ''}: expected precision = {layout['precision']:.4f}, recall = {layout['recall']:.4f}")
+    return "\n".join(lines)
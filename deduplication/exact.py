@@ -0,0 +1,243 @@
+from typing import List, Tuple, Optional, Dict
+import numpy as np
+import tempfile
+import hashlib
+import pickle
+import shutil
+import os
+
+EXACT_SUFFIX = ".exact"
+
+# grow the table once it is this full, linear probing slows down quickly beyond
+MAX_LOAD = 0.7
+
+
+def normalize_text(text: str) -> str:
+    """
+    Text with all runs of whitespace collapsed to a single space, so whitespace-only differences still match
+    """
+    return " ".join(text.split())
+
+
+def text_hash(text: str) -> int:
+    """
+    Nonzero 64-bit hash of the normalized text, stable across runs and processes
+    """
+    h = int.from_bytes(hashlib.blake2b(normalize_text(text).encode("utf8"), digest_size=8).digest(), "little")
+    # 0 marks an empty slot in the table
+    return h or 1
+
+
+def exact_file_path(minhash_file: str) -> str:
+    """
+    Path of the exact repeats recorded for a signature file
+    """
+    return os.path.splitext(minhash_file)[0] + EXACT_SUFFIX
+
+
+def write_exact_duplicates(minhash_file: str, repeats: List[Tuple[str, str]]):
+    """
+    Record the exact repeats of a signature file, (key, first_key) tuples of documents that have no signature
+    """
+    path = exact_file_path(minhash_file)
+    if not repeats:
+        # a stale record of an earlier run would report documents that now have signatures
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(f"{path}.tmp{os.getpid()}", "wb") as fout:
+        pickle.dump(repeats, fout)
+    os.replace(f"{path}.tmp{os.getpid()}", path)
+
+
+def read_exact_file(minhash_file: str) -> List[Tuple[str, str]]:
+    """
+    Exact repeats recorded for a signature file, if any
+    """
+    path = exact_file_path(minhash_file)
+    if not os.path.exists(path):
+        return []
+    with open(path, "rb") as fin:
+        return pickle.load(fin)
+
+
+def read_exact_duplicates(minhash_dir: str) -> List[Tuple[str, str]]:
+    """
+    Exact repeats recorded for all signature files in minhash_dir, in file order
+    """
+    if not os.path.isdir(minhash_dir):
+        return []
+    repeats = []
+    for f in sorted(os.listdir(minhash_dir)):
+        if f.endswith(EXACT_SUFFIX):
+            repeats.extend(read_exact_file(os.path.join(minhash_dir, f)))
+    return repeats
+
+
+# per-process read-only view of the table, reopened whenever the table has grown into a new file
+_table_path = None
+_table = None
+
+
+def seen(table_path: str, h: int) -> bool:
+    """
+    Whether h is in the table at table_path, for pool workers. The table only ever gains entries,
+    so a stale view may miss recent entries but never reports an entry that is not there.
+    """
+    global _table_path, _table
+    if table_path != _table_path:
+        _table = np.memmap(table_path, dtype=np.uint64, mode="r")
+        _table_path = table_path
+    mask = len(_table) - 1
+    pos = h & mask
+    while True:
+        slot = int(_table[pos])
+        if slot == h:
+            return True
+        if slot == 0:
+            return False
+        pos = (pos + 1) & mask
+
+
+class ExactFilter:
+    """
+    Run-wide set of the content hashes of all documents seen so far, used to skip minhashing documents that are
+    exact (or whitespace-only) repeats of an earlier document.
+
+    The hashes are kept in an open-addressing table with linear probing, in a file that the minhash workers map
+    read-only, so a worker can skip computing the signature of a repeat. Only the parent process inserts, in
+    document order, so which copy counts as the first one does not depend on worker scheduling.
+    Each slot takes 8 bytes in the shared file and 8 bytes for the reference to the first copy in the parent.
+
+    Example usage:
+    ```
+    with ExactFilter(work_dir) as exact:
+        m = MinHasher(indir, minhashdir, exact=exact)
+        m.process() # repeats get no signature and are listed in m.exact_duplicates
+    ```
+    """
+    def __init__(self, work_dir: Optional[str] = None, capacity: int = 1 << 20):
+        """
+        work_dir: directory for the table file, defaults to the system temp dir
+        capacity: number of documents to size the table for initially, it grows as needed
+        """
+        if work_dir is not None:
+            os.makedirs(work_dir, exist_ok=True)
+        self.work_dir = tempfile.mkdtemp(prefix="exact-", dir=work_dir)
+        self.generation = 0
+        self.count = 0
+        # table files of earlier generations, still named by tasks queued before the table grew
+        self.retired: List[str] = []
+        self.fnames: List[str] = []
+        self.file_ids: Dict[str, int] = {}
+        size = 1 << max(int(np.ceil(np.log2(capacity / MAX_LOAD))), 10)
+        self.hashes, self.refs = self._allocate(size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.hashes = self.refs = None
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    @property
+    def table_path(self) -> str:
+        return os.path.join(self.work_dir, f"table-{self.generation}.bin")
+
+    def _allocate(self, size: int) -> Tuple[np.memmap, np.ndarray]:
+        hashes = np.memmap(self.table_path, dtype=np.uint64, mode="w+", shape=(size,))
+        return hashes, np.zeros(size, dtype=np.int64)
+
+    def file_id(self, fname: str) -> int:
+        if fname not in self.file_ids:
+            self.file_ids[fname] = len(self.fnames)
+            self.fnames.append(fname)
+        return self.file_ids[fname]
+
+    def key(self, ref: int) -> str:
+        """
+        Document key of a reference, as built by compute_minhash_jsonl
+        """
+        return f"{self.fnames[ref >> 32]}-{ref & 0xFFFFFFFF}"
+
+    def _lookup(self, h: np.ndarray) -> np.ndarray:
+        # slot of every hash, -1 if absent, all probe sequences are advanced one step at a time together
+        mask = np.uint64(len(self.hashes) - 1)
+        pos = h & mask
+        slots = np.full(len(h), -1, dtype=np.int64)
+        pending = np.arange(len(h))
+        while len(pending):
+            slot = self.hashes[pos[pending]]
+            hit = slot == h[pending]
+            slots[pending[hit]] = pos[pending[hit]]
+            pending = pending[~hit & (slot != 0)]
+            pos[pending] = (pos[pending] + np.uint64(1)) & mask
+        return slots
+
+    def _insert(self, h: np.ndarray, refs: np.ndarray):
+        # h must be distinct and absent, of several hashes probing the same empty slot one wins per round
+        mask = np.uint64(len(self.hashes) - 1)
+        pos = h & mask
+        pending = np.arange(len(h))
+        while len(pending):
+            empty = pending[self.hashes[pos[pending]] == 0]
+            _, first = np.unique(pos[empty], return_index=True)
+            won = empty[first]
+            self.hashes[pos[won]] = h[won]
+            self.refs[pos[won]] = refs[won]
+            pending = np.setdiff1d(pending, won, assume_unique=True)
+            pos[pending] = (pos[pending] + np.uint64(1)) & mask
+        self.count += len(h)
+
+    def _grow(self, needed: int):
+        size = len(self.hashes)
+        while needed > size * MAX_LOAD:
+            size *= 2
+        occupied = np.flatnonzero(self.hashes)
+        old_hashes, old_refs = np.array(self.hashes[occupied]), self.refs[occupied]
+        old_path = self.table_path
+        self.generation += 1
+        self.hashes, self.refs = self._allocate(size)
+        self.count = 0
+        self._insert(old_hashes, old_refs)
+        # workers mapping the old file, or yet to map it for a task queued before now, keep a valid (if incomplete)
+        # view of it, so it stays until the file being hashed is done (see drop_retired)
+        self.retired.append(old_path)
+
+    def drop_retired(self):
+        """
+        Remove the table files of earlier generations, once no queued task names them any more
+        """
+        for path in self.retired:
+            if os.path.exists(path):
+                os.remove(path)
+        self.retired = []
+
+    def resolve(self, hashes: np.ndarray, refs: np.ndarray) -> np.ndarray:
+        """
+        Check a batch of documents against all documents seen so far and add the new ones, in order
+
+        hashes - text_hash of every document
+        refs - reference of every document, (file_id << 32) | line number
+
+        returns for every document the reference of its first copy, or -1 if it is the first copy
+        """
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        refs = np.asarray(refs, dtype=np.int64)
+        uniq, first, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+        slots = self._lookup(uniq)
+        new = slots < 0
+        # the copy from an earlier batch if there is one, otherwise the first copy within this batch
+        first_ref = np.where(new, refs[first], self.refs[np.maximum(slots, 0)])
+
+        if self.count + np.count_nonzero(new) > len(self.hashes) * MAX_LOAD:
+            self._grow(self.count + np.count_nonzero(new))
+        self._insert(uniq[new], refs[first[new]])
+
+        out = first_ref[inverse]
+        is_first = new[inverse] & (np.arange(len(hashes)) == first[inverse])
+        out[is_first] = -1
+        return out
@@ -0,0 +1,245 @@
+from tqdm.autonotebook import tqdm
+from multiprocessing import Pool
+from deduplication.signatures import signature_matrix, gather, estimate_jaccard
+from deduplication.memory import pool_size
+from typing import List, Tuple, Dict, Optional
+import numpy as np
+import pickle
+import json
+import os
+
+FOREST_META = "forest.json"
+
+
+class ForestIndex:
+    """
+    Persistent MinHash LSH Forest for top-k near-duplicate search, stored as memory-mapped numpy arrays in save_dir
+    so that any number of processes can open and query it without copying it.
+
+    Like datasketch's MinHashLSHForest, each of the l trees covers a range of k = num_perm / l hashvalues and keeps
+    the documents sorted by them, and a query collects the documents sharing the longest prefix of each range with
+    it. Here every tree is a (k, n) array in column-major order, so a query needs one binary search on the first
+    column of each tree, and the prefix lengths of the few rows that match are then compared in one vectorized step.
+    Candidates are scored from the stored signatures rather than rebuilt MinHash objects.
+
+    Documents are numbered in the order they are added. Each call to add() appends a segment with its own trees,
+    so earlier segments are never rewritten.
+
+    save_dir layout:
+    - forest.json: num_perm, l and the list of segments and signature files they hold
+    - segment-<j>/tree-<t>.npy: hashvalues of tree t sorted lexicographically, shape (k, n)
+    - segment-<j>/tree-<t>.ids.npy: doc id of each column of tree t
+    - segment-<j>/signatures.npy and keys.txt: signatures and keys of the segment's documents in id order
+
+    Example usage:
+    ```
+    forest = ForestIndex(save_dir, num_perm=128, l=8)
+    forest.add(minhash_files)
+    pairs = forest.query_minhash_list(minhash_list, top_k=5, threshold=0.8)
+    ```
+    """
+    def __init__(self, save_dir: str, num_perm: int = 128, l: int = 8):
+        """
+        save_dir: directory of the forest, an existing forest is opened (its num_perm and l take precedence)
+        num_perm: number of hash functions in the signatures
+        l: number of trees
+        """
+        self.save_dir = save_dir
+        meta_path = os.path.join(save_dir, FOREST_META)
+        if os.path.exists(meta_path):
+            with open(meta_path) as fin:
+                self.meta = json.load(fin)
+        else:
+            if l <= 0 or l > num_perm:
+                raise ValueError(f"l must be in [1, num_perm], got l={l}, num_perm={num_perm}")
+            self.meta = {"num_perm": num_perm, "l": l, "segments": []}
+        self.num_perm = self.meta["num_perm"]
+        self.l = self.meta["l"]
+        self.k = self.num_perm // self.l
+        self._open_segments()
+
+    def _open_segments(self):
+        self.trees, self.signatures, self.keys = [], [], []
+        for segment in self.meta["segments"]:
+            seg_dir = os.path.join(self.save_dir, segment["name"])
+            self.trees.append([
+                (np.load(os.path.join(seg_dir, f"tree-{t}.npy"), mmap_mode="r"),
+                 np.load(os.path.join(seg_dir, f"tree-{t}.ids.npy"), mmap_mode="r"))
+                for t in range(self.l)
+            ])
+            self.signatures.append(np.load(os.path.join(seg_dir, "signatures.npy"), mmap_mode="r"))
+            self.keys.append(None)
+        self.starts = np.array([segment["start"] for segment in self.meta["segments"]], dtype=np.int64)
+
+    def __len__(self) -> int:
+        if not self.meta["segments"]:
+            return 0
+        last = self.meta["segments"][-1]
+        return last["start"] + last["count"]
+
+    def file_starts(self) -> Dict[str, int]:
+        """
+        First doc id of every signature file added to the forest, by absolute path
+        """
+        return {f: start for segment in self.meta["segments"] for f, start in segment["files"]}
+
+    def add(self, minhash_files: List[str]):
+        """
+        Add the documents of the given signature files as one new segment, in the order given
+        """
+        start = len(self)
+        name = f"segment-{len(self.meta['segments'])}"
+        seg_dir = os.path.join(self.save_dir, name)
+
+        sigs, keys, files = [], [], []
+        for minhashfile in tqdm(minhash_files, desc="load", disable=None):
+            with open(minhashfile, "rb") as fin:
+                minhash_list = pickle.load(fin)
+            files.append((os.path.abspath(minhashfile), start + len(keys)))
+            keys.extend(key for key, _ in minhash_list)
+            if minhash_list:
+                sigs.append(signature_matrix(minhash_list))
+        if not keys:
+            return
+        sigs = np.concatenate(sigs)
+        if sigs.shape[1] < self.k * self.l:
+            raise ValueError(f"Signatures have {sigs.shape[1]} hashvalues, the forest needs {self.k * self.l}")
+
+        os.makedirs(seg_dir, exist_ok=True)
+        np.save(os.path.join(seg_dir, "signatures.npy"), sigs)
+        with open(os.path.join(seg_dir, "keys.txt"), "w") as fout:
+            fout.write("\n".join(keys))
+        for t in tqdm(range(self.l), desc="index", disable=None):
+            block = sigs[:, t * self.k:(t + 1) * self.k]
+            # lexsort takes the primary key last
+            order = np.lexsort(block.T[::-1])
+            np.save(os.path.join(seg_dir, f"tree-{t}.npy"), np.ascontiguousarray(block[order].T))
+            np.save(os.path.join(seg_dir, f"tree-{t}.ids.npy"), (order + start).astype(np.int64))
+
+        self.meta["segments"].append({"name": name, "start": start, "count": len(keys), "files": files})
+        tmp = os.path.join(self.save_dir, f"{FOREST_META}.tmp{os.getpid()}")
+        with open(tmp, "w") as fout:
+            json.dump(self.meta, fout)
+        os.replace(tmp, os.path.join(self.save_dir, FOREST_META))
+        self._open_segments()
+
+    def key(self, doc: int) -> str:
+        seg = int(np.searchsorted(self.starts, doc, side="right")) - 1
+        if self.keys[seg] is None:
+            with open(os.path.join(self.save_dir, self.meta["segments"][seg]["name"], "keys.txt")) as fin:
+                self.keys[seg] = fin.read().split("\n")
+        return self.keys[seg][doc - self.starts[seg]]
+
+    def _signatures(self, docs: np.ndarray) -> np.ndarray:
+        segs = np.searchsorted(self.starts, docs, side="right") - 1
+        return gather(self.signatures, segs, docs - self.starts[segs])
+
+    def _candidates(self, queries: np.ndarray, top_k: int, before: Optional[np.ndarray] = None) -> List[np.ndarray]:
+        """
+        Approximate top-k doc ids for every row of queries, the documents sharing the longest prefixes in any tree
+
+        before - optional doc ids of the queries, only documents with a smaller id are then candidates
+        """
+        found = [[] for _ in range(len(queries))]
+        for trees in self.trees:
+            for t, (tree, ids) in enumerate(trees):
+                q = queries[:, t * self.k:(t + 1) * self.k].astype(tree.dtype, copy=False)
+                # one batched binary search per tree on the first column, only rows sharing it have a prefix at all
+                lo = np.searchsorted(tree[0], q[:, 0], side="left")
+                hi = np.searchsorted(tree[0], q[:, 0], side="right")
+                for i in np.flatnonzero(hi > lo):
+                    block = tree[:, lo[i]:hi[i]]
+                    prefix = np.cumprod(block == q[i][:, None], axis=0).sum(axis=0)
+                    found[i].append((ids[lo[i]:hi[i]], prefix))
+
+        candidates = []
+        for i, per_query in enumerate(found):
+            if not per_query:
+                candidates.append(np.empty(0, dtype=np.int64))
+                continue
+            docs = np.concatenate([d for d, _ in per_query])
+            prefix = np.concatenate([p for _, p in per_query])
+            if before is not None:
+                # before the cut to top_k, so that the query itself and later documents take no slots
+                earlier = docs < before[i]
+                docs, prefix = docs[earlier], prefix[earlier]
+            # longest prefix first, each doc once
+            order = np.lexsort((docs, -prefix))
+            docs = docs[order]
+            _, first = np.unique(docs, return_index=True)
+            candidates.append(docs[np.sort(first)][:top_k])
+        return candidates
+
+    def query(self, queries: np.ndarray, top_k: int, threshold: float, ids: Optional[np.ndarray] = None) -> List[Tuple[int, int, float]]:
+        """
+        Batched top-k query with candidate verification
+
+        queries - signatures of shape (n, num_perm)
+        top_k - number of candidates per query
+        threshold - minimum estimated Jaccard similarity of a reported pair
+        ids - optional doc ids of the queries if they are in the forest themselves, only candidates with a smaller id
+        are then reported (keep-first), which also excludes the query itself
+
+        returns a list of (query row, candidate doc id, similarity) tuples
+        """
+        candidates = self._candidates(queries, top_k, ids)
+        rows = np.repeat(np.arange(len(queries)), [len(c) for c in candidates])
+        docs = np.concatenate(candidates) if candidates else np.empty(0, dtype=np.int64)
+        # all pairs of the batch are scored at once
+        sims = estimate_jaccard(queries[rows].astype(np.uint64), self._signatures(docs))
+        passed = sims >= threshold
+        return list(zip(rows[passed].tolist(), docs[passed].tolist(), sims[passed].tolist()))
+
+    def query_minhash_list(self, minhash_list: List[Tuple], top_k: int, threshold: float, first_id: Optional[int] = None,
+                           batch_size: int = 4096) -> List[Tuple[str, str, str]]:
+        """
+        Query a list of (key, minhash) tuples against the forest
+
+        first_id - doc id of the first document if the list has been added to the forest, see query
+
+        returns a list of tuples (key, dup_key, similarity)
+        """
+        duplicates = []
+        for start in range(0, len(minhash_list), batch_size):
+            batch = minhash_list[start:start + batch_size]
+            queries = np.stack([m.hashvalues for _, m in batch])
+            ids = None if first_id is None else np.arange(first_id + start, first_id + start + len(batch))
+            for row, doc, sim in self.query(queries, top_k, threshold, ids):
+                duplicates.append((batch[row][0], self.key(doc), f"{sim:.4f}"))
+        return duplicates
+
+
+# per-process forest, every worker maps the arrays itself rather than inheriting them through fork
+_forest = None
+
+
+def _init_forest(save_dir: str):
+    global _forest
+    _forest = ForestIndex(save_dir)
+
+
+def _query_minhash_file(params: Tuple) -> List[Tuple[str, str, str]]:
+    minhashfile, top_k, threshold, first_id = params
+    with open(minhashfile, "rb") as fin:
+        minhash_list = pickle.load(fin)
+    return _forest.query_minhash_list(minhash_list, top_k, threshold, first_id)
+
+
+def query_forest(save_dir: str, minhash_files: List[str], top_k: int, threshold: float, num_workers: int = 1,
+                 keep_first: bool = False, out: Optional[List] = None) -> List[Tuple[str, str, str]]:
+    """
+    Query signature files against the forest in save_dir on num_workers processes
+
+    keep_first - the files have been added to the forest, only report each document against earlier documents
+    out - optional list-like sink (e.g. a DuplicateWriter) that each file's duplicates are appended to as they arrive,
+    it is returned in place of a new list
+
+    returns a list of tuples (key, dup_key, similarity) in file order
+    """
+    file_starts = ForestIndex(save_dir).file_starts() if keep_first else {}
+    params = [(f, top_k, threshold, file_starts.get(os.path.abspath(f))) for f in minhash_files]
+    duplicates = [] if out is None else out
+    with Pool(pool_size(num_workers), initializer=_init_forest, initargs=(save_dir,)) as p:
+        for dups in tqdm(p.imap(_query_minhash_file, params), total=len(params), desc="query", disable=None):
+            duplicates.extend(dups)
+    return duplicates
@@ -0,0 +1,70 @@
+from datasketch import MinHashLSH
+from multiprocessing import Pool
+from deduplication.memory import pool_size
+from collections import deque
+from typing import Iterable, Iterator, List, Optional, Tuple
+import pickle
+
+
+def local_deduplicate(params: Tuple) -> Tuple[str, List[Tuple], List[Tuple[str]]]:
+    """
+    Deduplicates one shard (minhash file) against itself with a small in-memory LSH index
+    that uses the same band layout as the global index.
+
+    params - tuple (minhashfile, minhash_list, num_perm, b, r, pairs) where minhash_list may be None
+    to have the worker load minhashfile itself, and pairs selects the duplicate format
+
+    returns a tuple (minhashfile, survivors, duplicates) where survivors are the (key, minhash) tuples
+    without a duplicate earlier in the shard, in shard order, and duplicates are (key, dup_key) tuples if pairs
+    is set or (key,) tuples otherwise
+    """
+    minhashfile, minhash_list, num_perm, b, r, pairs = params
+    if minhash_list is None:
+        with open(minhashfile, "rb") as fin:
+            minhash_list = pickle.load(fin)
+
+    lsh = MinHashLSH(num_perm=num_perm, params=(b, r))
+    survivors, duplicates = [], []
+    for key, m in minhash_list:
+        result = lsh.query(m)
+        if result:
+            duplicates.extend([(key, dup_key) for dup_key in result] if pairs else [(key,)])
+        else:
+            lsh.insert(key, m)
+            survivors.append((key, m))
+
+    return minhashfile, survivors, duplicates
+
+
+def local_pass(
+    blocks: Iterable[Tuple[str, Optional[List[Tuple]]]],
+    num_perm: int,
+    params: Tuple[int, int],
+    num_workers: int,
+    pairs: bool,
+    depth: Optional[int] = None,
+) -> Iterator[Tuple[str, List[Tuple], List[Tuple[str]]]]:
+    """
+    Runs local_deduplicate over a sequence of shards on a process pool and yields the results in shard order,
+    so the global index can consume shard i while the workers deduplicate the following ones.
+
+    blocks - iterable of tuples (minhashfile, minhash_list), minhash_list may be None to load the file in the worker
+    num_perm - number of hash functions in the signatures
+    params - (b, r) band layout of the global index
+    num_workers - number of worker processes
+    pairs - whether duplicates are reported as (key, dup_key) tuples (LSHIndex) or (key,) tuples (LSHBloom)
+    depth - maximum number of shards in flight, defaults to twice the number of workers
+
+    yields tuples (minhashfile, survivors, duplicates), see local_deduplicate
+    """
+    b, r = params
+    depth = depth or 2 * num_workers
+    with Pool(pool_size(num_workers)) as p:
+        # bounded window of in-flight shards, Pool.imap would queue up every shard's results if the global index falls behind
+        in_flight = deque()
+        for minhashfile, minhash_list in blocks:
+            in_flight.append(p.apply_async(local_deduplicate, ((minhashfile, minhash_list, num_perm, b, r, pairs),)))
+            if len(in_flight) >= depth:
+                yield in_flight.popleft().get()
+        while in_flight:
+            yield in_flight.popleft().get()
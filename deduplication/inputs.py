@@ -0,0 +1,408 @@
+from deduplication.metrics import NullMetrics, get_metrics
+from deduplication.memory import get_budget
+from typing import List, Tuple, Union, Iterator, Optional
+from collections import deque
+from glob import glob
+from time import perf_counter
+import numpy as np
+import threading
+import queue
+import os
+
+# size of every read from an input file, rounded up to a multiple of the filesystem's preferred block size
+# (the stripe size on Lustre), large sequential reads get far more bandwidth out of parallel filesystems
+BLOCK_SIZE = 8 << 20
+
+# blocks read ahead of the consumer for every open input file
+BLOCKS_AHEAD = 2
+
+# input files reading at the same time, the one being hashed and the next ones
+OPEN_FILES = 4
+
+# columnar inputs, read with pyarrow (only needed for these) one row group at a time
+COLUMNAR_SUFFIXES = (".parquet", ".arrow")
+
+# column holding the text of every document of a columnar input
+TEXT_COLUMN = "text"
+
+
+def is_columnar(path: str) -> bool:
+    return path.endswith(COLUMNAR_SUFFIXES)
+
+
+def input_paths(input_dir: str) -> List[str]:
+    """
+    jsonl, Parquet and Arrow files of a corpus directory, sorted so that every run visits them in the same order
+    """
+    return sorted(path for suffix in (".jsonl",) + COLUMNAR_SUFFIXES for path in glob(f"{input_dir}/*{suffix}"))
+
+
+def input_stem(fname: str) -> str:
+    """
+    Name of the signature file of an input file, without extension. jsonl names lose their last 6 characters
+    as they always have, so that existing signature directories stay valid
+    """
+    for suffix in COLUMNAR_SUFFIXES:
+        if fname.endswith(suffix):
+            return fname[:-len(suffix)]
+    return fname[:-6]
+
+
+def aligned_block_size(path: str, block_size: int) -> int:
+    """
+    block_size rounded up to a multiple of the preferred I/O size of the filesystem holding path
+    """
+    try:
+        preferred = os.stat(path).st_blksize
+    except (OSError, AttributeError):
+        return block_size
+    if preferred <= 0:
+        return block_size
+    return -(-block_size // preferred) * preferred
+
+
+class BlockReader:
+    """
+    Reads one file in large aligned blocks on a background thread, up to depth blocks ahead of the consumer,
+    and splits the blocks into lines in bulk. Every read starts at a multiple of the block size, so with a block size
+    that is a multiple of the stripe size each read touches whole stripes.
+
+    The time spent in reads and the bytes read are recorded (input_read_seconds per block, input_read_bytes),
+    and describe() reports the throughput achieved for the file.
+
+    Example usage:
+    ```
+    with BlockReader(infile).start() as reader:
+        for line in reader.lines(): # same lines as iterating the file opened in binary mode
+            ...
+    ```
+    """
+    def __init__(self, path: str, block_size: Optional[int] = None, depth: int = BLOCKS_AHEAD, metrics: Optional[NullMetrics] = None):
+        """
+        path: file to read
+        block_size: size of every read before alignment, by default the process' block size (see set_block_reads)
+        depth: number of blocks read ahead of the consumer
+        metrics: optional metrics to record the reads in, by default the process' metrics
+        """
+        self.path = path
+        self.block_size = aligned_block_size(path, block_size or get_block_reads()[0])
+        self.depth = depth
+        self.metrics = metrics or get_metrics()
+        self.bytes_read = 0
+        self.read_seconds = 0.0
+        self.blocks_queue = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self) -> "BlockReader":
+        if self.thread is None:
+            # daemon so that an abandoned reader does not keep the interpreter alive
+            self.thread = threading.Thread(target=self._read, name=f"block-reader-{os.path.basename(self.path)}", daemon=True)
+            self.thread.start()
+        return self
+
+    def _put(self, item) -> bool:
+        while not self.stopped.is_set():
+            try:
+                self.blocks_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read(self):
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+            try:
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                offset = 0
+                while not self.stopped.is_set():
+                    start = perf_counter()
+                    block = os.pread(fd, self.block_size, offset)
+                    elapsed = perf_counter() - start
+                    if not block:
+                        break
+                    self.read_seconds += elapsed
+                    self.bytes_read += len(block)
+                    self.metrics.observe("input_read_seconds", elapsed, start)
+                    offset += len(block)
+                    if not self._put(block):
+                        return
+            finally:
+                os.close(fd)
+            self.metrics.inc("input_read_bytes", self.bytes_read)
+            self._put(None)
+        except BaseException as e:
+            self._put(e)
+
+    def blocks(self) -> Iterator[bytes]:
+        """
+        The blocks of the file in order
+        """
+        self.start()
+        while True:
+            block = self.blocks_queue.get()
+            if block is None:
+                return
+            if isinstance(block, BaseException):
+                raise block
+            yield block
+
+    def lines(self) -> Iterator[bytes]:
+        """
+        The lines of the file in order, each with its trailing newline (except a last line without one)
+        """
+        rest = b""
+        for block in self.blocks():
+            lines = block.split(b"\n")
+            if rest:
+                lines[0] = rest + lines[0]
+            rest = lines.pop()
+            for line in lines:
+                yield line + b"\n"
+        if rest:
+            yield rest
+
+    def describe(self) -> str:
+        mb = self.bytes_read / (1 << 20)
+        return f"{mb:,.1f} MB read at {mb / self.read_seconds if self.read_seconds > 0 else 0:,.1f} MB/s"
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+        import pyarrow.ipc
+    except ImportError:
+        raise ImportError("Parquet and Arrow inputs need pyarrow, install it with pip install pyarrow") from None
+    return pyarrow
+
+
+def column_strings(array) -> List[str]:
+    """
+    Values of a string column (an Array or ChunkedArray), null values as empty strings. Each value is decoded straight
+    from a slice of the column's data buffer, through views of its offsets and data buffers, without building
+    intermediate Python objects for the column
+    """
+    pa = _pyarrow()
+    texts = []
+    for chunk in (array.chunks if isinstance(array, pa.ChunkedArray) else [array]):
+        if len(chunk) == 0:
+            continue
+        if pa.types.is_string(chunk.type):
+            width = np.int32
+        else:
+            if not pa.types.is_large_string(chunk.type):
+                chunk = chunk.cast(pa.large_string())
+            width = np.int64
+        _, offsets, data = chunk.buffers()[:3]
+        offsets = np.frombuffer(offsets, dtype=width)[chunk.offset:chunk.offset + len(chunk) + 1].tolist()
+        data = memoryview(data) if data is not None else memoryview(b"")
+        valid = chunk.is_valid().to_numpy(zero_copy_only=False).tolist() if chunk.null_count else None
+        for i in range(len(chunk)):
+            if valid is not None and not valid[i]:
+                texts.append("")
+            else:
+                texts.append(str(data[offsets[i]:offsets[i + 1]], "utf8"))
+    return texts
+
+
+def read_column(path: str, column: str, group: Optional[int] = None):
+    """
+    One column of a Parquet or Arrow file, of a single row group (record batch of an Arrow file) if group is given.
+    Arrow files are memory-mapped, so the column is not copied until it is decoded
+    """
+    pa = _pyarrow()
+    if path.endswith(".parquet"):
+        parquet = pa.parquet.ParquetFile(path)
+        if group is None:
+            return parquet.read(columns=[column]).column(0)
+        return parquet.read_row_group(group, columns=[column]).column(0)
+    reader = pa.ipc.open_file(pa.memory_map(path))
+    if group is None:
+        return reader.read_all().column(column)
+    return reader.get_batch(group).column(column)
+
+
+def read_texts(path: str, group: int, column: str) -> Tuple[List[str], int]:
+    """
+    Texts of one row group of a Parquet file (record batch of an Arrow file), reading no other column
+
+    returns a tuple (texts, size of the column read)
+    """
+    array = read_column(path, column, group)
+    return column_strings(array), array.nbytes
+
+
+class ColumnarReader:
+    """
+    Plans the reads of one Parquet or Arrow file for the minhash workers: each row group (record batch of an Arrow
+    file) is one task, and the worker that gets it reads only the text column of that row group. Only the file's
+    metadata is read here. The workers report their reads back through record(), which keeps the same
+    statistics as BlockReader, so both kinds of input can be read by an InputReader.
+
+    Example usage:
+    ```
+    with ColumnarReader(infile).start() as reader:
+        for (path, group, first_row), (texts, seconds, size) in zip(reader.tasks(), pool.imap(work, reader.tasks())):
+            reader.record(seconds, size)
+    ```
+    """
+    def __init__(self, path: str, text_column: Optional[str] = None, metrics: Optional[NullMetrics] = None):
+        """
+        path: file to read
+        text_column: column holding the text, by default the process' text column (see set_text_column)
+        metrics: optional metrics to record the reads in, by default the process' metrics
+        """
+        self.path = path
+        self.text_column = text_column or get_text_column()
+        self.metrics = metrics or get_metrics()
+        self.bytes_read = 0
+        self.read_seconds = 0.0
+        self.num_rows = 0
+        self.groups = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self) -> "ColumnarReader":
+        if self.groups is None:
+            pa = _pyarrow()
+            if self.path.endswith(".parquet"):
+                metadata = pa.parquet.read_metadata(self.path)
+                sizes = [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)]
+            else:
+                reader = pa.ipc.open_file(pa.memory_map(self.path))
+                sizes = [reader.get_batch(i).num_rows for i in range(reader.num_record_batches)]
+            self.groups = []
+            for group, size in enumerate(sizes):
+                self.groups.append((self.path, group, self.num_rows))
+                self.num_rows += size
+        return self
+
+    def tasks(self) -> List[Tuple[str, int, int]]:
+        """
+        One (path, row group, index of its first row) tuple per row group, in file order
+        """
+        self.start()
+        return self.groups
+
+    def record(self, seconds: float, size: int):
+        """
+        Record the read of one row group, done by a worker
+        """
+        self.read_seconds += seconds
+        self.bytes_read += size
+        self.metrics.observe("input_read_seconds", seconds)
+        self.metrics.inc("input_read_bytes", size)
+
+    def describe(self) -> str:
+        mb = self.bytes_read / (1 << 20)
+        return f"{mb:,.1f} MB of column data read at {mb / self.read_seconds if self.read_seconds > 0 else 0:,.1f} MB/s per worker"
+
+    def close(self):
+        pass
+
+
+def open_input(path: str, block_size: Optional[int] = None) -> Union[BlockReader, ColumnarReader]:
+    """
+    Started reader of one input file, a ColumnarReader for Parquet and Arrow files and a BlockReader otherwise
+    """
+    if is_columnar(path):
+        return ColumnarReader(path).start()
+    return BlockReader(path, block_size).start()
+
+
+class InputReader:
+    """
+    Reads a sequence of input files in order, starting to read the next files while the current one is being
+    consumed, so that opening a file (a metadata server round trip on parallel filesystems) and its first reads
+    overlap with the work on the previous one. At most open_files files are reading at a time, and no file is
+    started ahead under memory pressure. Parquet and Arrow files get a ColumnarReader, which only reads their
+    metadata ahead.
+
+    Example usage:
+    ```
+    for reader in InputReader(input_files):
+        for line in reader.lines():
+            ...
+    ```
+    """
+    def __init__(self, paths: List[str], open_files: Optional[int] = None, block_size: Optional[int] = None):
+        """
+        paths: files to read, in order
+        open_files: number of files reading at a time, by default the process' setting (see set_block_reads)
+        block_size: size of every read, by default the process' block size
+        """
+        self.paths = list(paths)
+        self.open_files = max(1, open_files or get_block_reads()[1])
+        self.block_size = block_size
+
+    def __iter__(self) -> Iterator[Union[BlockReader, ColumnarReader]]:
+        budget = get_budget()
+        readers = deque()
+        i = 0
+
+        def fill():
+            nonlocal i
+            while i < len(self.paths) and len(readers) < self.open_files:
+                if readers and budget is not None and budget.under_pressure():
+                    break
+                readers.append(open_input(self.paths[i], self.block_size))
+                i += 1
+
+        try:
+            fill()
+            while readers:
+                reader = readers.popleft()
+                fill()
+                try:
+                    yield reader
+                finally:
+                    reader.close()
+        finally:
+            for reader in readers:
+                reader.close()
+
+
+# size of every input read and number of input files reading at a time, set once by the entry point
+_block_size = BLOCK_SIZE
+_open_files = OPEN_FILES
+
+
+def get_block_reads():
+    return _block_size, _open_files
+
+
+def set_block_reads(block_size: int, open_files: int):
+    global _block_size, _open_files
+    _block_size = block_size
+    _open_files = open_files
+
+
+# column of columnar inputs holding the text of every document, set once by the entry point
+_text_column = TEXT_COLUMN
+
+
+def get_text_column() -> str:
+    return _text_column
+
+
+def set_text_column(text_column: str):
+    global _text_column
+    _text_column = text_column
@@ -0,0 +1,238 @@
+from typing import Dict, List, Optional, Iterator
+import threading
+import socket
+import json
+import time
+import os
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def _write_json_atomic(path: str, obj) -> None:
+    tmp = f"{path}.tmp.{default_worker_id()}"
+    with open(tmp, "w") as fout:
+        json.dump(obj, fout)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(tmp, path)
+
+
+class LeaseQueue:
+    """
+    Distributes a fixed list of work items over any number of workers that share a filesystem,
+    without a central service or pre-partitioning.
+
+    work_dir layout:
+    - plan.json: the work items, written once by whichever worker gets there first
+    - leases/<id>.lease: held by the worker currently processing item <id>, kept alive by a heartbeat thread
+    - done/<id>.json: completion ledger entry for item <id>
+
+    A lease whose heartbeat is older than ttl seconds belongs to a dead worker and is taken over by the next
+    worker looking for work. Items are handed out largest first, so workers that join late or run on slower nodes
+    pick up the small items at the end and the stage finishes evenly.
+
+    Example usage:
+    ```
+    queue = LeaseQueue("/shared/run/minhash")
+    queue.plan([{"path": f, "size": os.path.getsize(f)} for f in files])
+    with queue:
+        for item in queue: # returns once every item is done, by this worker or another
+            process(item["path"])
+            queue.complete(item)
+    ```
+    """
+    def __init__(self, work_dir: str, worker_id: Optional[str] = None, ttl: float = 600, poll: float = 10):
+        """
+        work_dir: shared directory for this stage's plan, leases and ledger
+        worker_id: unique name of this worker, defaults to hostname-pid
+        ttl: seconds without a heartbeat after which a lease is considered abandoned
+        poll: seconds to wait between checks while other workers hold the remaining items
+        """
+        self.work_dir = work_dir
+        self.worker_id = worker_id or default_worker_id()
+        self.ttl = ttl
+        self.poll = poll
+        self.lease_dir = os.path.join(work_dir, "leases")
+        self.done_dir = os.path.join(work_dir, "done")
+        os.makedirs(self.lease_dir, exist_ok=True)
+        os.makedirs(self.done_dir, exist_ok=True)
+
+        self.items: List[Dict] = []
+        self.held = set()
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+        self.heartbeat = None
+
+    def __enter__(self):
+        self.heartbeat = threading.Thread(target=self._heartbeat, daemon=True)
+        self.heartbeat.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.heartbeat.join()
+        # hand back anything we did not finish, e.g. on an exception
+        for item_id in list(self.held):
+            self._drop(item_id)
+
+    def _lease_path(self, item_id: str) -> str:
+        return os.path.join(self.lease_dir, f"{item_id}.lease")
+
+    def _done_path(self, item_id: str) -> str:
+        return os.path.join(self.done_dir, f"{item_id}.json")
+
+    def _fs_now(self) -> float:
+        """
+        Current time according to the shared filesystem, so that lease expiry does not depend on node clocks agreeing
+        """
+        probe = os.path.join(self.lease_dir, f".clock.{self.worker_id}")
+        with open(probe, "w"):
+            pass
+        return os.stat(probe).st_mtime
+
+    def plan(self, items: List[Dict]) -> List[Dict]:
+        """
+        Register the work items of this stage, each a json serializable dict with a "size" entry.
+        Only the first worker's plan is used, every other worker adopts it, so all workers agree on item ids.
+
+        returns the adopted plan, largest items first, with an "id" added to every item
+        """
+        plan_path = os.path.join(self.work_dir, "plan.json")
+        if not os.path.exists(plan_path):
+            items = sorted(items, key=lambda item: item["size"], reverse=True)
+            items = [dict(item, id=f"{i:08d}") for i, item in enumerate(items)]
+            tmp = f"{plan_path}.tmp.{self.worker_id}"
+            with open(tmp, "w") as fout:
+                json.dump(items, fout)
+                fout.flush()
+                os.fsync(fout.fileno())
+            try:
+                # link fails if another worker published its plan first
+                os.link(tmp, plan_path)
+            except FileExistsError:
+                pass
+            os.remove(tmp)
+        with open(plan_path) as fin:
+            self.items = json.load(fin)
+        return self.items
+
+    def is_done(self, item_id: str) -> bool:
+        return os.path.exists(self._done_path(item_id))
+
+    def ledger(self) -> Dict[str, Dict]:
+        """
+        Completion records of all finished items, by item id
+        """
+        ledger = {}
+        for f in os.listdir(self.done_dir):
+            if f.endswith(".json"):
+                with open(os.path.join(self.done_dir, f)) as fin:
+                    ledger[f[:-5]] = json.load(fin)
+        return ledger
+
+    def _try_acquire(self, item_id: str) -> bool:
+        try:
+            fd = os.open(self._lease_path(item_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as fout:
+            fout.write(self.worker_id)
+        with self.lock:
+            self.held.add(item_id)
+        return True
+
+    def _reclaim(self, item_id: str) -> bool:
+        """
+        Move an expired lease out of the way, returns whether the item may now be acquired
+        """
+        lease = self._lease_path(item_id)
+        try:
+            if self._fs_now() - os.stat(lease).st_mtime < self.ttl:
+                return False
+            stale = f"{lease}.expired.{self.worker_id}"
+            os.rename(lease, stale)
+        except FileNotFoundError:
+            # released or reclaimed by someone else in the meantime
+            return True
+        # someone may have reclaimed and re-acquired between our stat and rename, give a fresh lease back
+        if self._fs_now() - os.stat(stale).st_mtime < self.ttl:
+            try:
+                os.link(stale, lease)
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return False
+        os.remove(stale)
+        return True
+
+    def claim(self) -> Optional[Dict]:
+        """
+        Take a lease on the next unfinished item, taking over items of dead workers
+
+        returns the claimed item (with "reclaimed" set if it was taken over from a dead worker) or None if
+        no item can be claimed right now
+        """
+        for item in self.items:
+            item_id = item["id"]
+            if self.is_done(item_id):
+                continue
+            if self._try_acquire(item_id):
+                reclaimed = False
+            elif self._reclaim(item_id) and self._try_acquire(item_id):
+                reclaimed = True
+            else:
+                continue
+            # the holder may have completed and released the item between our ledger check and acquire
+            if self.is_done(item_id):
+                self._drop(item_id)
+                continue
+            return dict(item, reclaimed=reclaimed)
+        return None
+
+    def complete(self, item: Dict, info: Optional[Dict] = None):
+        """
+        Record item as finished in the ledger and release its lease
+        """
+        record = {"worker": self.worker_id, "time": time.time(), "size": item["size"]}
+        record.update(info or {})
+        _write_json_atomic(self._done_path(item["id"]), record)
+        self._drop(item["id"])
+
+    def _drop(self, item_id: str):
+        with self.lock:
+            self.held.discard(item_id)
+        try:
+            with open(self._lease_path(item_id)) as fin:
+                owner = fin.read()
+            if owner == self.worker_id:
+                os.remove(self._lease_path(item_id))
+        except FileNotFoundError:
+            pass
+
+    def _heartbeat(self):
+        while not self.stop.wait(self.ttl / 4):
+            with self.lock:
+                held = list(self.held)
+            for item_id in held:
+                try:
+                    os.utime(self._lease_path(item_id))
+                except FileNotFoundError:
+                    pass
+
+    def pending(self) -> List[Dict]:
+        return [item for item in self.items if not self.is_done(item["id"])]
+
+    def __iter__(self) -> Iterator[Dict]:
+        """
+        Yield claimed items until every item of the plan is done, waiting while other workers hold the remaining ones
+        """
+        while True:
+            item = self.claim()
+            if item is not None:
+                yield item
+            elif not self.pending():
+                return
+            else:
+                time.sleep(self.poll)
@@ -1,7 +1,12 @@
 from tqdm.autonotebook import tqdm
 from multiprocessing import Pool
 from datasketch import MinHashLSH
-from typing import List, Tuple, Dict
+from deduplication.hierarchical import local_pass
+from deduplication.signatures import SignatureStore
+from deduplication.metrics import NullMetrics, get_metrics
+from deduplication.readahead import SignatureReader
+from typing import List, Tuple, Dict, Iterable, Iterator, Optional
+from time import perf_counter
 import pickle
 import os
 
@@ -20,36 +25,96 @@ class LSHIndex:
     duplicates = index.deduplicate_corpus() # creates index and stores based on lsh_params
     ```
     """
-    def __init__(self, minhash_dir: str, lsh_params: Dict):
+    def __init__(self, minhash_dir: str, lsh_params: Dict, store: Optional[SignatureStore] = None, metrics: Optional[NullMetrics] = None):
         """
         minhash_dir: path to directory of pickled minhash signatures
         lsh_params: dict of parameters for MinHashLSH for datasketch
+        store: optional signature store, if given every LSH candidate is verified against its stored signature and only
+        candidates with an estimated Jaccard similarity of at least the threshold are reported, as (key, dup_key, similarity)
+        metrics: optional metrics to record index query and insert latencies in, by default the process' metrics
 
         for more info on how to set lsh_params see here: https://ekzhu.com/datasketch/documentation.html#minhash-lsh
         """
         self.minhash_dir = minhash_dir
         self.lsh = MinHashLSH(**lsh_params)
+        self.store = store
+        self.threshold = lsh_params.get("threshold", 0.9)
+        self.metrics = metrics or get_metrics()
 
-    def deduplicate_corpus(self) -> List[Tuple[str]]:
+    def deduplicate_corpus(self, local_workers: int = 0, out: Optional[List] = None) -> List[Tuple[str]]:
         """
         Deduplicates documents in the given corpus and adds them to the LSH index if appropriate.
         Documents without existing duplicates will be stored in the LSH index for future deduplication.
 
+        local_workers - if set, first deduplicate each minhash file against itself on this many processes
+        and only send the survivors to the LSH index, see deduplicate_hierarchical
+        out - optional list-like sink (e.g. a DuplicateWriter) that duplicates are appended to as they are found,
+        it is returned in place of a new list
+
         returns a list of tuples of the form (key, dup_key) representing duplicated documents,
         key is from the corpus we are currently considering and dup_key is from the LSH index.
         """
-        duplicate_list = []
-        minhash_files = [
+        if local_workers:
+            return self.deduplicate_hierarchical(((f, None) for f in self._minhash_files()), local_workers, out)
+        return self.deduplicate_stream(self.load_minhash_files(), out)
+
+    def _minhash_files(self) -> List[str]:
+        return sorted(
             os.path.join(self.minhash_dir, f)
             for f in os.listdir(self.minhash_dir)
             if f.endswith(".pkl")
-        ]
-        for minhashfile in minhash_files:
-            dups = self.deduplicate_minhash_file(minhashfile)
-            duplicate_list.extend(dups)
+        )
+
+    def load_minhash_files(self) -> Iterator[Tuple[str, List[Tuple]]]:
+        """
+        Loads the pickled minhash files in minhash_dir in sorted order, the next files in the background
+
+        yields tuples (minhashfile, minhash_list)
+        """
+        return iter(SignatureReader(self._minhash_files(), metrics=self.metrics))
+
+    def deduplicate_stream(self, blocks: Iterable[Tuple[str, List[Tuple]]], out: Optional[List] = None) -> List[Tuple[str]]:
+        """
+        Deduplicates blocks of minhash signatures in the order they are given and adds them to the LSH index if appropriate,
+        e.g. the blocks yielded by MinHasher.stream() while the rest of the corpus is still being hashed.
+
+        blocks - iterable of tuples (minhashfile, minhash_list) where minhashfile names the block
+        out - optional sink for the duplicates, as in deduplicate_corpus
+
+        returns a list of tuples of the form (key, dup_key) representing duplicated documents,
+        key is from the corpus we are currently considering and dup_key is from the LSH index.
+        """
+        duplicate_list = [] if out is None else out
+        for minhashfile, minhash_list in blocks:
+            self.deduplicate_minhash_list(minhash_list, minhashfile.split("/")[-1], duplicate_list)
 
         return duplicate_list
 
+    def deduplicate_hierarchical(self, blocks: Iterable[Tuple[str, Optional[List[Tuple]]]], num_workers: int, out: Optional[List] = None) -> List[Tuple[str]]:
+        """
+        Two level deduplication: each block (shard) is first deduplicated against itself with a small in-memory
+        index in parallel across num_workers processes, and only the survivors of each shard are then deduplicated
+        against (and inserted into) the LSH index, in block order. Intra-shard duplicates therefore never cost
+        a round trip to the LSH index.
+
+        blocks - iterable of tuples (minhashfile, minhash_list), minhash_list may be None to have the workers load minhashfile
+        num_workers - number of processes for the local pass
+        out - optional sink for the duplicates, as in deduplicate_corpus
+
+        returns a list of tuples of the form (key, dup_key) representing duplicated documents, dup_key is either
+        from the same shard (local duplicates) or from the LSH index
+        """
+        assert self.store is None, "Candidate verification is not supported together with a local deduplication pass"
+        duplicate_list = [] if out is None else out
+
+        def survivors():
+            for minhashfile, shard_survivors, local_dups in local_pass(blocks, self.lsh.h, (self.lsh.b, self.lsh.r), num_workers, pairs=True):
+                duplicate_list.extend(local_dups)
+                yield minhashfile, shard_survivors
+
+        self.deduplicate_stream(survivors(), duplicate_list)
+        return duplicate_list
+
     def deduplicate_and_insert(self, params: Tuple) -> List[Tuple[str]]:
         """
         Deduplicates a MinHash signature corresponding to a document using the provided LSH index.
@@ -63,36 +128,75 @@ class LSHIndex:
         """
         # query against lsh index
         key, m_query = params
+        timed = self.metrics.enabled
+        if timed:
+            start = perf_counter()
         result = self.lsh.query(m_query)
+        if timed:
+            self.metrics.observe("index_query_seconds", perf_counter() - start, start)
+
+        sims = None
+        if self.store is not None and result:
+            # all candidates of the document are scored at once, candidates that are not in the store can not be
+            # verified (NaN) and are kept
+            sims = self.store.similarity(m_query.hashvalues, result)
+            keep = ~(sims < self.threshold)
+            result, sims = [dup_key for dup_key, k in zip(result, keep) if k], sims[keep]
 
         # insert if not duplicated in index
         if not len(result) or (len(result) == 1 and result[0] == key):
+            if timed:
+                start = perf_counter()
             self.lsh.insert(key, m_query)
+            if timed:
+                self.metrics.observe("index_insert_seconds", perf_counter() - start, start)
 
+        if sims is not None:
+            return [(key, dup_key, "" if sim != sim else f"{sim:.4f}") for dup_key, sim in zip(result, sims.tolist())]
         return [(key, dup_key) for dup_key in result]
 
-    def deduplicate_minhash_file(self, minhashfile: str) -> List[Tuple[str]]:
+    def deduplicate_minhash_file(self, minhashfile: str, out: Optional[List] = None) -> List[Tuple[str]]:
         """
         Deduplicate documents in the given minhash file and adds them to the LSH index if appropriate.
         Documents without existing duplicates will be stored in the LSH index for future deduplication.
 
         minhashfile - path to file of minhash signatures stored in pickle format
+        out - optional sink for the duplicates, as in deduplicate_corpus
 
         returns a list of tuples of the form (key, dup_key) representing duplicated documents,
         key is from the corpus we are currently considering and dup_key is from the LSH index.
 
         Note: currently, this should only be run through deduplicate_corpus in order to ensure instantiation of the lsh object
         """
-        duplicate_list = []
         with open(minhashfile, "rb") as fin:
             minhash_list = pickle.load(fin)
-            fname = minhashfile.split("/")[-1]
-            with tqdm(total=len(minhash_list), desc=fname) as pbar:
-                for i in range(len(minhash_list)):
-                    result = self.deduplicate_and_insert(minhash_list[i])
-                    if result:
-                        duplicate_list.extend(result)
-                    pbar.update()
+        return self.deduplicate_minhash_list(minhash_list, minhashfile.split("/")[-1], out)
 
-        return duplicate_list
+    def deduplicate_minhash_list(self, minhash_list: List[Tuple], desc: str = None, out: Optional[List] = None) -> List[Tuple[str]]:
+        """
+        Deduplicate a list of (key, minhash) tuples in order and adds them to the LSH index if appropriate.
 
+        minhash_list - list of (key, minhash) tuples, as stored in a minhash file
+        desc - label for the progress bar
+        out - optional sink for the duplicates, as in deduplicate_corpus
+
+        returns a list of tuples of the form (key, dup_key) representing duplicated documents
+        """
+        if self.store is not None:
+            # candidates within the same file are verified too, the entry is named after the corpus as well since
+            # corpora often hold files of the same name
+            self.store.add(os.path.join(os.path.abspath(self.minhash_dir), os.path.splitext(desc or "block")[0]), minhash_list)
+
+        duplicate_list = [] if out is None else out
+        found = 0
+        with tqdm(total=len(minhash_list), desc=desc, disable=None) as pbar:
+            for i in range(len(minhash_list)):
+                result = self.deduplicate_and_insert(minhash_list[i])
+                if result:
+                    duplicate_list.extend(result)
+                    found += 1
+                pbar.update()
+
+        self.metrics.inc("index_documents", len(minhash_list))
+        self.metrics.inc("index_duplicates", found)
+        return duplicate_list
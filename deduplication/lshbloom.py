@@ -1,11 +1,86 @@
 from tqdm.autonotebook import tqdm
 from multiprocessing import Pool
 from datasketch import MinHashLSHBloom
-from typing import List, Tuple, Dict
+from datasketch.lsh import _optimal_param
+from datasketch.lsh_bloom import BloomTable
+from pybloomfilter import BloomFilter
+from deduplication.checkpoint import ProgressJournal
+from deduplication.hierarchical import local_pass
+from deduplication.writers import write_duplicates_to_csv
+from deduplication.metrics import NullMetrics, get_metrics
+from deduplication.readahead import SignatureReader
+from deduplication.memory import pool_size
+from typing import List, Tuple, Dict, Optional, Iterable, Iterator
 from functools import partial
+from time import perf_counter
+import numpy as np
 import pickle
+import re
 import os
 
+
+class ReadOnlyBloomTable(BloomTable):
+    """
+    A BloomTable over an existing filter file, mapped read-only so that any number of processes
+    can share a single page cache copy of it
+    """
+    def __init__(self, fname: str, band_size: int):
+        self.r = band_size
+        self.fname = fname
+        self.bloom_filter = BloomFilter.open(fname, mode="r")
+
+    def insert(self, hashvalues):
+        raise RuntimeError(f"Can not insert into read-only Bloom filter {self.fname}")
+
+    def sync(self):
+        pass
+
+
+class ReadOnlyMinHashLSHBloom(MinHashLSHBloom):
+    """
+    MinHashLSHBloom that opens the Bloom filters already stored in save_dir instead of creating them.
+    Accepts the same parameters as MinHashLSHBloom, n and fp are ignored since the filters already exist.
+    """
+    def __init__(self, threshold: float = 0.9, num_perm: int = 128, n: Optional[int] = None, fp: Optional[float] = None,
+                 save_dir: Optional[str] = None, weights: Tuple[float, float] = (0.5, 0.5), params: Optional[Tuple[int, int]] = None):
+        if save_dir is None or not os.path.isdir(save_dir):
+            raise ValueError(f"Read-only Bloom index requires an existing save_dir, got {save_dir}")
+        self.h = num_perm
+        # pick the same band layout the index was built with
+        if params is not None:
+            self.b, self.r = params
+        else:
+            self.b, self.r = _optimal_param(threshold, num_perm, *weights)
+
+        # band filters are named by band index, e.g. band-0.bf ... band-{b-1}.bf
+        fnames = sorted(
+            (f for f in os.listdir(save_dir) if f.endswith(".bf")),
+            key=lambda f: int(re.findall(r"\d+", f)[-1]),
+        )
+        if len(fnames) != self.b:
+            raise ValueError(f"Expected {self.b} Bloom filters in {save_dir} for threshold={threshold}, num_perm={num_perm}, found {len(fnames)}")
+        self.hashtables = [ReadOnlyBloomTable(os.path.join(save_dir, f), self.r) for f in fnames]
+        self.hashranges = [(i * self.r, (i + 1) * self.r) for i in range(self.b)]
+        self._minhash_scheme = None
+
+    def insert(self, minhash):
+        raise RuntimeError("Can not insert into a read-only LSHBloom index")
+
+
+# per-process index for parallel queries, each worker maps the filters itself rather than inheriting them
+_reader = None
+
+
+def _init_reader(minhash_dir: str, lsh_params: Dict):
+    global _reader
+    # a forked worker must not record into the parent's metrics, whose lock may have been held at fork time
+    _reader = LSHBloom(minhash_dir, lsh_params, read_only=True, metrics=NullMetrics())
+
+
+def _query_minhash_file(minhashfile: str) -> List[Tuple[str]]:
+    return _reader.query_minhash_file(minhashfile, progress=False)
+
+
 class LSHBloom:
     """
     Constructs a MinHashLSH Index using datasketch with Bloom Filters as a backend
@@ -19,34 +94,162 @@ class LSHBloom:
     lsh_params = {...}
     index = LSHBloom(minhashdir, lsh_params)
     index.deduplicate_corpus() # creates index and stores based on lsh_params
+
+    # check a new corpus against an existing index without modifying it
+    index = LSHBloom(minhashdir, lsh_params, read_only=True)
+    duplicates = index.query_corpus(num_workers=16)
     ```
     """
-    def __init__(self, minhash_dir: str, lsh_params: Dict):
+    def __init__(self, minhash_dir: str, lsh_params: Dict, read_only: bool = False, metrics: Optional[NullMetrics] = None):
         """
         minhash_dir: path to directory of pickled minhash signatures
         lsh_params: dict of parameters for MinHashLSH for datasketch
+        read_only: if set, open the existing Bloom filters in lsh_params["save_dir"] as read-only shared mappings,
+        the index can then only be queried
+        metrics: optional metrics to record index query, insert and band hash latencies in, by default the process' metrics
 
         for more info on how to set lsh_params see here: https://github.com/123epsilon/datasketch/blob/lsh_bloom/datasketch/lsh_bloom.py#L95
         """
         self.minhash_dir = minhash_dir
-        self.lsh = MinHashLSHBloom(**lsh_params)
+        self.lsh_params = lsh_params
+        self.read_only = read_only
+        self.metrics = metrics or get_metrics()
+        if read_only:
+            self.lsh = ReadOnlyMinHashLSHBloom(**lsh_params)
+        else:
+            self.lsh = MinHashLSHBloom(**lsh_params)
+
+    def _minhash_files(self) -> List[str]:
+        # sorted so that a resumed run visits files in the same order as the interrupted one
+        return sorted(
+            os.path.join(self.minhash_dir, f)
+            for f in os.listdir(self.minhash_dir)
+            if f.endswith(".pkl")
+        )
 
-    def deduplicate_corpus(self) -> List[Tuple[str]]:
+    def query_minhash_file(self, minhashfile: str, progress: bool = True) -> List[Tuple[str]]:
+        """
+        Check the documents in the given minhash file against the index without inserting them
+
+        minhashfile - path to file of minhash signatures stored in pickle format
+
+        returns a list of keys representing documents that are duplicated in the index
+        """
+        with open(minhashfile, "rb") as fin:
+            minhash_list = pickle.load(fin)
+        fname = minhashfile.split("/")[-1]
+        duplicates = [
+            (key,)
+            for key, m_query in tqdm(minhash_list, desc=fname, disable=None if progress else True)
+            if self.lsh.query(m_query)
+        ]
+        self.metrics.inc("index_documents", len(minhash_list))
+        self.metrics.inc("index_duplicates", len(duplicates))
+        return duplicates
+
+    def query_corpus(self, num_workers: int = 1, out: Optional[List] = None) -> List[Tuple[str]]:
+        """
+        Check every document in the given corpus against the index without inserting them.
+        Documents are only compared against the index, not against each other.
+
+        num_workers - number of processes to query with, each maps the Bloom filters read-only so they share
+        a single copy in the page cache
+        out - optional sink for the duplicates, as in deduplicate_corpus
+
+        returns a list of keys representing documents that are duplicated in the index, in the same order as a serial query
+        """
+        duplicate_list = [] if out is None else out
+        minhash_files = self._minhash_files()
+        if num_workers <= 1:
+            for minhashfile in minhash_files:
+                duplicate_list.extend(self.query_minhash_file(minhashfile))
+            return duplicate_list
+
+        with Pool(pool_size(num_workers), initializer=_init_reader, initargs=(self.minhash_dir, self.lsh_params)) as p, \
+                tqdm(total=len(minhash_files), desc=self.minhash_dir, disable=None) as pbar:
+            for dups in p.imap(_query_minhash_file, minhash_files):
+                duplicate_list.extend(dups)
+                self.metrics.inc("index_duplicates", len(dups))
+                pbar.update()
+
+        return duplicate_list
+
+    def deduplicate_corpus(self, journal: Optional[ProgressJournal] = None, local_workers: int = 0, out: Optional[List] = None) -> List[Tuple[str]]:
         """
         Deduplicates documents in the given corpus and adds them to the LSH index if appropriate.
         Documents without existing duplicates will be stored in the LSH index for future deduplication.
 
+        journal - optional progress journal, if given the corpus is processed in checkpointed windows, duplicates
+        are appended to the journal's csv as each window commits and work committed by a previous run is skipped
+        local_workers - if set, first deduplicate each minhash file against itself on this many processes
+        and only send the survivors to the Bloom index, see deduplicate_hierarchical
+        out - optional list-like sink (e.g. a DuplicateWriter) that duplicates are appended to as they are found,
+        it is returned in place of a new list
+
         returns a list of document keys representing duplicated documents
         """
-        duplicate_list = []
+        if local_workers:
+            assert journal is None, "Checkpointing is not supported together with a local deduplication pass"
+            return self.deduplicate_hierarchical(((f, None) for f in self._minhash_files()), local_workers, out)
+        return self.deduplicate_stream(self.load_minhash_files(journal), journal, out)
+
+    def deduplicate_hierarchical(self, blocks: Iterable[Tuple[str, Optional[List[Tuple]]]], num_workers: int, out: Optional[List] = None) -> List[Tuple[str]]:
+        """
+        Two level deduplication: each block (shard) is first deduplicated against itself with a small in-memory
+        index in parallel across num_workers processes, and only the survivors of each shard are then deduplicated
+        against (and inserted into) the Bloom index, in block order. Intra-shard duplicates therefore never cost
+        Bloom filter probes or inserts.
+
+        blocks - iterable of tuples (minhashfile, minhash_list), minhash_list may be None to have the workers load minhashfile
+        num_workers - number of processes for the local pass
+        out - optional sink for the duplicates, as in deduplicate_corpus
+
+        returns a list of document keys representing duplicated documents, both local and against the Bloom index
+        """
+        duplicate_list = [] if out is None else out
+
+        def survivors():
+            for minhashfile, shard_survivors, local_dups in local_pass(blocks, self.lsh.h, (self.lsh.b, self.lsh.r), num_workers, pairs=False):
+                duplicate_list.extend(local_dups)
+                yield minhashfile, shard_survivors
+
+        self.deduplicate_stream(survivors(), out=duplicate_list)
+        return duplicate_list
+
+    def load_minhash_files(self, journal: Optional[ProgressJournal] = None) -> Iterator[Tuple[str, List[Tuple]]]:
+        """
+        Loads the pickled minhash files in minhash_dir in sorted order, the next files in the background
+
+        journal - optional progress journal, files it marks as done are not loaded
+
+        yields tuples (minhashfile, minhash_list)
+        """
         minhash_files = [
-            os.path.join(self.minhash_dir, f)
-            for f in os.listdir(self.minhash_dir)
-            if f.endswith(".pkl")
+            minhashfile for minhashfile in self._minhash_files()
+            if journal is None or not journal.is_done(os.path.abspath(minhashfile))
         ]
-        for minhashfile in minhash_files:
-            dups = self.deduplicate_minhash_file(minhashfile)
-            duplicate_list.extend(dups)
+        return iter(SignatureReader(minhash_files, metrics=self.metrics))
+
+    def deduplicate_stream(self, blocks: Iterable[Tuple[str, List[Tuple]]], journal: Optional[ProgressJournal] = None, out: Optional[List] = None) -> List[Tuple[str]]:
+        """
+        Deduplicates blocks of minhash signatures in the order they are given and adds them to the LSH index if appropriate,
+        e.g. the blocks yielded by MinHasher.stream() while the rest of the corpus is still being hashed.
+
+        blocks - iterable of tuples (minhashfile, minhash_list) where minhashfile names the block
+        journal - optional progress journal, as in deduplicate_corpus
+        out - optional sink for the duplicates, as in deduplicate_corpus
+
+        returns a list of document keys representing duplicated documents
+        """
+        duplicate_list = [] if out is None else out
+        for minhashfile, minhash_list in blocks:
+            if journal is not None:
+                duplicate_list.extend(self.deduplicate_minhash_list_checkpointed(minhash_list, os.path.abspath(minhashfile), journal))
+            else:
+                self.deduplicate_minhash_list(minhash_list, minhashfile.split("/")[-1], duplicate_list)
+
+        if journal is not None:
+            journal.commit_corpus(self.minhash_dir)
 
         return duplicate_list
 
@@ -63,38 +266,204 @@ class LSHBloom:
         """
         # query against lsh index
         key, m_query = params
+        timed = self.metrics.enabled
+        if timed:
+            start = perf_counter()
         result = self.lsh.query(m_query)
+        if timed:
+            self.metrics.observe("index_query_seconds", perf_counter() - start, start)
 
         # insert if not duplicated in index
         if not result:
+            if timed:
+                start = perf_counter()
             self.lsh.insert(m_query)
+            if timed:
+                self.metrics.observe("index_insert_seconds", perf_counter() - start, start)
             return None
 
         return [(key,)]
 
-    def deduplicate_minhash_file(self, minhashfile: str) -> List[Tuple[str]]:
+    def deduplicate_minhash_file(self, minhashfile: str, out: Optional[List] = None) -> List[Tuple[str]]:
         """
         Deduplicate documents in the given minhash file and adds them to the LSH index if appropriate.
         Documents without existing duplicates will be stored in the LSH index for future deduplication.
 
         minhashfile - path to file of minhash signatures stored in pickle format
+        out - optional sink for the duplicates, as in deduplicate_corpus
 
         returns a list of keys representing duplicated documents,
         key is from the corpus we are currently considering and dup_key is from the LSH index.
 
         Note: currently, this should only be run through deduplicate_corpus in order to ensure instantiation of the lsh object
         """
-        duplicate_list = []
         with open(minhashfile, "rb") as fin:
             minhash_list = pickle.load(fin)
-            fname = minhashfile.split("/")[-1]
-            # can't multiprocess here as insertion requires C++ dependencies that are not compatible with pickle
-            with tqdm(total=len(minhash_list), desc=fname) as pbar:
-                for i in range(len(minhash_list)):
-                    result = self.deduplicate_and_insert(minhash_list[i])
-                    if result:
-                        duplicate_list.extend(result)
-                    pbar.update()
+        return self.deduplicate_minhash_list(minhash_list, minhashfile.split("/")[-1], out)
+
+    def deduplicate_minhash_list(self, minhash_list: List[Tuple], desc: str = None, out: Optional[List] = None) -> List[Tuple[str]]:
+        """
+        Deduplicate a list of (key, minhash) tuples in order and adds them to the LSH index if appropriate.
+
+        minhash_list - list of (key, minhash) tuples, as stored in a minhash file
+        desc - label for the progress bar
+        out - optional sink for the duplicates, as in deduplicate_corpus
+
+        returns a list of keys representing duplicated documents
+        """
+        duplicate_list = [] if out is None else out
+        found = 0
+        # can't multiprocess here as insertion requires C++ dependencies that are not compatible with pickle
+        with tqdm(total=len(minhash_list), desc=desc, disable=None) as pbar:
+            for i in range(len(minhash_list)):
+                result = self.deduplicate_and_insert(minhash_list[i])
+                if result:
+                    duplicate_list.extend(result)
+                    found += 1
+                pbar.update()
+
+        self.metrics.inc("index_documents", len(minhash_list))
+        self.metrics.inc("index_duplicates", found)
+        return duplicate_list
+
+    def deduplicate_band_hashes(self, keys: List[str], band_hashes: np.ndarray, desc: str = None, out: Optional[List] = None) -> List[Tuple[str]]:
+        """
+        Same as deduplicate_minhash_list, for documents whose band hashes have already been computed, e.g. for
+        several band layouts at once with bloom_band_hashes
+
+        keys - document keys in order
+        band_hashes - array of shape (len(keys), b) with the band hashes of every document under this index's layout
+        out - optional sink for the duplicates, as in deduplicate_corpus
+
+        returns a list of keys representing duplicated documents
+        """
+        duplicate_list = [] if out is None else out
+        tables = [table.bloom_filter for table in self.lsh.hashtables]
+        found = 0
+        for key, hashes in zip(keys, tqdm(band_hashes.tolist(), desc=desc, disable=None)):
+            # a collision in any band makes the document a duplicate
+            if any(H in table for H, table in zip(hashes, tables)):
+                duplicate_list.append((key,))
+                found += 1
+            else:
+                for H, table in zip(hashes, tables):
+                    table.add(H)
+        self.metrics.inc("index_documents", len(keys))
+        self.metrics.inc("index_duplicates", found)
+        return duplicate_list
+
+    def _band_hashes(self, m_query) -> List[int]:
+        """
+        Hash each band of a signature the same way the Bloom filters in the index do
+        """
+        return [
+            table._band_hash(m_query.hashvalues[start:end])
+            for (start, end), table in zip(self.lsh.hashranges, self.lsh.hashtables)
+        ]
 
+    def _apply_inserts(self, band_hashes: List[List[int]]):
+        """
+        Insert precomputed band hashes into the Bloom filters and flush them to disk
+        """
+        for hashes in band_hashes:
+            for H, table in zip(hashes, self.lsh.hashtables):
+                table.bloom_filter.add(H)
+        for table in self.lsh.hashtables:
+            table.bloom_filter.sync()
+
+    def _commit_window(self, minhash_list: List[Tuple], fname: str, start: int, end: int, dups: List[int], journal: ProgressJournal, band_hashes: List[List[int]]) -> List[Tuple[str]]:
+        """
+        Durably apply one window: journal its verdicts, insert its unique documents, sync the filters,
+        append its duplicates to the csv and finally mark it committed
+        """
+        with self.metrics.timer("checkpoint_commit_seconds"):
+            journal.begin(fname, start, end, dups)
+            with self.metrics.timer("index_insert_seconds"):
+                self._apply_inserts(band_hashes)
+            duplicate_list = [(minhash_list[start + i][0],) for i in dups]
+            write_duplicates_to_csv(duplicate_list, journal.csvpath, journal.corpus_name, header=journal.header, sync=True)
+            journal.commit(fname, end, done=end == len(minhash_list))
+        self.metrics.inc("index_documents", end - start)
+        self.metrics.inc("index_duplicates", len(dups))
         return duplicate_list
 
+    def _replay_window(self, minhash_list: List[Tuple], fname: str, journal: ProgressJournal) -> List[Tuple[str]]:
+        """
+        Finish a window that was journaled but never committed using its recorded verdicts
+        """
+        pending = journal.pending_for(fname)
+        start, end, dups = pending["start"], pending["end"], pending["dups"]
+        journal.truncate_csv(pending["csv_size"])
+        skip = set(dups)
+        band_hashes = [
+            self._band_hashes(minhash_list[start + i][1])
+            for i in range(end - start) if i not in skip
+        ]
+        return self._commit_window(minhash_list, fname, start, end, dups, journal, band_hashes)
+
+    def deduplicate_minhash_file_checkpointed(self, minhashfile: str, journal: ProgressJournal) -> List[Tuple[str]]:
+        """
+        Same as deduplicate_minhash_file, but commits progress to the journal every journal.checkpoint_every documents
+        and resumes after the last committed window of this file. Inserts within a window are held in memory
+        (while still being visible to later queries in the window) until the window commits, so a crash never leaves
+        uncommitted inserts in the filters that the journal does not know about.
+
+        minhashfile - path to file of minhash signatures stored in pickle format
+        journal - progress journal shared by all files of the run
+
+        returns a list of keys representing documents found to be duplicates in this run
+        """
+        fname = os.path.abspath(minhashfile)
+        if journal.is_done(fname):
+            return []
+        with open(minhashfile, "rb") as fin:
+            minhash_list = pickle.load(fin)
+        return self.deduplicate_minhash_list_checkpointed(minhash_list, fname, journal)
+
+    def deduplicate_minhash_list_checkpointed(self, minhash_list: List[Tuple], fname: str, journal: ProgressJournal) -> List[Tuple[str]]:
+        """
+        Checkpointed deduplication of a list of (key, minhash) tuples, see deduplicate_minhash_file_checkpointed
+
+        minhash_list - list of (key, minhash) tuples, as stored in a minhash file
+        fname - absolute path of the minhash file the list belongs to, identifies it in the journal
+
+        returns a list of keys representing documents found to be duplicates in this run
+        """
+        if journal.is_done(fname):
+            return []
+
+        duplicate_list = []
+        if journal.pending_for(fname) is not None:
+            duplicate_list.extend(self._replay_window(minhash_list, fname, journal))
+
+        offset = journal.offset(fname)
+        if offset == 0 and not minhash_list:
+            journal.commit(fname, 0, done=True)
+            return duplicate_list
+
+        timed = self.metrics.enabled
+        with tqdm(total=len(minhash_list), initial=offset, desc=fname.split("/")[-1], disable=None) as pbar:
+            for start in range(offset, len(minhash_list), journal.checkpoint_every):
+                end = min(start + journal.checkpoint_every, len(minhash_list))
+                # band hashes inserted during this window, not yet written to the Bloom filters
+                window = [set() for _ in self.lsh.hashtables]
+                band_hashes, dups = [], []
+                for i in range(start, end):
+                    if timed:
+                        clock = perf_counter()
+                    hashes = self._band_hashes(minhash_list[i][1])
+                    if timed:
+                        self.metrics.observe("band_hash_seconds", perf_counter() - clock, clock)
+                        clock = perf_counter()
+                    if any(H in table.bloom_filter or H in seen for H, table, seen in zip(hashes, self.lsh.hashtables, window)):
+                        dups.append(i - start)
+                    else:
+                        band_hashes.append(hashes)
+                        for H, seen in zip(hashes, window):
+                            seen.add(H)
+                    if timed:
+                        self.metrics.observe("index_query_seconds", perf_counter() - clock, clock)
+                    pbar.update()
+                duplicate_list.extend(self._commit_window(minhash_list, fname, start, end, dups, journal, band_hashes))
+
+        return duplicate_list
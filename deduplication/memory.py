@@ -0,0 +1,222 @@
+from deduplication.metrics import NullMetrics, get_metrics
+from multiprocessing import active_children
+from typing import List, Optional
+import threading
+import logging
+import math
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+# rough resident size of an idle pool worker once numpy and datasketch are imported
+WORKER_BYTES = 96 << 20
+
+# python object, array header and key overhead of one (key, MinHash) tuple on top of its hashvalues
+SIGNATURE_OVERHEAD = 400
+
+# fraction of the budget at which a run starts backing off, and the fraction it backs off to
+HIGH_WATER = 0.85
+LOW_WATER = 0.7
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def process_rss(pid="self") -> int:
+    """
+    Resident set size in bytes of a process, 0 if it is gone (or not on Linux)
+    """
+    try:
+        with open(f"/proc/{pid}/statm") as fin:
+            return int(fin.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def signature_bytes(num_perm: int) -> int:
+    """
+    Approximate memory of one signature held in a minhash list (hashvalues plus object overhead)
+    """
+    return num_perm * 8 + SIGNATURE_OVERHEAD
+
+
+class MemoryBudget:
+    """
+    A memory limit for the whole run (this process and its pool workers), used in two ways:
+
+    - up front, to size things: worker counts, documents in flight to the minhash pool, how far ahead corpora are
+      prefetched, the size of the Bloom filters and the sort buffers
+    - at runtime, by sampling the resident size of the process tree: once it passes HIGH_WATER of the limit the
+      minhash pool is fed fewer documents at a time and the prefetcher stops running ahead, until it is back
+      below LOW_WATER
+
+    The peak resident size is tracked and recorded in the metrics as rss_bytes and peak_rss_bytes.
+
+    Example usage:
+    ```
+    budget = MemoryBudget(64 << 30)
+    set_budget(budget)
+    p = Pool(pool_size(32)) # no more workers than fit in the budget
+    ```
+    """
+    def __init__(self, limit: int, interval: float = 0.5, metrics: Optional[NullMetrics] = None):
+        """
+        limit: memory budget in bytes
+        interval: seconds for which a measurement of the resident size is reused
+        metrics: optional metrics to record the resident size in, by default the process' metrics
+        """
+        self.limit = limit
+        self.interval = interval
+        self.metrics = metrics or get_metrics()
+        self.peak = 0
+        self.last = 0
+        self.measured = 0.0
+        self.backing_off = False
+        self.lock = threading.Lock()
+
+    def used(self) -> int:
+        """
+        Current resident size of this process and its children, measured at most every interval seconds
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now - self.measured >= self.interval:
+                self.last = process_rss() + sum(process_rss(p.pid) for p in active_children())
+                self.measured = now
+                self.peak = max(self.peak, self.last)
+                self.metrics.gauge("rss_bytes", self.last)
+                self.metrics.gauge("peak_rss_bytes", self.peak)
+            return self.last
+
+    def under_pressure(self) -> bool:
+        """
+        Whether the run should back off, with hysteresis between HIGH_WATER and LOW_WATER
+        """
+        used = self.used()
+        if self.backing_off:
+            self.backing_off = used > LOW_WATER * self.limit
+        elif used > HIGH_WATER * self.limit:
+            self.backing_off = True
+            self.metrics.inc("memory_backoffs")
+            logger.warning(f"Resident size {used / (1 << 30):.2f}G is close to the memory budget of {self.limit / (1 << 30):.2f}G, backing off")
+        return self.backing_off
+
+    def workers(self, requested: int, per_worker: int = WORKER_BYTES, share: float = 0.5) -> int:
+        """
+        Number of pool workers to start, at most requested and at most as many as fit in share of the budget
+        """
+        return max(1, min(requested, int(share * self.limit) // per_worker))
+
+    def inflight_docs(self, num_perm: int, doc_bytes: int = 64 << 10, share: float = 0.1) -> int:
+        """
+        Documents handed to the minhash pool ahead of their results, each holds its raw line (about doc_bytes)
+        until it is hashed
+        """
+        return max(64, int(share * self.limit) // (doc_bytes + signature_bytes(num_perm)))
+
+    def prefetch_bytes(self, share: float = 0.25) -> int:
+        """
+        Size of the signatures that may be hashed ahead of the index
+        """
+        return int(share * self.limit)
+
+    def index_bytes(self, share: float = 0.5) -> int:
+        """
+        Size the index may grow to
+        """
+        return int(share * self.limit)
+
+    def sort_bytes(self, share: float = 0.5) -> int:
+        """
+        Memory for the sort buffers of all sort workers together
+        """
+        return int(share * self.limit)
+
+
+def fit_bloom_fp(n: int, fp: float, bands: List[int], limit: int) -> float:
+    """
+    False positive rate of each Bloom filter, fp if the filters of all indexes (bands[i] filters each) for
+    n documents fit in limit bytes, else the smallest rate at which they do
+    """
+    bits = 8 * limit / sum(bands)
+    return max(fp, math.exp(-bits * math.log(2) ** 2 / n))
+
+
+class InFlight:
+    """
+    Bounds the number of tasks handed to a process pool ahead of their results. Pool.imap reads its input as fast as
+    it can, so without a bound a whole input file can end up queued in memory. Under memory pressure the bound is
+    halved (down to minimum), and it grows back once the pressure is gone.
+
+    minimum must be at least the chunksize of the pool, which only sends a chunk once it is full
+    """
+    def __init__(self, limit: int, budget: Optional[MemoryBudget] = None, minimum: int = 64):
+        self.minimum = minimum
+        self.max_limit = max(limit, minimum)
+        self.limit = self.max_limit
+        self.budget = budget
+        self.count = 0
+        self.released = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def acquire(self) -> bool:
+        """
+        Wait for a free slot, returns False if the window was closed in the meantime
+        """
+        with self.cond:
+            while self.count >= self.limit and not self.closed:
+                self.cond.wait()
+            self.count += 1
+            return not self.closed
+
+    def release(self):
+        with self.cond:
+            self.count -= 1
+            self.released += 1
+            # resized once every minimum results, measuring the resident size is not free
+            if self.budget is not None and self.released % self.minimum == 0:
+                if self.budget.under_pressure():
+                    self.limit = max(self.minimum, self.limit // 2)
+                else:
+                    self.limit = min(self.max_limit, self.limit * 2)
+            self.cond.notify()
+
+    def close(self):
+        """
+        Stop handing out slots, so that a pool whose results are abandoned does not block its task feeder forever
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def wrap(self, items):
+        """
+        Iterate items, waiting for a free slot before each, the consumer calls release once per result
+        """
+        for item in items:
+            if not self.acquire():
+                return
+            yield item
+
+
+# memory budget of this process, set once by the entry point, None means unlimited
+_budget: Optional[MemoryBudget] = None
+
+
+def get_budget() -> Optional[MemoryBudget]:
+    return _budget
+
+
+def set_budget(budget: Optional[MemoryBudget]):
+    global _budget
+    _budget = budget
+
+
+def pool_size(requested: int, per_worker: int = WORKER_BYTES) -> int:
+    """
+    Number of processes for a pool of requested workers, fewer if they would not fit in the memory budget
+    """
+    if _budget is None:
+        return requested
+    return _budget.workers(requested, per_worker)
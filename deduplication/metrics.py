@@ -0,0 +1,292 @@
+from typing import Dict, List, Optional
+from bisect import bisect_left
+from time import perf_counter
+import threading
+import random
+import json
+import time
+import os
+
+# upper bounds in seconds of the latency histogram buckets, 1us to ~67s in powers of two
+BUCKETS = [2.0 ** e for e in range(-20, 7)]
+
+# metrics files ending in this are written in the Prometheus textfile format, anything else as json lines
+PROMETHEUS_SUFFIX = ".prom"
+
+
+class Histogram:
+    """
+    Latency histogram with fixed power of two buckets, cheap enough to observe every document
+    """
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of the bucket holding the q-quantile
+        """
+        rank, seen = q * self.count, 0
+        for bound, n in zip(BUCKETS + [float("inf")], self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self) -> Dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": self.counts,
+        }
+
+
+class _Span:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics: "Metrics", name: str):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, perf_counter() - self.start, self.start)
+
+
+class NullMetrics:
+    """
+    Metrics that records nothing, the default. Hot loops check enabled before reading the clock,
+    everything else can call the methods unconditionally.
+    """
+    enabled = False
+
+    def inc(self, name: str, value: int = 1):
+        pass
+
+    def observe(self, name: str, seconds: float, start: Optional[float] = None):
+        pass
+
+    def gauge(self, name: str, value: float):
+        pass
+
+    def timer(self, name: str) -> "_NullSpan":
+        return _NULL_SPAN
+
+    def start(self):
+        return self
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Metrics(NullMetrics):
+    """
+    Counters, gauges (e.g. queue depths) and latency histograms per stage of a run, exported every interval
+    seconds as a json line appended to path, or as a Prometheus textfile (path ending in .prom) that is replaced
+    on every export, for node_exporter's textfile collector. A sample of the timed operations can also be written
+    to trace_path as Chrome trace events, one json object per line.
+
+    Latencies are recorded under <stage>_seconds, e.g. minhash_parse_seconds, index_query_seconds, write_seconds.
+
+    Example usage:
+    ```
+    with Metrics("run.prom", interval=30) as metrics:
+        set_metrics(metrics)
+        ...
+        with metrics.timer("write_seconds"):
+            ...
+        metrics.inc("documents", len(minhash_list))
+    ```
+    """
+    enabled = True
+
+    def __init__(self, path: Optional[str] = None, interval: float = 30.0, trace_path: Optional[str] = None,
+                 trace_sample: float = 0.001, labels: Optional[Dict[str, str]] = None):
+        """
+        path: file the metrics are exported to, if None they are only kept in memory (see snapshot)
+        interval: seconds between exports
+        trace_path: optional file to write sampled spans to
+        trace_sample: fraction of timed operations written to trace_path
+        labels: constant labels added to every exported metric, e.g. the corpus or worker id
+        """
+        self.path = path
+        self.interval = interval
+        self.trace_path = trace_path
+        self.trace_sample = trace_sample if trace_path else 0.0
+        self.labels = labels or {}
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[str, float] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # perf_counter has an arbitrary origin, trace timestamps are taken relative to the construction of this object
+        self._clock_offset = perf_counter()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.trace_file = None
+
+    def inc(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, seconds: float, start: Optional[float] = None):
+        """
+        Record a latency in the histogram name, start is the perf_counter() time the operation began at, if given
+        a trace_sample fraction of observations is also written to the trace
+        """
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+        if start is not None and self.trace_sample > 0 and random.random() < self.trace_sample:
+            self._trace(name, start, seconds)
+
+    def gauge(self, name: str, value: float):
+        with self.lock:
+            self.gauges[name] = value
+
+    def timer(self, name: str) -> _Span:
+        """
+        Context manager recording the time spent in its body in the histogram name, and as a trace span
+        for a trace_sample fraction of calls
+        """
+        return _Span(self, name)
+
+    def _trace(self, name: str, start: float, elapsed: float):
+        event = {"name": name, "ph": "X", "ts": int((self.started + start - self._clock_offset) * 1e6),
+                 "dur": int(elapsed * 1e6), "pid": os.getpid(), "tid": threading.get_ident()}
+        with self.lock:
+            if self.trace_file is None:
+                self.trace_file = open(self.trace_path, "a")
+            self.trace_file.write(json.dumps(event) + "\n")
+
+    def snapshot(self) -> Dict:
+        with self.lock:
+            return {
+                "timestamp": time.time(),
+                "elapsed": time.time() - self.started,
+                "pid": os.getpid(),
+                **self.labels,
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": {name: h.snapshot() for name, h in self.histograms.items()},
+            }
+
+    def export(self):
+        """
+        Write the current values to path
+        """
+        if self.path is None:
+            return
+        snapshot = self.snapshot()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if self.path.endswith(PROMETHEUS_SUFFIX):
+            # replaced atomically so the collector never reads a partial file
+            tmp = f"{self.path}.tmp{os.getpid()}"
+            with open(tmp, "w") as fout:
+                fout.write(format_prometheus(snapshot, self.labels))
+            os.replace(tmp, self.path)
+        else:
+            with open(self.path, "a") as fout:
+                fout.write(json.dumps(snapshot) + "\n")
+        if self.trace_file is not None:
+            with self.lock:
+                self.trace_file.flush()
+
+    def _export_loop(self):
+        while not self.stopped.wait(self.interval):
+            self.export()
+
+    def start(self) -> "Metrics":
+        """
+        Start exporting every interval seconds on a background thread
+        """
+        if self.path is not None and self.thread is None:
+            self.thread = threading.Thread(target=self._export_loop, daemon=True)
+            self.thread.start()
+        return self
+
+    def close(self):
+        """
+        Stop the export thread and write the final values
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.export()
+        if self.trace_file is not None:
+            self.trace_file.close()
+            self.trace_file = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def format_prometheus(snapshot: Dict, labels: Dict[str, str], prefix: str = "dedup_") -> str:
+    """
+    Metrics snapshot in the Prometheus text exposition format
+    """
+    def fmt(extra: Optional[Dict[str, str]] = None) -> str:
+        pairs = {**labels, **(extra or {})}
+        return "{" + ",".join(f'{k}="{v}"' for k, v in pairs.items()) + "}" if pairs else ""
+
+    lines: List[str] = []
+    for name, value in sorted(snapshot["counters"].items()):
+        lines += [f"# TYPE {prefix}{name}_total counter", f"{prefix}{name}_total{fmt()} {value}"]
+    for name, value in sorted(snapshot["gauges"].items()):
+        lines += [f"# TYPE {prefix}{name} gauge", f"{prefix}{name}{fmt()} {value}"]
+    for name, h in sorted(snapshot["histograms"].items()):
+        lines.append(f"# TYPE {prefix}{name} histogram")
+        cumulative = 0
+        for bound, n in zip(BUCKETS + [float("inf")], h["buckets"]):
+            cumulative += n
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f"{prefix}{name}_bucket{fmt({'le': le})} {cumulative}")
+        lines += [f"{prefix}{name}_sum{fmt()} {h['sum']}", f"{prefix}{name}_count{fmt()} {h['count']}"]
+    return "\n".join(lines) + "\n"
+
+
+# metrics of this process, set once by the entry point and picked up by every component that is not given its own
+_metrics: NullMetrics = NullMetrics()
+
+
+def get_metrics() -> NullMetrics:
+    return _metrics
+
+
+def set_metrics(metrics: Optional[NullMetrics]):
+    global _metrics
+    _metrics = metrics if metrics is not None else NullMetrics()
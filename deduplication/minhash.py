@@ -1,52 +1,270 @@
 from tqdm.autonotebook import tqdm
 from multiprocessing import Pool
 from datasketch import MinHash
-from typing import Optional
-from glob import glob
+from deduplication.exact import ExactFilter, text_hash, seen, write_exact_duplicates
+from deduplication.output import write_offsets
+from deduplication.metrics import NullMetrics, get_metrics
+from deduplication.memory import InFlight, get_budget, pool_size
+from deduplication.inputs import BlockReader, ColumnarReader, InputReader, is_columnar, input_paths, input_stem, read_texts
+from typing import Optional, Iterator, List, Tuple, Union
+from queue import Queue
+import numpy as np
+import threading
 import pickle
 import json
 from functools import partial
+from time import perf_counter
+import logging
 import os
 
 # TODO check if minhashes already exist, recompute only if forced
 
-def compute_minhash_jsonl(t, fname, num_perm):
+logger = logging.getLogger(__name__)
+
+# number of documents checked against the exact filter at a time
+EXACT_BATCH = 1024
+
+def compute_minhash_jsonl(t, fname, num_perm, exact_table=None):
 	lineNo, line = t
-	lineNo += 1
 	line = json.loads(line)
 	line = line.get("text", "")
+	return minhash_text(lineNo + 1, line, set(line.split()), fname, num_perm, exact_table)
+
+def compute_minhash_jsonl_timed(t, fname, num_perm, exact_table=None):
+	"""
+	compute_minhash_jsonl that also measures its steps, for when metrics are enabled
+
+	returns a tuple (result, (parse, tokenize, hash)) with the seconds spent in each step
+	"""
+	start = perf_counter()
+	lineNo, line = t
+	line = json.loads(line).get("text", "")
+	parsed = perf_counter()
 	s = set(line.split())
+	tokenized = perf_counter()
+	result = minhash_text(lineNo + 1, line, s, fname, num_perm, exact_table)
+	return result, (parsed - start, tokenized - parsed, perf_counter() - tokenized)
+
+def compute_minhash_row_group(t, fname, num_perm, text_column, exact_table=None):
+	"""
+	Minhash every row of one row group of a Parquet file (record batch of an Arrow file), reading only its text column
+
+	returns a tuple (results, read seconds, bytes read), with one minhash_text result per row
+	"""
+	path, group, first_row = t
+	start = perf_counter()
+	texts, size = read_texts(path, group, text_column)
+	read = perf_counter() - start
+	return [minhash_text(first_row + i + 1, text, set(text.split()), fname, num_perm, exact_table) for i, text in enumerate(texts)], read, size
+
+def minhash_text(lineNo, text, s, fname, num_perm, exact_table=None):
 	if not s:
 		return None
+	# generate a unique key for this document
+	key = f"{fname}-{lineNo}"
+	if exact_table is not None:
+		h = text_hash(text)
+		# a repeat of a document the parent has already seen needs no signature
+		if seen(exact_table, h):
+			return (key, None, h)
 	m = MinHash(num_perm=num_perm)
 	for d in s:
 		m.update(d.encode("utf8"))
-	# generate a unique key for this document
-	key = f"{fname}-{lineNo}"
+	if exact_table is not None:
+		return (key, m, h)
 	return (key, m)
 
-def compute_minhash_for_file(infile: str, output_dir: str, num_perm: int):
+def resolve_exact(batch: List[Tuple], exact: ExactFilter, file_id: int, minhash_list: List[Tuple], repeats: List[Tuple]):
 	"""
-	Compute minhash signatures for a given jsonl file with the format specified for
-	'compute_minhash_jsonl' above.
+	Check a batch of (lineNo, (key, minhash, hash)) results against the exact filter in document order,
+	first copies go to minhash_list and repeats to repeats as (key, first_key)
+	"""
+	hashes = np.array([h for _, (_, _, h) in batch], dtype=np.uint64)
+	refs = np.array([(file_id << 32) | lineNo for lineNo, _ in batch], dtype=np.int64)
+	for (_, (key, m, _)), first in zip(batch, exact.resolve(hashes, refs).tolist()):
+		if first < 0:
+			minhash_list.append((key, m))
+		else:
+			repeats.append((key, exact.key(first)))
 
-	infile is the path to the singular jsonl file
-	will store the minhash signatures in self.output_dir
+def minhash_lines(infile: str, num_perm: int, p: Pool, exact: Optional[ExactFilter] = None, metrics: Optional[NullMetrics] = None, reader: Optional[BlockReader] = None) -> Tuple[List[Tuple], List[Tuple], List[int]]:
+	"""
+	Compute minhash signatures for every document of a jsonl file on the given process pool
+
+	exact - optional run-wide exact filter, documents whose normalized text was already seen get no signature
+	metrics - optional metrics to record the parse, tokenize and hash time of every document in, by default the process' metrics
+	reader - optional block reader of infile that may already be reading ahead, by default one is started here
+
+	returns a tuple (minhash_list, repeats, offsets), minhash_list is a list of (key, minhash) tuples in the order the documents
+	appear in infile, repeats a list of (key, first_key) tuples of the exact repeats and offsets the byte offsets
+	of the lines of infile (line i spans offsets[i - 1] to offsets[i])
 	"""
 	n = 50000
 	fname = infile.split("/")[-1]
-	with open(infile) as fin, Pool(32) as p, tqdm(total=n, desc=fname) as pbar:
+	metrics = metrics or get_metrics()
+	timed = metrics.enabled
+	# with a memory budget, only a bounded (and under pressure shrinking) number of lines is queued for the pool
+	budget = get_budget()
+	window = InFlight(budget.inflight_docs(num_perm), budget) if budget is not None else None
+	# workers send every signature with its own copy of the permutations, which are the same for the whole run
+	permutations = None
+	# read as bytes in large blocks so that line offsets are byte offsets, json.loads decodes in the workers
+	with (reader or BlockReader(infile)).start() as reader, tqdm(total=n, desc=fname, disable=None) as pbar:
 		minhash_list = list()
-		partial_compute_minhash = partial(compute_minhash_jsonl, fname=fname, num_perm=num_perm)
-		for result in p.imap_unordered(partial_compute_minhash, enumerate(fin)):
-		# for t in enumerate(fin):
-			# result = partial_compute_minhash(t)	
-			if result:
-				minhash_list.append(result)
+		repeats = list()
+		batch = list()
+		offsets = [0]
+
+		def lines():
+			# consumed by the pool's task feeder thread, offsets is complete once every result is in
+			for line in (reader.lines() if window is None else window.wrap(reader.lines())):
+				offsets.append(offsets[-1] + len(line))
+				yield line
+
+		file_id = exact.file_id(fname) if exact is not None else None
+		partial_compute_minhash = partial(compute_minhash_jsonl_timed if timed else compute_minhash_jsonl, fname=fname, num_perm=num_perm, exact_table=exact.table_path if exact is not None else None)
+		# ordered so that signature files are reproducible, resumed runs index into them by position
+		results = p.imap(partial_compute_minhash, enumerate(lines()), chunksize=64)
+		try:
+			for lineNo, result in enumerate(results, 1):
+				if window is not None:
+					window.release()
+				if timed:
+					result, (parse, tokenize, hashing) = result
+					metrics.observe("minhash_parse_seconds", parse)
+					metrics.observe("minhash_tokenize_seconds", tokenize)
+					metrics.observe("minhash_hash_seconds", hashing)
+				if not result:
+					continue
 				pbar.update()
-		with open(f"{output_dir}/{fname[:-6]}.pkl", "wb") as fp:
-			pickle.dump(minhash_list, fp)
-		print(f"Generated MinHash for {len(minhash_list):,} documents in {fname}")
+				if result[1] is not None:
+					if permutations is None:
+						permutations = result[1].permutations
+					else:
+						result[1].permutations = permutations
+				if exact is None:
+					minhash_list.append(result)
+					continue
+				batch.append((lineNo, result))
+				if len(batch) >= EXACT_BATCH:
+					resolve_exact(batch, exact, file_id, minhash_list, repeats)
+					batch = list()
+		finally:
+			if window is not None:
+				window.close()
+		if batch:
+			resolve_exact(batch, exact, file_id, minhash_list, repeats)
+		if exact is not None:
+			# every task of the file is done, none names an older table any more
+			exact.drop_retired()
+	metrics.inc("minhash_documents", len(offsets) - 1)
+	metrics.inc("minhash_bytes", offsets[-1])
+	metrics.inc("exact_repeats", len(repeats))
+	return minhash_list, repeats, offsets
+
+def minhash_row_groups(infile: str, num_perm: int, p: Pool, exact: Optional[ExactFilter] = None, metrics: Optional[NullMetrics] = None, reader: Optional[ColumnarReader] = None) -> Tuple[List[Tuple], List[Tuple], None]:
+	"""
+	Compute minhash signatures for every row of a Parquet or Arrow file on the given process pool, one row group per task
+	so that the row groups of a file are spread over the workers. Only the text column is read (see set_text_column), and
+	keys are the file name and the row number counting from 1, as the line numbers of a jsonl file
+
+	exact - optional run-wide exact filter, documents whose normalized text was already seen get no signature
+	metrics - optional metrics to record the reads in, by default the process' metrics
+	reader - optional columnar reader of infile, by default one is started here
+
+	returns a tuple (minhash_list, repeats, None) as minhash_lines, a columnar file has no line offsets
+	"""
+	fname = infile.split("/")[-1]
+	metrics = metrics or get_metrics()
+	# workers send every signature with its own copy of the permutations, which are the same for the whole run
+	permutations = None
+	with (reader or ColumnarReader(infile)).start() as reader, tqdm(total=reader.num_rows, desc=fname, disable=None) as pbar:
+		minhash_list = list()
+		repeats = list()
+		batch = list()
+		file_id = exact.file_id(fname) if exact is not None else None
+		partial_compute_minhash = partial(compute_minhash_row_group, fname=fname, num_perm=num_perm, text_column=reader.text_column, exact_table=exact.table_path if exact is not None else None)
+		tasks = reader.tasks()
+		# ordered so that signature files are reproducible, resumed runs index into them by position
+		for (_, _, first_row), (results, seconds, size) in zip(tasks, p.imap(partial_compute_minhash, tasks)):
+			reader.record(seconds, size)
+			pbar.update(len(results))
+			for lineNo, result in enumerate(results, first_row + 1):
+				if not result:
+					continue
+				if result[1] is not None:
+					if permutations is None:
+						permutations = result[1].permutations
+					else:
+						result[1].permutations = permutations
+				if exact is None:
+					minhash_list.append(result)
+					continue
+				batch.append((lineNo, result))
+				if len(batch) >= EXACT_BATCH:
+					resolve_exact(batch, exact, file_id, minhash_list, repeats)
+					batch = list()
+		if batch:
+			resolve_exact(batch, exact, file_id, minhash_list, repeats)
+		if exact is not None:
+			# every task of the file is done, none names an older table any more
+			exact.drop_retired()
+	metrics.inc("minhash_documents", reader.num_rows)
+	metrics.inc("minhash_bytes", reader.bytes_read)
+	metrics.inc("exact_repeats", len(repeats))
+	return minhash_list, repeats, None
+
+def minhash_input(infile: str, num_perm: int, p: Pool, exact: Optional[ExactFilter] = None, reader: Optional[Union[BlockReader, ColumnarReader]] = None) -> Tuple[List[Tuple], List[Tuple], Optional[List[int]]]:
+	"""
+	minhash_row_groups for Parquet and Arrow files, minhash_lines for jsonl files
+	"""
+	if isinstance(reader, ColumnarReader) or (reader is None and is_columnar(infile)):
+		return minhash_row_groups(infile, num_perm, p, exact, reader=reader)
+	return minhash_lines(infile, num_perm, p, exact, reader=reader)
+
+def save_minhashes(infile: str, minhash_file: str, minhash_list: List[Tuple], repeats: List[Tuple], offsets: Optional[List[int]]):
+	"""
+	Write the signatures of an input file along with its exact repeats and, for jsonl files, its line offsets
+	"""
+	# write then rename, so that a reader (or another worker redoing this file) never sees a partial file
+	with open(f"{minhash_file}.tmp{os.getpid()}", "wb") as fp:
+		pickle.dump(minhash_list, fp)
+	os.replace(f"{minhash_file}.tmp{os.getpid()}", minhash_file)
+	write_exact_duplicates(minhash_file, repeats)
+	if offsets is not None:
+		write_offsets(minhash_file, offsets)
+
+def minhash_file_path(infile: str, output_dir: str) -> str:
+	"""
+	Path of the pickled signatures for a given jsonl, Parquet or Arrow file
+	"""
+	fname = infile.split("/")[-1]
+	return f"{output_dir}/{input_stem(fname)}.pkl"
+
+def compute_minhash_for_file(infile: str, output_dir: str, num_perm: int, p: Optional[Pool] = None, exact: Optional[ExactFilter] = None, reader: Optional[Union[BlockReader, ColumnarReader]] = None) -> List[Tuple]:
+	"""
+	Compute minhash signatures for a given jsonl file with the format specified for
+	'compute_minhash_jsonl' above, or for a Parquet or Arrow file with a text column.
+
+	infile is the path to the singular input file
+	will store the minhash signatures in self.output_dir
+	p is an optional process pool to hash on, by default a new one is created for this file
+	exact is an optional run-wide exact filter, the exact repeats it finds are stored next to the signatures
+	the byte offsets of the lines of a jsonl infile are stored next to the signatures as well, for write_deduplicated
+	reader is an optional reader of infile, e.g. one of an InputReader that started reading it ahead
+
+	returns the exact repeats as (key, first_key) tuples
+	"""
+	fname = infile.split("/")[-1]
+	reader = reader or (ColumnarReader(infile) if is_columnar(infile) else BlockReader(infile))
+	if p is None:
+		with Pool(pool_size(32)) as p:
+			minhash_list, repeats, offsets = minhash_input(infile, num_perm, p, exact, reader=reader)
+	else:
+		minhash_list, repeats, offsets = minhash_input(infile, num_perm, p, exact, reader=reader)
+	save_minhashes(infile, minhash_file_path(infile, output_dir), minhash_list, repeats, offsets)
+	logger.info(f"Generated MinHash for {len(minhash_list):,} documents in {fname} ({reader.describe()})" + (f", skipped {len(repeats):,} exact repeats" if repeats else ""))
+	return repeats
 
 class MinHasher:
 	"""
@@ -58,27 +276,96 @@ class MinHasher:
 	outdir = "/data/minhashes/"
 	m = MinHasher(indir, outdir)
 	m.process() # signatures will be stored in outdir
+
+	# skip the signatures of exact repeats, they are listed in m.exact_duplicates instead
+	m = MinHasher(indir, outdir, exact=ExactFilter())
+
+	# or feed signatures straight to an index while later files are still being hashed
+	for minhash_file, minhash_list in m.stream(save=False):
+		...
 	```
 	"""
-	def __init__(self, jsonl_dir: str, output_dir: str, num_perm: int = 128):
+	def __init__(self, jsonl_dir: str, output_dir: str, num_perm: int = 128, exact: Optional[ExactFilter] = None):
 		"""
 		jsonl_dir: path to jsonl files for the given corpus
 		output_dir: path to save minhash signatures to for the given corpus
+		exact: optional exact filter shared by the whole run, documents whose normalized text was already seen are not
+		minhashed, they are collected in self.exact_duplicates as (key, first_key) and stored next to the signatures
 		"""
 		self.input_dir = jsonl_dir
 		self.output_dir = output_dir
 		self.num_perm = num_perm
+		self.exact = exact
+		self.exact_duplicates = []
 
 		os.makedirs(self.output_dir, exist_ok=True)
 
 
-	def process(self):
+	def process(self, p: Optional[Pool] = None):
 		"""
 		Compute minhash signatures for a directory of jsonl files with the format specified for
-		'self.compute_minhash_jsonl'.
+		'self.compute_minhash_jsonl', and of Parquet and Arrow files with a text column.
+
+		p is an optional process pool to hash on, by default one is created for the whole corpus
+		"""
+		if p is None:
+			# forked before the readers start their threads
+			with Pool(pool_size(32)) as p:
+				return self.process(p)
+		# the next files are opened and read ahead while the current one is being hashed
+		for reader in InputReader(self.input_files()):
+			self.compute_minhash_for_file(reader.path, p, reader)
+
+	def input_files(self) -> List[str]:
+		"""
+		jsonl, Parquet and Arrow files of the corpus, sorted so that every run visits them in the same order
 		"""
-		for infile in glob(f"{self.input_dir}/*.jsonl"):
-			self.compute_minhash_for_file(infile)
+		return input_paths(self.input_dir)
+
+	def stream(self, save: bool = True, depth: int = 2) -> Iterator[Tuple[str, List[Tuple]]]:
+		"""
+		Compute minhash signatures for a directory of jsonl files and yield them file by file in input order,
+		so that a consumer (e.g. an index) can work on one file while the following ones are being hashed.
+
+		save - whether to also write each file's signatures to self.output_dir, as process() does
+		depth - maximum number of hashed files buffered ahead of the consumer
+
+		yields tuples (minhash_file, minhash_list) where minhash_file is the path the signatures are (or would be) saved to
+		"""
+		blocks = Queue(maxsize=depth)
+		metrics = get_metrics()
+		# workers are forked here on the calling thread, before the producer thread exists
+		p = Pool(pool_size(32))
+
+		def produce():
+			try:
+				for reader in InputReader(self.input_files()):
+					infile = reader.path
+					minhash_list, repeats, offsets = minhash_input(infile, self.num_perm, p, self.exact, reader=reader)
+					logger.info(f"Generated MinHash for {len(minhash_list):,} documents in {os.path.basename(infile)} ({reader.describe()})")
+					minhash_file = minhash_file_path(infile, self.output_dir)
+					if save:
+						save_minhashes(infile, minhash_file, minhash_list, repeats, offsets)
+					self.exact_duplicates.extend(repeats)
+					blocks.put((minhash_file, minhash_list))
+				blocks.put(None)
+			except BaseException as e:
+				blocks.put(e)
+
+		try:
+			# daemon so that an abandoned stream does not keep the interpreter alive
+			threading.Thread(target=produce, daemon=True).start()
+			while True:
+				# hashed files waiting for the consumer, 0 means the consumer is starved
+				metrics.gauge("minhash_stream_queue_depth", blocks.qsize())
+				block = blocks.get()
+				if block is None:
+					return
+				if isinstance(block, BaseException):
+					raise block
+				yield block
+		finally:
+			p.terminate()
 
 	def compute_minhash_jsonl(self, t: tuple, fname: str) -> Optional[tuple]:
 		"""
@@ -94,13 +381,14 @@ class MinHasher:
 		"""
 		return compute_minhash_jsonl(t, fname, self.num_perm)
 
-	def compute_minhash_for_file(self, infile: str):
+	def compute_minhash_for_file(self, infile: str, p: Optional[Pool] = None, reader: Optional[Union[BlockReader, ColumnarReader]] = None):
 		"""
 		Compute minhash signatures for a given jsonl file with the format specified for
-		'compute_minhash_jsonl' above.
+		'compute_minhash_jsonl' above, or for a Parquet or Arrow file with a text column.
 
-		infile is the path to the singular jsonl file
+		infile is the path to the singular input file
 		will store the minhash signatures in self.output_dir
+		reader is an optional reader of infile that may already be reading ahead
 		"""
-		compute_minhash_for_file(infile, self.output_dir, self.num_perm)
+		self.exact_duplicates.extend(compute_minhash_for_file(infile, self.output_dir, self.num_perm, p, self.exact, reader))
 
@@ -0,0 +1,111 @@
+from deduplication.lsh import LSHIndex
+from deduplication.lshbloom import LSHBloom
+from deduplication.readahead import SignatureReader
+from typing import List, Tuple, Iterable, Iterator, Optional, Union
+import numpy as np
+import pickle
+import os
+
+_mersenne_prime = np.uint64((1 << 61) - 1)
+
+
+def bloom_band_hashes(hashvalues: np.ndarray, layouts: List[List[Tuple[int, int]]]) -> List[np.ndarray]:
+    """
+    Band hashes of a batch of signatures for several band layouts at once. A Bloom band hash is the sum of the band's
+    hashvalues (in uint64) modulo 2^61 - 1, so one prefix sum per signature gives the band sums of every layout
+    as differences of two entries.
+
+    hashvalues - array of shape (n_docs, num_perm)
+    layouts - for every layout, the (start, end) hashranges of its bands
+
+    returns one array of shape (n_docs, b) per layout, equal to BloomTable._band_hash of every band
+    """
+    prefix = np.zeros((hashvalues.shape[0], hashvalues.shape[1] + 1), dtype=np.uint64)
+    # uint64 wraps around exactly like the summation in BloomTable._band_hash
+    np.cumsum(hashvalues.astype(np.uint64, copy=False), axis=1, dtype=np.uint64, out=prefix[:, 1:])
+    out = []
+    for hashranges in layouts:
+        starts = np.array([start for start, _ in hashranges])
+        ends = np.array([end for _, end in hashranges])
+        out.append((prefix[:, ends] - prefix[:, starts]) % _mersenne_prime)
+    return out
+
+
+class MultiThresholdIndex:
+    """
+    Deduplicates a corpus against several indexes at once, one per Jaccard similarity threshold (each with its own
+    band layout), reading every signature file only once.
+
+    For LSHBloom indexes the band hashes of all layouts are computed together from one prefix sum per signature and
+    the Bloom filters are probed with the precomputed hashes. LSHIndex indexes share the loaded signatures.
+
+    Example usage:
+    ```
+    indexes = [(t, LSHBloom(minhash_dir, dict(lsh_params, threshold=t, save_dir=f"{save_dir}/threshold-{t}"))) for t in (0.7, 0.8, 0.9)]
+    index = MultiThresholdIndex(minhash_dir, indexes)
+    duplicates = index.deduplicate_corpus() # (threshold, key) tuples
+    ```
+    """
+    def __init__(self, minhash_dir: str, indexes: List[Tuple[float, Union[LSHIndex, LSHBloom]]]):
+        """
+        minhash_dir: path to directory of pickled minhash signatures
+        indexes: list of (threshold, index) tuples, all of the same kind
+        """
+        assert len({type(index) for _, index in indexes}) == 1, "Expected indexes of a single kind"
+        self.minhash_dir = minhash_dir
+        self.indexes = indexes
+
+    def deduplicate_corpus(self, out: Optional[List] = None) -> List[Tuple[str]]:
+        """
+        Deduplicates documents in the given corpus against every index and adds them to each index if appropriate
+
+        out - optional list-like sink (e.g. a DuplicateWriter) that duplicates are appended to file by file,
+        it is returned in place of a new list
+
+        returns a list of tuples of the form (threshold,) + duplicate, with duplicate as returned by the index kind
+        """
+        return self.deduplicate_stream(self.load_minhash_files(), out)
+
+    def deduplicate_minhash_file(self, minhashfile: str, out: Optional[List] = None) -> List[Tuple[str]]:
+        """
+        Deduplicate documents in the given minhash file against every index and add them to each index if appropriate
+        """
+        with open(minhashfile, "rb") as fin:
+            minhash_list = pickle.load(fin)
+        return self.deduplicate_stream([(minhashfile, minhash_list)], out)
+
+    def load_minhash_files(self) -> Iterator[Tuple[str, List[Tuple]]]:
+        minhash_files = sorted(
+            os.path.join(self.minhash_dir, f)
+            for f in os.listdir(self.minhash_dir)
+            if f.endswith(".pkl")
+        )
+        return iter(SignatureReader(minhash_files))
+
+    def deduplicate_stream(self, blocks: Iterable[Tuple[str, List[Tuple]]], out: Optional[List] = None) -> List[Tuple[str]]:
+        """
+        Deduplicates blocks of minhash signatures in the order they are given against every index
+
+        blocks - iterable of tuples (minhashfile, minhash_list) where minhashfile names the block
+        out - optional sink for the duplicates, as in deduplicate_corpus
+
+        returns a list of tuples of the form (threshold,) + duplicate
+        """
+        duplicate_list = [] if out is None else out
+        bloom = isinstance(self.indexes[0][1], LSHBloom)
+        for minhashfile, minhash_list in blocks:
+            fname = minhashfile.split("/")[-1]
+            if bloom and minhash_list:
+                keys = [key for key, _ in minhash_list]
+                hashvalues = np.stack([m.hashvalues for _, m in minhash_list])
+                # hashed for the whole file at once, so timed per file rather than per document
+                with self.indexes[0][1].metrics.timer("band_hash_batch_seconds"):
+                    layouts = bloom_band_hashes(hashvalues, [index.lsh.hashranges for _, index in self.indexes])
+                for (threshold, index), band_hashes in zip(self.indexes, layouts):
+                    dups = index.deduplicate_band_hashes(keys, band_hashes, f"{fname} @ {threshold}")
+                    duplicate_list.extend((threshold,) + dup for dup in dups)
+            elif not bloom:
+                for threshold, index in self.indexes:
+                    dups = index.deduplicate_minhash_list(minhash_list, f"{fname} @ {threshold}")
+                    duplicate_list.extend((threshold,) + dup for dup in dups)
+        return duplicate_list
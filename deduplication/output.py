@@ -0,0 +1,219 @@
+from multiprocessing import Pool
+from deduplication.writers import is_binary, read_duplicate_blocks
+from deduplication.memory import pool_size
+from typing import List, Dict, Tuple
+from glob import glob
+import numpy as np
+import errno
+import csv
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+OFFSETS_SUFFIX = ".offsets"
+
+# size of the reads when newlines have to be found or bytes copied in user space
+READ_SIZE = 8 << 20
+
+# copy_file_range and sendfile fail with these on filesystems or kernels that do not support them
+_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP)
+
+# header rows of the duplicate csv files, the kept rows all have the removed document's key after the corpus name
+HEADERS = ("corpus", "key", "dup_key", "threshold")
+
+
+def offsets_file_path(minhash_file: str) -> str:
+    """
+    Path of the line offsets recorded for a signature file
+    """
+    return os.path.splitext(minhash_file)[0] + OFFSETS_SUFFIX
+
+
+def write_offsets(minhash_file: str, offsets: List[int]):
+    """
+    Record the byte offsets of the lines of the jsonl file a signature file was computed from,
+    line i (counting from 1, as in document keys) spans bytes offsets[i - 1] to offsets[i]
+    """
+    path = offsets_file_path(minhash_file)
+    with open(f"{path}.tmp{os.getpid()}", "wb") as fout:
+        np.save(fout, np.asarray(offsets, dtype=np.uint64))
+    os.replace(f"{path}.tmp{os.getpid()}", path)
+
+
+def scan_offsets(infile: str) -> np.ndarray:
+    """
+    Byte offsets of the lines of a jsonl file found by scanning it for newlines, for signatures computed without offsets
+    """
+    offsets = [np.zeros(1, dtype=np.uint64)]
+    pos = 0
+    with open(infile, "rb") as fin:
+        while True:
+            buf = fin.read(READ_SIZE)
+            if not buf:
+                break
+            offsets.append(np.flatnonzero(np.frombuffer(buf, dtype=np.uint8) == ord("\n")).astype(np.uint64) + np.uint64(pos + 1))
+            pos += len(buf)
+    offsets = np.concatenate(offsets)
+    # a last line without a trailing newline
+    if offsets[-1] != pos:
+        offsets = np.append(offsets, np.uint64(pos))
+    return offsets
+
+
+def read_offsets(minhash_file: str, infile: str) -> np.ndarray:
+    """
+    Byte offsets of the lines of infile, as recorded next to its signatures if they still match the file
+    """
+    path = offsets_file_path(minhash_file)
+    if os.path.exists(path):
+        offsets = np.load(path)
+        if int(offsets[-1]) == os.path.getsize(infile):
+            return offsets
+    return scan_offsets(infile)
+
+
+def read_duplicate_lines(csvfiles: List[str]) -> Dict[Tuple[str, str], np.ndarray]:
+    """
+    Line numbers of the documents to remove, from duplicate csv files with a (corpus, key, ...) layout or binary duplicate files
+
+    returns a dict mapping (corpus, jsonl file name) to a sorted array of line numbers
+    """
+    lines = {}
+    for csvfile in csvfiles:
+        if is_binary(csvfile):
+            # the first key column of every block holds the removed documents as (file index << 32) | line number
+            for meta, columns in read_duplicate_blocks(csvfile):
+                ids = columns[meta["types"].index("key")]
+                for i, fname in enumerate(meta["files"]):
+                    lines.setdefault((meta["corpus"], fname), []).extend((ids[(ids >> 32) == i] & 0xFFFFFFFF).tolist())
+            continue
+        with open(csvfile, newline="") as fin:
+            for row in csv.reader(fin):
+                if len(row) < 2 or row[0] in HEADERS:
+                    continue
+                fname, lineNo = row[1].rsplit("-", 1)
+                lines.setdefault((row[0], fname), []).append(int(lineNo))
+    return {k: np.unique(np.array(v, dtype=np.int64)) for k, v in lines.items()}
+
+
+def kept_ranges(offsets: np.ndarray, removed: np.ndarray) -> List[Tuple[int, int]]:
+    """
+    Byte ranges (start, end) of the lines that are kept, runs of consecutive kept lines are merged into one range
+    """
+    keep = np.ones(len(offsets) - 1, dtype=bool)
+    removed = removed[(removed >= 1) & (removed <= len(keep))]
+    keep[removed - 1] = False
+    edges = np.diff(np.concatenate(([False], keep, [False])).astype(np.int8))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    return list(zip(offsets[starts].tolist(), offsets[ends].tolist()))
+
+
+# cleared once a call shows the kernel or filesystem does not support it
+_copy_file_range = hasattr(os, "copy_file_range")
+_sendfile = hasattr(os, "sendfile")
+
+
+def copy_range(src: int, dst: int, offset: int, count: int):
+    """
+    Append count bytes of src starting at offset to dst, inside the kernel where possible
+    """
+    global _copy_file_range, _sendfile
+    while count > 0 and _copy_file_range:
+        try:
+            n = os.copy_file_range(src, dst, count, offset)
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+            _copy_file_range = False
+            break
+        if n == 0:
+            raise EOFError(f"Unexpected end of input at byte {offset}")
+        offset += n
+        count -= n
+    while count > 0 and _sendfile:
+        try:
+            n = os.sendfile(dst, src, offset, count)
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+            _sendfile = False
+            break
+        if n == 0:
+            raise EOFError(f"Unexpected end of input at byte {offset}")
+        offset += n
+        count -= n
+    while count > 0:
+        buf = os.pread(src, min(count, READ_SIZE), offset)
+        if not buf:
+            raise EOFError(f"Unexpected end of input at byte {offset}")
+        os.write(dst, buf)
+        offset += len(buf)
+        count -= len(buf)
+
+
+def write_shard(task: Tuple[str, str, str, np.ndarray]) -> Tuple[str, int, int, int]:
+    """
+    Write the kept documents of one jsonl file to outfile, copying byte ranges without parsing any document
+
+    task - tuple (infile, minhash_file, outfile, removed line numbers)
+
+    returns a tuple (outfile, documents kept, documents removed, bytes written)
+    """
+    infile, minhash_file, outfile, removed = task
+    offsets = read_offsets(minhash_file, infile)
+    ranges = kept_ranges(offsets, removed)
+    os.makedirs(os.path.dirname(outfile) or ".", exist_ok=True)
+    tmp = f"{outfile}.tmp{os.getpid()}"
+    written = 0
+    with open(infile, "rb") as fin, open(tmp, "wb") as fout:
+        src, dst = fin.fileno(), fout.fileno()
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(src, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        for start, end in ranges:
+            copy_range(src, dst, start, end - start)
+            written += end - start
+    os.replace(tmp, outfile)
+    n_removed = int(np.count_nonzero((removed >= 1) & (removed < len(offsets))))
+    return outfile, len(offsets) - 1 - n_removed, n_removed, written
+
+
+def write_deduplicated(
+    corpus_names: List[str],
+    inputs: List[str],
+    minhash_dirs: List[str],
+    csvfiles: List[str],
+    output_dir: str,
+    num_workers: int = 1,
+):
+    """
+    Write every input corpus without the documents listed as duplicates in csvfiles, one jsonl shard per input file
+    at output_dir/<corpus name>/<file name>. Kept lines are copied verbatim as byte ranges, using the line offsets
+    recorded next to the signatures (or found by scanning for newlines if there are none), and shards are written
+    in parallel.
+
+    corpus_names - names of the corpora as written to the csv files
+    inputs - directory of jsonl files (or a single jsonl file) of every corpus
+    minhash_dirs - signature directory of every corpus
+    num_workers - number of shards written at a time
+    """
+    removed = read_duplicate_lines(csvfiles)
+    tasks = []
+    for corpus_name, input_path, minhash_dir in zip(corpus_names, inputs, minhash_dirs):
+        infiles = [input_path] if os.path.isfile(input_path) else sorted(glob(f"{input_path}/*.jsonl"))
+        for infile in infiles:
+            fname = infile.split("/")[-1]
+            minhash_file = f"{minhash_dir}/{fname[:-6]}.pkl"
+            outfile = os.path.join(output_dir, corpus_name, fname)
+            tasks.append((infile, minhash_file, outfile, removed.get((corpus_name, fname), np.zeros(0, dtype=np.int64))))
+
+    # largest files first so that no worker is left with a big shard at the end
+    tasks.sort(key=lambda t: os.path.getsize(t[0]), reverse=True)
+    kept = dropped = written = 0
+    with Pool(pool_size(max(num_workers, 1))) as p:
+        for _, n_kept, n_removed, n_bytes in p.imap_unordered(write_shard, tasks):
+            kept += n_kept
+            dropped += n_removed
+            written += n_bytes
+    logger.info(f"Wrote {kept:,} documents ({written / (1 << 20):,.1f} MiB) to {output_dir}, removed {dropped:,} duplicates")
@@ -0,0 +1,252 @@
+from typing import Dict, Optional, Tuple
+import numpy as np
+import warnings
+import math
+import json
+import time
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+PLAN_NAME = "plan.json"
+
+# rough Redis memory per stored member (dict entry, set header, sds string headers), used for the LSH footprint
+REDIS_ENTRY_OVERHEAD = 64
+
+
+def false_positive_rate(threshold: float, b: int, r: int) -> float:
+    """
+    Probability that a pair with similarity below the threshold becomes a candidate, averaged over
+    similarities uniform in [0, threshold]
+    """
+    # datasketch is only imported when a plan is made, applying a stored plan does not need it
+    from datasketch.lsh import _false_positive_probability
+    return _false_positive_probability(threshold, b, r) / threshold if threshold > 0 else 0.0
+
+
+def false_negative_rate(threshold: float, b: int, r: int) -> float:
+    """
+    Probability that a pair with similarity above the threshold is missed, averaged over similarities
+    uniform in [threshold, 1]
+    """
+    from datasketch.lsh import _false_negative_probability
+    return _false_negative_probability(threshold, b, r) / (1 - threshold) if threshold < 1 else 0.0
+
+
+def bloom_filter_bits(capacity: int, error_rate: float) -> int:
+    """
+    Size in bits of an optimally sized Bloom filter for capacity items at the given false positive rate
+    """
+    return math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+
+
+def index_memory(kind: str, corpus_size: int, b: int, r: int, filter_fp: float = 0.001, key_bytes: int = 32) -> int:
+    """
+    Expected size of the index in bytes after inserting corpus_size documents
+
+    kind - "bloom" (b Bloom filters) or "lsh" (b Redis hash tables plus the key table)
+    filter_fp - false positive rate of each Bloom filter
+    key_bytes - average length of a document key, for the LSH estimate
+    """
+    if kind == "bloom":
+        return b * bloom_filter_bits(corpus_size, filter_fp) // 8
+    # every band stores r hashvalues as the bucket key and the document key as a member,
+    # and the key table maps each document to its b band keys
+    per_doc = b * (r * 8 + key_bytes + 2 * REDIS_ENTRY_OVERHEAD) + key_bytes + REDIS_ENTRY_OVERHEAD
+    return corpus_size * per_doc
+
+
+def _random_signatures(num_perm: int, n_docs: int, seed: int = 1) -> list:
+    from datasketch import MinHash
+    rng = np.random.default_rng(seed)
+    template = MinHash(num_perm=num_perm)
+    minhashes = []
+    for hashvalues in rng.integers(0, 1 << 32, size=(n_docs, num_perm), dtype=np.uint64):
+        m = template.copy()
+        m.hashvalues = hashvalues
+        minhashes.append(m)
+    return minhashes
+
+
+def _time_index(kind: str, minhashes: list, b: int, r: int) -> float:
+    from datasketch import MinHashLSH, MinHashLSHBloom
+    if kind == "bloom":
+        with warnings.catch_warnings():
+            # in-memory filters are all a benchmark needs
+            warnings.simplefilter("ignore", RuntimeWarning)
+            lsh = MinHashLSHBloom(num_perm=b * r, n=len(minhashes), fp=0.001, params=(b, r))
+    else:
+        lsh = MinHashLSH(num_perm=b * r, params=(b, r))
+    start = time.perf_counter()
+    # query then insert, as the workflows do for every new document
+    for i, m in enumerate(minhashes):
+        lsh.query(m)
+        if kind == "bloom":
+            lsh.insert(m)
+        else:
+            lsh.insert(str(i), m)
+    return (time.perf_counter() - start) / len(minhashes)
+
+
+def _redis_latency(redis_port: int, rounds: int = 200) -> float:
+    import redis
+    client = redis.Redis(host="localhost", port=redis_port)
+    try:
+        client.ping()
+    except redis.exceptions.ConnectionError:
+        logger.warning(f"No Redis server on port {redis_port}, LSH calibration does not include round trips")
+        return 0.0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        client.ping()
+    return (time.perf_counter() - start) / rounds
+
+
+def calibrate(kind: str, num_perm: int = 128, n_docs: int = 2000, redis_port: Optional[int] = None) -> Dict[str, float]:
+    """
+    Short micro-benchmark of the index on this machine, fitting the cost of deduplicating one document
+    as doc_seconds + b * band_seconds
+
+    kind - "bloom" or "lsh"
+    n_docs - number of random signatures to insert per measurement
+    redis_port - for "lsh", port of the Redis server whose round trip time is added to every band lookup and insert
+
+    returns a dict with doc_seconds and band_seconds
+    """
+    minhashes = _random_signatures(num_perm, n_docs)
+    b_lo, b_hi = 2, min(32, num_perm)
+    t_lo = _time_index(kind, minhashes, b_lo, num_perm // b_lo)
+    t_hi = _time_index(kind, minhashes, b_hi, num_perm // b_hi)
+    band_seconds = max((t_hi - t_lo) / (b_hi - b_lo), 0.0)
+    doc_seconds = max(t_lo - b_lo * band_seconds, 0.0)
+    if kind == "lsh" and redis_port is not None:
+        band_seconds += 2 * _redis_latency(redis_port)
+    return {"doc_seconds": doc_seconds, "band_seconds": band_seconds}
+
+
+def plan_index(
+    kind: str,
+    threshold: float,
+    num_perm: int,
+    corpus_size: int,
+    max_fp_rate: Optional[float] = None,
+    max_fn_rate: Optional[float] = None,
+    bloom_fp: float = 0.001,
+    memory_budget: Optional[int] = None,
+    min_docs_per_sec: Optional[float] = None,
+    calibration: Optional[Dict[str, float]] = None,
+    weights: Tuple[float, float] = (0.5, 0.5),
+    key_bytes: int = 32,
+) -> Dict:
+    """
+    Pick the band layout (b, r) for an index, weighing the LSH error rates against memory and throughput
+
+    Like datasketch, the layout minimizes the weighted sum of the false positive and false negative probabilities,
+    but only among the layouts that meet the given limits, since every extra band is another Bloom filter or another
+    Redis hash table (and round trip) per document.
+
+    kind - "bloom" or "lsh"
+    corpus_size - number of documents that will be inserted into the index
+    max_fp_rate, max_fn_rate - limits on the LSH error rates, see false_positive_rate and false_negative_rate
+    bloom_fp - probability that a new document is flagged by the Bloom filters alone, split evenly over the b filters
+    memory_budget - limit on the expected index size in bytes
+    min_docs_per_sec - limit on the expected index throughput, needs calibration
+    calibration - result of calibrate(), without it no throughput is estimated
+
+    returns the plan as a dict with b, r, the error rates, filter_fp (per Bloom filter), memory and docs_per_sec
+
+    raises ValueError if no layout meets the limits
+    """
+    best, best_error, rejected = None, float("inf"), 0
+    # datasketch needs at least two bands
+    for b in range(2, num_perm + 1):
+        filter_fp = 1 - (1 - bloom_fp) ** (1 / b)
+        memory = index_memory(kind, corpus_size, b, 1, filter_fp, key_bytes) if kind == "bloom" else None
+        if calibration is not None:
+            docs_per_sec = 1 / max(calibration["doc_seconds"] + b * calibration["band_seconds"], 1e-12)
+        else:
+            docs_per_sec = None
+        # both limits only get tighter with more bands
+        if (memory_budget is not None and memory is not None and memory > memory_budget) or \
+                (min_docs_per_sec is not None and docs_per_sec is not None and docs_per_sec < min_docs_per_sec):
+            rejected += num_perm // b
+            continue
+        for r in range(1, num_perm // b + 1):
+            if kind != "bloom":
+                memory = index_memory(kind, corpus_size, b, r, key_bytes=key_bytes)
+                if memory_budget is not None and memory > memory_budget:
+                    rejected += 1
+                    continue
+            fp = false_positive_rate(threshold, b, r)
+            fn = false_negative_rate(threshold, b, r)
+            if (max_fp_rate is not None and fp > max_fp_rate) or (max_fn_rate is not None and fn > max_fn_rate):
+                rejected += 1
+                continue
+            # same objective as datasketch's own choice, so that without limits the plan matches the default layout
+            error = fp * threshold * weights[0] + fn * (1 - threshold) * weights[1]
+            if error < best_error:
+                best_error = error
+                best = {
+                    "kind": kind,
+                    "threshold": threshold,
+                    "num_perm": num_perm,
+                    "corpus_size": corpus_size,
+                    "b": b,
+                    "r": r,
+                    "fp_rate": fp,
+                    "fn_rate": fn,
+                    "filter_fp": filter_fp if kind == "bloom" else None,
+                    "memory": memory,
+                    "docs_per_sec": docs_per_sec,
+                }
+    if best is None:
+        raise ValueError(
+            f"No band layout meets the limits (max_fp_rate={max_fp_rate}, max_fn_rate={max_fn_rate}, "
+            f"memory_budget={memory_budget}, min_docs_per_sec={min_docs_per_sec}), all {rejected} layouts were rejected"
+        )
+    return best
+
+
+def format_plan(plan: Dict) -> str:
+    lines = [
+        f"Index plan for {plan['kind']} at threshold {plan['threshold']} with {plan['num_perm']} permutations:",
+        f"  bands (b) = {plan['b']}, rows per band (r) = {plan['r']}",
+        f"  false positive rate = {plan['fp_rate']:.4f}, false negative rate = {plan['fn_rate']:.4f}",
+        f"  expected index size for {plan['corpus_size']:,} documents = {plan['memory'] / (1 << 30):.2f} GiB",
+    ]
+    if plan["filter_fp"] is not None:
+        lines.append(f"  Bloom filter false positive rate = {plan['filter_fp']:.2e} per filter")
+    if plan["docs_per_sec"] is not None:
+        lines.append(f"  expected index throughput = {plan['docs_per_sec']:,.0f} docs/sec")
+    return "\n".join(lines)
+
+
+def apply_plan(lsh_params: Dict, plan: Optional[Dict]) -> Dict:
+    """
+    Index parameters with the band layout (and Bloom filter error rate) of the plan, if any
+    """
+    if plan is None:
+        return lsh_params
+    lsh_params = dict(lsh_params, params=(plan["b"], plan["r"]))
+    if plan["filter_fp"] is not None and "fp" in lsh_params:
+        lsh_params["fp"] = plan["filter_fp"]
+    return lsh_params
+
+
+def load_plan(path: str) -> Optional[Dict]:
+    """
+    Plan stored at path, or None if there is none
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as fin:
+        return json.load(fin)
+
+
+def save_plan(path: str, plan: Dict):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "w") as fout:
+        json.dump(plan, fout, indent=2)
+    os.replace(tmp, path)
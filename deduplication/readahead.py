@@ -0,0 +1,114 @@
+from deduplication.metrics import NullMetrics, get_metrics
+from deduplication.memory import get_budget
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Iterator, Optional
+from collections import deque
+from time import perf_counter
+import pickle
+import os
+
+# signature files loaded ahead of the index by default, 0 loads each file only when the index asks for it
+READ_AHEAD = 2
+
+
+def load_minhash_file(minhashfile: str) -> List[Tuple]:
+    # the whole file is read first, the read releases the GIL while the index keeps working
+    with open(minhashfile, "rb") as fin:
+        data = fin.read()
+    return pickle.loads(data)
+
+
+class SignatureReader:
+    """
+    Loads pickled minhash files on background threads ahead of the index that consumes them, so that reading
+    (and decoding) the next files overlaps with the index work on the current one. Files are always yielded in the
+    order given, whichever thread finishes first.
+
+    How far the reader runs ahead is bounded by
+    - depth: the number of files loading or loaded while the consumer works on the current one
+    - max_bytes: the total size on disk of those files
+    - the memory budget, if any: under memory pressure no file is loaded ahead
+    The file the consumer is waiting for is never held back by the limits.
+
+    Stalls on both sides are recorded in the metrics: signature_wait_seconds is the time the consumer waited for
+    a file, signature_idle_seconds the time a loaded file waited for the consumer (the reader was ahead).
+
+    Example usage:
+    ```
+    for minhashfile, minhash_list in SignatureReader(minhash_files, depth=2):
+        ...
+    ```
+    """
+    def __init__(self, minhash_files: List[str], depth: Optional[int] = None, max_bytes: Optional[int] = None, metrics: Optional[NullMetrics] = None):
+        """
+        minhash_files: paths of the pickled minhash files, in the order they are consumed
+        depth: number of files loaded ahead, by default the process' read ahead (see set_read_ahead)
+        max_bytes: optional bound on the size of the files loaded ahead
+        metrics: optional metrics to record the stalls in, by default the process' metrics
+        """
+        self.minhash_files = list(minhash_files)
+        self.depth = get_read_ahead() if depth is None else depth
+        self.max_bytes = max_bytes
+        self.metrics = metrics or get_metrics()
+
+    def _load(self, minhashfile: str) -> Tuple[List[Tuple], float]:
+        with self.metrics.timer("signature_load_seconds"):
+            minhash_list = load_minhash_file(minhashfile)
+        return minhash_list, perf_counter()
+
+    def __iter__(self) -> Iterator[Tuple[str, List[Tuple]]]:
+        if self.depth <= 0 or len(self.minhash_files) <= 1:
+            for minhashfile in self.minhash_files:
+                start = perf_counter()
+                minhash_list = load_minhash_file(minhashfile)
+                self.metrics.observe("signature_wait_seconds", perf_counter() - start)
+                yield minhashfile, minhash_list
+            return
+
+        budget = get_budget()
+        pending = deque()
+        pending_bytes = 0
+        i = 0
+        with ThreadPoolExecutor(self.depth, thread_name_prefix="signature-reader") as executor:
+
+            def fill():
+                nonlocal pending_bytes, i
+                while i < len(self.minhash_files) and len(pending) < self.depth:
+                    size = os.path.getsize(self.minhash_files[i])
+                    if pending and ((self.max_bytes is not None and pending_bytes + size > self.max_bytes) or
+                                    (budget is not None and budget.under_pressure())):
+                        break
+                    pending.append((self.minhash_files[i], size, executor.submit(self._load, self.minhash_files[i])))
+                    pending_bytes += size
+                    i += 1
+
+            try:
+                fill()
+                while pending:
+                    minhashfile, size, future = pending.popleft()
+                    start = perf_counter()
+                    minhash_list, loaded = future.result()
+                    self.metrics.observe("signature_wait_seconds", perf_counter() - start)
+                    self.metrics.observe("signature_idle_seconds", max(start - loaded, 0.0))
+                    pending_bytes -= size
+                    # the next files load while the consumer works on this one
+                    fill()
+                    self.metrics.gauge("signature_queue_depth", len(pending))
+                    yield minhashfile, minhash_list
+            finally:
+                # files that have not started loading are dropped if the consumer stops early
+                for _, _, future in pending:
+                    future.cancel()
+
+
+# signature files loaded ahead of the index, set once by the entry point
+_read_ahead = READ_AHEAD
+
+
+def get_read_ahead() -> int:
+    return _read_ahead
+
+
+def set_read_ahead(depth: int):
+    global _read_ahead
+    _read_ahead = depth
@@ -0,0 +1,177 @@
+from deduplication.minhash import MinHasher
+from deduplication.exact import ExactFilter, EXACT_SUFFIX
+from deduplication.output import OFFSETS_SUFFIX
+from deduplication.metrics import get_metrics
+from deduplication.memory import get_budget, pool_size
+from multiprocessing import Pool
+from typing import List, Optional
+import threading
+import shutil
+import os
+
+
+def dir_size(path: str) -> int:
+    """
+    Total size in bytes of the pickled minhash signatures in a directory
+    """
+    if not os.path.isdir(path):
+        return 0
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path) if f.endswith(".pkl"))
+
+
+class MinhashPrefetcher:
+    """
+    Computes minhash signatures for a sequence of corpora on a background thread, running ahead of a consumer
+    that indexes the corpora strictly in the order given. While corpus i is being inserted into the index
+    (which is mostly single-core) the process pool is busy hashing corpus i+1, i+2, ...
+
+    How far the hashing runs ahead is bounded by
+    - depth: the number of corpora hashed ahead of the one being indexed
+    - max_bytes: the total size of signature files that have been written but not yet indexed
+    - min_free_bytes: the free space to leave on the filesystem holding the signatures
+    The corpus the consumer is waiting for is never held back by the byte limits.
+    Signatures are written to disk and only one file's signatures are held in memory at a time,
+    so memory use does not grow with depth.
+
+    Example usage:
+    ```
+    with MinhashPrefetcher(input_dirs, minhash_dirs, num_perm=128, depth=2) as prefetcher:
+        for i in range(len(input_dirs)):
+            prefetcher.wait(i) # returns once corpus i has been hashed
+            index = LSHBloom(minhash_dirs[i], lsh_params)
+            index.deduplicate_corpus()
+            prefetcher.release(i) # corpus i no longer counts against the limits
+    ```
+    """
+    def __init__(
+        self,
+        input_dirs: List[str],
+        minhash_dirs: List[str],
+        num_perm: int = 128,
+        depth: int = 1,
+        max_bytes: Optional[int] = None,
+        min_free_bytes: int = 0,
+        skip: Optional[List[bool]] = None,
+        delete_released: bool = False,
+        exact: Optional[ExactFilter] = None,
+    ):
+        """
+        input_dirs: jsonl directories of the corpora, in the order they will be indexed
+        minhash_dirs: directories the signatures of each corpus are written to
+        num_perm: number of hash functions for minhashing
+        depth: maximum number of corpora hashed ahead of the corpus being indexed
+        max_bytes: maximum size of hashed but not yet indexed signatures, unbounded if None
+        min_free_bytes: stop running ahead when less than this much space is free in a minhash dir
+        skip: optional flag per corpus, corpora flagged are not hashed (e.g. already indexed by a resumed run)
+        delete_released: remove a corpus' signature files once it has been indexed
+        exact: optional exact filter shared by the whole run, see MinHasher
+        """
+        assert len(input_dirs) == len(minhash_dirs), \
+            f"Expected len(input_dirs) == len(minhash_dirs), got {len(input_dirs)}, {len(minhash_dirs)}"
+        self.input_dirs = input_dirs
+        self.minhash_dirs = minhash_dirs
+        self.num_perm = num_perm
+        self.depth = max(depth, 0)
+        self.max_bytes = max_bytes
+        self.min_free_bytes = min_free_bytes
+        self.skip = skip or [False] * len(input_dirs)
+        self.delete_released = delete_released
+        self.exact = exact
+
+        self.cond = threading.Condition()
+        self.hashed = set()
+        self.sizes = {}
+        self.current = 0
+        self.error = None
+        self.stopped = False
+        self.thread = None
+        self.pool = None
+        self.metrics = get_metrics()
+
+    def __enter__(self):
+        # workers are forked here on the calling thread, before the producer thread exists
+        self.pool = Pool(pool_size(32))
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.pool.terminate()
+
+    def _pending_bytes(self) -> int:
+        return sum(self.sizes.values())
+
+    def _record_depth(self):
+        # corpora hashed ahead of the index and the size of their signatures, both 0 means the index waits on hashing
+        self.metrics.gauge("prefetch_queue_depth", len(self.sizes))
+        self.metrics.gauge("prefetch_queue_bytes", self._pending_bytes())
+
+    def _may_start(self, j: int) -> bool:
+        if self.stopped or j <= self.current:
+            return True
+        if j > self.current + self.depth:
+            return False
+        if self.max_bytes is not None and self._pending_bytes() >= self.max_bytes:
+            return False
+        # close to the memory budget the index comes first, hashing ahead resumes once memory is freed
+        budget = get_budget()
+        if budget is not None and budget.under_pressure():
+            return False
+        os.makedirs(self.minhash_dirs[j], exist_ok=True)
+        if shutil.disk_usage(self.minhash_dirs[j]).free < self.min_free_bytes:
+            return False
+        return True
+
+    def _produce(self):
+        try:
+            for j in range(len(self.input_dirs)):
+                with self.cond:
+                    # free disk space is not signalled, so recheck periodically while blocked
+                    while not self._may_start(j):
+                        self.cond.wait(timeout=5)
+                    if self.stopped:
+                        return
+                if not self.skip[j]:
+                    m = MinHasher(self.input_dirs[j], self.minhash_dirs[j], self.num_perm, exact=self.exact)
+                    m.process(self.pool)
+                with self.cond:
+                    if j >= self.current and not self.skip[j]:
+                        self.sizes[j] = dir_size(self.minhash_dirs[j])
+                    self.hashed.add(j)
+                    self._record_depth()
+                    self.cond.notify_all()
+        except BaseException as e:
+            with self.cond:
+                self.error = e
+                self.cond.notify_all()
+
+    def wait(self, i: int):
+        """
+        Block until corpus i has been hashed, corpus i becomes the one being indexed
+        """
+        with self.cond:
+            self.current = max(self.current, i)
+            self.cond.notify_all()
+            while i not in self.hashed:
+                if self.error is not None:
+                    raise self.error
+                self.cond.wait()
+
+    def release(self, i: int):
+        """
+        Mark corpus i as indexed so that its signatures no longer count against the prefetch limits
+        """
+        with self.cond:
+            self.sizes.pop(i, None)
+            self.current = max(self.current, i + 1)
+            self._record_depth()
+            self.cond.notify_all()
+        if self.delete_released and not self.skip[i]:
+            # the signatures along with everything saved next to them
+            for f in os.listdir(self.minhash_dirs[i]):
+                if f.endswith((".pkl", EXACT_SUFFIX, OFFSETS_SUFFIX)):
+                    os.remove(os.path.join(self.minhash_dirs[i], f))
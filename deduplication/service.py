@@ -0,0 +1,609 @@
+"""
+Deduplication daemon: keeps an LSHIndex or LSHBloom index loaded and checks batches of documents against it
+(optionally inserting the new ones) for any number of local clients, over a Unix domain socket.
+
+    python -m deduplication.service serve --socket /run/dedup.sock --mode bloom --save-dir ./project/index/ -n 1600000
+    python -m deduplication.service submit --socket /run/dedup.sock --name daily --input drop/*.jsonl --insert --output-file daily.csv
+
+Only the server imports datasketch and the index modules, so submitting a batch costs a connection and a round trip.
+"""
+from typing import List, Dict, Optional, Tuple
+from multiprocessing import Pool
+import threading
+import argparse
+import logging
+import socket
+import struct
+import signal
+import queue
+import time
+import json
+import os
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# every frame starts with this header: magic, op (requests) or status (responses), payload kind, num_perm,
+# number of documents and payload length
+MAGIC = b"DDS1"
+HEADER = struct.Struct("<4sBBHII")
+
+# requests
+CHECK = 1
+CHECK_INSERT = 2
+STATS = 3
+SHUTDOWN = 4
+
+# payload kinds of check requests: signatures (keys, then count x num_perm uint64 hashvalues) or texts (keys, then texts)
+SIGNATURES = 0
+TEXTS = 1
+
+# response status
+OK = 0
+ERROR = 1
+
+# per document verdicts in a check response
+NEW = 0
+DUPLICATE = 1
+EMPTY = 2
+
+# texts are minhashed on the worker pool once a request holds at least this many
+POOL_MIN_TEXTS = 256
+
+
+def encode_strings(values: List[str]) -> bytes:
+    """
+    uint32 byte length of every string followed by the utf8 bytes of all of them
+    """
+    data = [v.encode("utf8") for v in values]
+    return np.array([len(d) for d in data], dtype=np.uint32).tobytes() + b"".join(data)
+
+
+def decode_strings(payload: bytes, offset: int, count: int) -> Tuple[List[str], int]:
+    """
+    Inverse of encode_strings for count strings starting at offset, returns the strings and the offset after them
+    """
+    lengths = np.frombuffer(payload, dtype=np.uint32, count=count, offset=offset).tolist()
+    offset += 4 * count
+    values = []
+    for n in lengths:
+        values.append(payload[offset:offset + n].decode("utf8"))
+        offset += n
+    return values, offset
+
+
+def recv_exact(sock: socket.socket, n: int) -> bytes:
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        k = sock.recv_into(view[got:])
+        if k == 0:
+            raise ConnectionError("Connection closed in the middle of a frame")
+        got += k
+    return bytes(buf)
+
+
+def send_frame(sock: socket.socket, code: int, kind: int, num_perm: int, count: int, payload: bytes = b""):
+    sock.sendall(HEADER.pack(MAGIC, code, kind, num_perm, count, len(payload)) + payload)
+
+
+def recv_frame(sock: socket.socket) -> Optional[Tuple[int, int, int, int, bytes]]:
+    """
+    Next frame from the socket as (code, kind, num_perm, count, payload), None if the peer closed the connection
+    """
+    first = sock.recv(HEADER.size)
+    if not first:
+        return None
+    header = first + (recv_exact(sock, HEADER.size - len(first)) if len(first) < HEADER.size else b"")
+    magic, code, kind, num_perm, count, length = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ConnectionError(f"Not a deduplication service frame: {magic!r}")
+    return code, kind, num_perm, count, recv_exact(sock, length) if length else b""
+
+
+def text_signatures(texts: List[str], num_perm: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Minhash signatures of texts, tokenized and hashed exactly as MinHasher does
+
+    returns a tuple (hashvalues, empty), hashvalues an array of shape (len(texts), num_perm) and empty a mask of the
+    texts without tokens, which get no signature
+    """
+    from datasketch import MinHash
+    hashvalues = np.zeros((len(texts), num_perm), dtype=np.uint64)
+    empty = np.zeros(len(texts), dtype=bool)
+    for i, text in enumerate(texts):
+        tokens = set(text.split())
+        if not tokens:
+            empty[i] = True
+            continue
+        m = MinHash(num_perm=num_perm)
+        m.update_batch([t.encode("utf8") for t in tokens])
+        hashvalues[i] = m.hashvalues
+    return hashvalues, empty
+
+
+def _text_signatures(params: Tuple[List[str], int]) -> Tuple[np.ndarray, np.ndarray]:
+    return text_signatures(*params)
+
+
+class _Job:
+    __slots__ = ("insert", "keys", "hashvalues", "empty", "flags", "dup_keys", "error", "done")
+
+    def __init__(self, insert: bool, keys: List[str], hashvalues: np.ndarray, empty: np.ndarray):
+        self.insert = insert
+        self.keys = keys
+        self.hashvalues = hashvalues
+        self.empty = empty
+        self.flags = None
+        self.dup_keys = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class DedupService:
+    """
+    Serves check and check-and-insert requests against one index over a Unix domain socket.
+
+    Every client connection has its own thread that decodes requests (and minhashes texts, on a shared worker pool
+    for large requests), while a single index thread owns the index: it takes all requests that are waiting,
+    up to max_batch documents, and processes them in arrival order as one batch. Documents in a batch are therefore
+    checked against each other as well as against the index, exactly as if they had been deduplicated one after
+    the other. For a Bloom index the band hashes of a whole batch are computed at once, and inserts are synced to
+    disk every sync_interval seconds and on shutdown.
+
+    Example usage:
+    ```
+    index = LSHBloom(None, lsh_params)
+    DedupService(index, "/run/dedup.sock", num_perm=128).serve_forever()
+    ```
+    """
+    def __init__(self, index, socket_path: str, num_perm: int = 128, num_workers: int = 1, max_batch: int = 65536, sync_interval: float = 10.0):
+        """
+        index: LSHIndex or LSHBloom (possibly read-only, then only check requests are accepted)
+        socket_path: path of the Unix domain socket to listen on
+        num_perm: number of permutations of the index, requests with other signatures are rejected
+        num_workers: size of the pool texts are minhashed on
+        max_batch: largest number of documents the index thread processes as one batch
+        sync_interval: seconds between syncs of a Bloom index to disk
+        """
+        from datasketch import MinHash
+        from deduplication.lshbloom import LSHBloom
+        from deduplication.multithreshold import bloom_band_hashes
+        from deduplication.memory import pool_size
+        from deduplication.metrics import get_metrics
+
+        self.index = index
+        self.bloom = isinstance(index, LSHBloom)
+        self.read_only = self.bloom and index.read_only
+        self._band_hashes = bloom_band_hashes
+        self.socket_path = socket_path
+        self.num_perm = num_perm
+        self.max_batch = max_batch
+        self.sync_interval = sync_interval
+        self.metrics = get_metrics()
+        # signatures are rebuilt around the hashvalues of a request, sharing one set of permutations
+        self.template = MinHash(num_perm=num_perm)
+        self.jobs = queue.Queue()
+        self.stopped = threading.Event()
+        self.stats = {"requests": 0, "batches": 0, "documents": 0, "duplicates": 0, "inserted": 0, "clients": 0}
+        self.started = time.time()
+        # forked before any thread is started
+        self.num_workers = pool_size(num_workers)
+        self.pool = Pool(self.num_workers) if self.num_workers > 1 else None
+        self.sock = None
+
+    def _listen(self):
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except OSError:
+                # left behind by a server that did not shut down cleanly
+                os.remove(self.socket_path)
+            else:
+                raise RuntimeError(f"Another deduplication service is already listening on {self.socket_path}")
+            finally:
+                probe.close()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.socket_path)
+        self.sock.listen(64)
+        # woken up regularly to notice a shutdown
+        self.sock.settimeout(0.5)
+
+    def serve_forever(self):
+        """
+        Accept clients until a shutdown request, SIGTERM or SIGINT, then finish the queued work and sync the index
+        """
+        self._listen()
+        index_thread = threading.Thread(target=self._run_index, daemon=True)
+        index_thread.start()
+        if threading.current_thread() is threading.main_thread():
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(sig, lambda *_: self.stopped.set())
+        logger.info(f"Serving {'Bloom' if self.bloom else 'LSH'} index on {self.socket_path}")
+        try:
+            while not self.stopped.is_set():
+                try:
+                    conn, _ = self.sock.accept()
+                except socket.timeout:
+                    continue
+                except OSError:
+                    if self.stopped.is_set():
+                        break
+                    raise
+                conn.settimeout(None)
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            self.stopped.set()
+            index_thread.join()
+            self.sock.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            if self.pool is not None:
+                self.pool.terminate()
+            logger.info(f"Stopped after {self.stats['documents']:,} documents in {self.stats['requests']:,} requests")
+
+    def shutdown(self):
+        self.stopped.set()
+
+    def _handle(self, conn: socket.socket):
+        self.stats["clients"] += 1
+        try:
+            with conn:
+                while True:
+                    frame = recv_frame(conn)
+                    if frame is None:
+                        return
+                    op, kind, num_perm, count, payload = frame
+                    try:
+                        if op in (CHECK, CHECK_INSERT):
+                            flags, dup_keys = self._check(op == CHECK_INSERT, kind, num_perm, count, payload)
+                            send_frame(conn, OK, kind, self.num_perm, count, flags.tobytes() + encode_strings(dup_keys))
+                        elif op == STATS:
+                            send_frame(conn, OK, 0, self.num_perm, 0, json.dumps(self.describe()).encode("utf8"))
+                        elif op == SHUTDOWN:
+                            send_frame(conn, OK, 0, self.num_perm, 0)
+                            self.stopped.set()
+                            return
+                        else:
+                            raise ValueError(f"Unknown request {op}")
+                    except (ValueError, RuntimeError) as e:
+                        send_frame(conn, ERROR, kind, self.num_perm, 0, str(e).encode("utf8"))
+        except (ConnectionError, OSError) as e:
+            logger.warning(f"Dropped client: {e}")
+        finally:
+            self.stats["clients"] -= 1
+
+    def describe(self) -> Dict:
+        return dict(self.stats, kind="bloom" if self.bloom else "lsh", read_only=self.read_only, num_perm=self.num_perm,
+                    uptime=time.time() - self.started, queued=self.jobs.qsize())
+
+    def _check(self, insert: bool, kind: int, num_perm: int, count: int, payload: bytes) -> Tuple[np.ndarray, List[str]]:
+        if insert and self.read_only:
+            raise ValueError("The index is served read-only, only check requests are accepted")
+        keys, offset = decode_strings(payload, 0, count)
+        if kind == SIGNATURES:
+            if num_perm != self.num_perm:
+                raise ValueError(f"Signatures have {num_perm} permutations, the index expects {self.num_perm}")
+            hashvalues = np.frombuffer(payload, dtype=np.uint64, count=count * num_perm, offset=offset).reshape(count, num_perm)
+            empty = np.zeros(count, dtype=bool)
+        elif kind == TEXTS:
+            texts, _ = decode_strings(payload, offset, count)
+            hashvalues, empty = self._minhash(texts)
+        else:
+            raise ValueError(f"Unknown payload kind {kind}")
+        job = _Job(insert, keys, hashvalues, empty)
+        self.jobs.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise RuntimeError(job.error)
+        return job.flags, job.dup_keys
+
+    def _minhash(self, texts: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        if self.pool is None or len(texts) < POOL_MIN_TEXTS:
+            return text_signatures(texts, self.num_perm)
+        size = -(-len(texts) // (4 * self.num_workers))
+        parts = self.pool.map(_text_signatures, [(texts[i:i + size], self.num_perm) for i in range(0, len(texts), size)])
+        return np.concatenate([h for h, _ in parts]), np.concatenate([e for _, e in parts])
+
+    def _run_index(self):
+        last_sync = time.monotonic()
+        dirty = False
+        while True:
+            try:
+                jobs = [self.jobs.get(timeout=0.5)]
+            except queue.Empty:
+                jobs = []
+            # everything that is already waiting joins the batch
+            n = sum(len(job.keys) for job in jobs)
+            while jobs and n < self.max_batch:
+                try:
+                    job = self.jobs.get_nowait()
+                except queue.Empty:
+                    break
+                jobs.append(job)
+                n += len(job.keys)
+            if jobs:
+                with self.metrics.timer("service_batch_seconds"):
+                    self._process(jobs)
+                dirty |= any(job.insert for job in jobs)
+            if self.bloom and dirty and (self.stopped.is_set() or time.monotonic() - last_sync >= self.sync_interval):
+                for table in self.index.lsh.hashtables:
+                    table.bloom_filter.sync()
+                last_sync, dirty = time.monotonic(), False
+            if not jobs and self.stopped.is_set() and self.jobs.empty():
+                return
+
+    def _process(self, jobs: List[_Job]):
+        self.stats["batches"] += 1
+        try:
+            if self.bloom:
+                self._process_bloom(jobs)
+            else:
+                self._process_lsh(jobs)
+        except Exception as e:
+            logger.exception("Batch failed")
+            for job in jobs:
+                job.error = f"{type(e).__name__}: {e}"
+        for job in jobs:
+            self.stats["requests"] += 1
+            self.stats["documents"] += len(job.keys)
+            if job.flags is not None:
+                self.stats["duplicates"] += int(np.count_nonzero(job.flags == DUPLICATE))
+            job.done.set()
+
+    def _process_bloom(self, jobs: List[_Job]):
+        hashvalues = np.concatenate([job.hashvalues for job in jobs]) if len(jobs) > 1 else jobs[0].hashvalues
+        band_hashes = self._band_hashes(hashvalues, [self.index.lsh.hashranges])[0].tolist()
+        tables = [table.bloom_filter for table in self.index.lsh.hashtables]
+        i = 0
+        for job in jobs:
+            flags = np.full(len(job.keys), NEW, dtype=np.uint8)
+            for j in range(len(job.keys)):
+                hashes = band_hashes[i + j]
+                if job.empty[j]:
+                    flags[j] = EMPTY
+                elif any(H in table for H, table in zip(hashes, tables)):
+                    flags[j] = DUPLICATE
+                elif job.insert:
+                    for H, table in zip(hashes, tables):
+                        table.add(H)
+                    self.stats["inserted"] += 1
+            i += len(job.keys)
+            job.flags, job.dup_keys = flags, []
+
+    def _process_lsh(self, jobs: List[_Job]):
+        from datasketch import MinHash
+        for job in jobs:
+            flags = np.full(len(job.keys), NEW, dtype=np.uint8)
+            dup_keys = [""] * len(job.keys)
+            for j, key in enumerate(job.keys):
+                if job.empty[j]:
+                    flags[j] = EMPTY
+                    continue
+                m = MinHash(num_perm=self.num_perm, hashvalues=job.hashvalues[j], permutations=self.template.permutations, scheme=self.template.scheme)
+                # a document sent again under its own key is not its own duplicate
+                matches = [dup for dup in self.index.lsh.query(m) if dup != key]
+                if matches:
+                    flags[j] = DUPLICATE
+                    dup_keys[j] = matches[0]
+                elif job.insert:
+                    self.index.lsh.insert(key, m, check_duplication=False)
+                    self.stats["inserted"] += 1
+            job.flags, job.dup_keys = flags, dup_keys
+
+
+class DedupClient:
+    """
+    Client of a DedupService, one connection that can be used for any number of requests
+
+    Example usage:
+    ```
+    with DedupClient("/run/dedup.sock") as client:
+        flags, dup_keys = client.check(keys, texts=texts, insert=True) # flags[i] is NEW, DUPLICATE or EMPTY
+    ```
+    """
+    def __init__(self, socket_path: str, timeout: Optional[float] = None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(socket_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.sock.close()
+
+    def _request(self, op: int, kind: int = 0, num_perm: int = 0, count: int = 0, payload: bytes = b"") -> Tuple[int, int, bytes]:
+        send_frame(self.sock, op, kind, num_perm, count, payload)
+        frame = recv_frame(self.sock)
+        if frame is None:
+            raise ConnectionError("The deduplication service closed the connection")
+        status, _, num_perm, count, payload = frame
+        if status != OK:
+            raise RuntimeError(payload.decode("utf8"))
+        return num_perm, count, payload
+
+    def check(self, keys: List[str], hashvalues: Optional[np.ndarray] = None, texts: Optional[List[str]] = None, insert: bool = False) -> Tuple[np.ndarray, List[str]]:
+        """
+        Check documents against the index, given either their signatures or their texts
+
+        keys - document keys, stored in an LSH index for the documents that are inserted
+        hashvalues - array of shape (len(keys), num_perm) with the documents' minhash signatures
+        texts - document texts, minhashed by the service
+        insert - whether to insert the documents without a duplicate into the index
+
+        returns a tuple (flags, dup_keys), flags an array with NEW, DUPLICATE or EMPTY (no tokens) for every document,
+        dup_keys the key of an indexed duplicate of every document (LSH index only, empty otherwise)
+        """
+        op = CHECK_INSERT if insert else CHECK
+        if texts is not None:
+            num_perm, count, payload = self._request(op, TEXTS, 0, len(keys), encode_strings(keys) + encode_strings(texts))
+        else:
+            hashvalues = np.ascontiguousarray(hashvalues, dtype=np.uint64)
+            num_perm, count, payload = self._request(op, SIGNATURES, hashvalues.shape[1], len(keys), encode_strings(keys) + hashvalues.tobytes())
+        flags = np.frombuffer(payload, dtype=np.uint8, count=count)
+        dup_keys, _ = decode_strings(payload, count, count) if len(payload) > count else ([], count)
+        return flags, dup_keys
+
+    def stats(self) -> Dict:
+        _, _, payload = self._request(STATS)
+        return json.loads(payload)
+
+    def shutdown(self):
+        self._request(SHUTDOWN)
+
+
+def read_batches(path: str, batch_size: int):
+    """
+    Documents of an input file in batches, as (keys, hashvalues, texts) tuples with either hashvalues or texts set
+
+    jsonl files yield texts keyed like MinHasher does, <file name>-<line number>
+    .pkl minhash files yield their stored keys and signatures (this needs datasketch to unpickle)
+    .npy signature arrays yield their rows, keyed <file name>-<row number>
+    """
+    fname = os.path.basename(path)
+    if path.endswith(".pkl"):
+        import pickle
+        with open(path, "rb") as fin:
+            minhash_list = pickle.load(fin)
+        for start in range(0, len(minhash_list), batch_size):
+            batch = minhash_list[start:start + batch_size]
+            yield [key for key, _ in batch], np.stack([m.hashvalues for _, m in batch]), None
+    elif path.endswith(".npy"):
+        signatures = np.load(path, mmap_mode="r")
+        stem = fname[:-len(".sig.npy")] if fname.endswith(".sig.npy") else fname[:-len(".npy")]
+        for start in range(0, len(signatures), batch_size):
+            rows = signatures[start:start + batch_size]
+            yield [f"{stem}-{start + i + 1}" for i in range(len(rows))], np.asarray(rows, dtype=np.uint64), None
+    else:
+        keys, texts = [], []
+        with open(path, "rb") as fin:
+            for lineNo, line in enumerate(fin, 1):
+                keys.append(f"{fname}-{lineNo}")
+                texts.append(json.loads(line).get("text", ""))
+                if len(keys) >= batch_size:
+                    yield keys, None, texts
+                    keys, texts = [], []
+        if keys:
+            yield keys, None, texts
+
+
+def open_index(mode: str, threshold: float, num_perm: int, save_dir: Optional[str], n: Optional[int], fp: float,
+               redis_port: int, redis_name: bytes, read_only: bool, plan_file: Optional[str]):
+    """
+    The index to serve, opened with the same parameters (and stored plan) the workflows use
+    """
+    from deduplication.planner import PLAN_NAME, apply_plan, load_plan
+    if mode == "bloom":
+        from deduplication.lshbloom import LSHBloom
+        assert save_dir, "A Bloom index needs --save-dir"
+        assert read_only or n, "Creating or extending a Bloom index needs the expected number of documents (-n)"
+        lsh_params = {"threshold": threshold, "num_perm": num_perm, "n": n, "fp": fp, "save_dir": save_dir}
+        plan = load_plan(plan_file or os.path.join(save_dir, PLAN_NAME))
+        return LSHBloom(None, apply_plan(lsh_params, plan), read_only=read_only)
+    from deduplication.lsh import LSHIndex
+    lsh_params = {
+        "threshold": threshold,
+        "num_perm": num_perm,
+        "storage_config": {
+            "type": "redis",
+            "basename": redis_name,
+            "redis": {"host": "localhost", "port": redis_port},
+        },
+    }
+    plan = None
+    if plan_file or save_dir:
+        # the plan the index was created with, kept next to the output file of the run that created it
+        from deduplication.workflows import lsh_index_plan
+        assert not plan_file or os.path.exists(plan_file), f"--plan-file {plan_file} does not exist"
+        plan = lsh_index_plan(plan_file or os.path.join(save_dir, PLAN_NAME), threshold, num_perm)
+    if plan is None:
+        logger.warning("Serving the Redis index with the default band layout for the threshold, which does not match an index created with --auto-tune")
+    return LSHIndex(None, apply_plan(lsh_params, plan))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Deduplication service that keeps an index loaded and checks documents against it over a Unix domain socket",
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--socket", help="Path of the service's Unix domain socket", required=True)
+    parser.add_argument("--log-level", help="Level of the log messages to print. Default is INFO", default="INFO")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve = commands.add_parser("serve", help="Load an index and serve requests until stopped")
+    serve.add_argument("--mode", help="Index to serve, lsh (Redis) or bloom. Default is bloom", choices=["lsh", "bloom"], default="bloom")
+    serve.add_argument("--sim-threshold", help="Jaccard similarity threshold of the index. Default is 0.8", type=float, default=0.8)
+    serve.add_argument("--num-perm", help="Number of hash functions for MinHashing. Default is 128", type=int, default=128)
+    serve.add_argument("--save-dir", help="<Bloom mode> Directory of the Bloom filters, created if they do not exist. <LSH mode> Directory of the output file of the runs that built the index, whose plan.json gives the band layout", default=None)
+    serve.add_argument("-n", "--num", help="<Bloom mode> Expected number of documents in the index, to size new filters", type=int, default=None)
+    serve.add_argument("--fp", help="<Bloom mode> False positive rate of each Bloom filter. Default is 0.001", type=float, default=0.001)
+    serve.add_argument("--redis_port", help="<LSH mode> Port of the Redis server holding the index. Default is 6379", type=int, default=6379)
+    serve.add_argument("--redis-name", help="<LSH mode> Basename of the index in Redis. Default is tpc, as in the workflows", default="tpc")
+    serve.add_argument("--plan-file", help="Index plan to apply (see --auto-tune), by default the plan.json stored in save-dir", default=None)
+    serve.add_argument("--read-only", help="<Bloom mode> Open the filters read-only and only accept check requests", action="store_true")
+    serve.add_argument("--num-workers", help="Number of processes to minhash submitted texts on. Default is 1", type=int, default=1)
+    serve.add_argument("--max-batch", help="Largest number of documents processed as one batch. Default is 65536", type=int, default=65536)
+    serve.add_argument("--sync-interval", help="<Bloom mode> Seconds between syncs of inserted documents to disk. Default is 10", type=float, default=10)
+
+    submit = commands.add_parser("submit", help="Check input files against the served index")
+    submit.add_argument("--input", help="jsonl files, minhash files (.pkl) or signature arrays (.npy) to check", nargs="+", required=True)
+    submit.add_argument("--name", help="Name of the corpus, the first column of the output", required=True)
+    submit.add_argument("--output-file", help="Where the duplicates are appended, as csv or, if it ends in .dups, in binary. Default is not to write them", default=None)
+    submit.add_argument("--insert", help="Insert the documents without a duplicate into the index", action="store_true")
+    submit.add_argument("--batch-size", help="Documents per request. Default is 10000", type=int, default=10000)
+
+    commands.add_parser("stats", help="Print the service's counters")
+    commands.add_parser("stop", help="Stop the service once the queued requests are done")
+    return parser.parse_args()
+
+
+def submit(args):
+    # the writer is a light import, it does not pull in datasketch
+    from deduplication.writers import DuplicateWriter
+    with DedupClient(args.socket) as client:
+        bloom = client.stats()["kind"] == "bloom"
+        writer = None
+        if args.output_file:
+            writer = DuplicateWriter(args.output_file, args.name, header=["dup_key"] if bloom else ["corpus", "key", "dup_key"])
+        start, checked, found, empty = time.perf_counter(), 0, 0, 0
+        try:
+            for path in args.input:
+                for keys, hashvalues, texts in read_batches(path, args.batch_size):
+                    flags, dup_keys = client.check(keys, hashvalues, texts, insert=args.insert)
+                    checked += len(keys)
+                    empty += int(np.count_nonzero(flags == EMPTY))
+                    for i in np.flatnonzero(flags == DUPLICATE).tolist():
+                        found += 1
+                        if writer is not None:
+                            writer.append((keys[i],) if bloom else (keys[i], dup_keys[i]))
+        finally:
+            if writer is not None:
+                writer.close()
+        logger.info(f"Checked {checked:,} documents in {time.perf_counter() - start:.3f}s, {found:,} duplicates" + (f", {empty:,} without text" if empty else ""))
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(message)s")
+    if args.command == "serve":
+        index = open_index(args.mode, args.sim_threshold, args.num_perm, args.save_dir, args.num, args.fp,
+                           args.redis_port, args.redis_name.encode(), args.read_only, args.plan_file)
+        DedupService(index, args.socket, args.num_perm, args.num_workers, args.max_batch, args.sync_interval).serve_forever()
+    elif args.command == "submit":
+        submit(args)
+    elif args.command == "stats":
+        with DedupClient(args.socket) as client:
+            print(json.dumps(client.stats(), indent=2))
+    else:
+        with DedupClient(args.socket) as client:
+            client.shutdown()
+
+
+if __name__ == "__main__":
+    main()
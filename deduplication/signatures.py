@@ -0,0 +1,184 @@
+from deduplication.clustering import key_hash
+from typing import List, Tuple, Optional, Iterable
+import numpy as np
+import re
+import os
+
+SIG_SUFFIX = ".sig.npy"
+KEYS_SUFFIX = ".keys.npy"
+
+
+def signature_matrix(minhash_list: List[Tuple]) -> np.ndarray:
+    """
+    Stack the hashvalues of a list of (key, minhash) tuples into an array of shape (n_docs, num_perm),
+    stored as uint32 when the values fit (as they do for datasketch's default hash) to halve the size
+    """
+    if not minhash_list:
+        return np.empty((0, 0), dtype=np.uint32)
+    hashvalues = np.stack([m.hashvalues for _, m in minhash_list])
+    if hashvalues.max() <= np.iinfo(np.uint32).max:
+        return hashvalues.astype(np.uint32)
+    return hashvalues
+
+
+def jaccard(a: Iterable[str], b: Iterable[str]) -> float:
+    """
+    Jaccard similarity of the token sets of two documents, the similarity the signatures estimate
+    """
+    a, b = set(a), set(b)
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+def estimate_jaccard(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Estimated Jaccard similarity of every pair of rows a[i], b[i], the fraction of equal hashvalues
+    """
+    if not len(a):
+        return np.empty(0, dtype=np.float64)
+    return np.count_nonzero(a == b, axis=1) / a.shape[1]
+
+
+def gather(signatures: List[np.ndarray], files: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """
+    Collect rows from several (memory-mapped) signature arrays, one fancy-indexing read per file involved
+
+    signatures - signature arrays by file id
+    files, rows - file id and row of every signature to collect
+
+    returns an array of shape (len(rows), num_perm)
+    """
+    num_perm = next((s.shape[1] for s in signatures if s.ndim == 2 and s.shape[0]), 0)
+    out = np.empty((len(rows), num_perm), dtype=np.uint64)
+    if not len(rows):
+        return out
+    order = np.argsort(files, kind="stable")
+    files_sorted = files[order]
+    bounds = np.flatnonzero(np.diff(files_sorted)) + 1
+    for group in np.split(order, bounds):
+        f = int(files[group[0]])
+        # sorted rows keep the reads on a memory-mapped file sequential
+        group = group[np.argsort(rows[group], kind="stable")]
+        out[group] = signatures[f][rows[group]]
+    return out
+
+
+class SignatureStore:
+    """
+    Persistent store of minhash signatures that can be looked up by document key, used to verify LSH candidates.
+
+    Every signature file added to the store is kept as two numpy arrays in store_dir, <name>.sig.npy with the
+    hashvalues and <name>.keys.npy with the 64-bit hashes of the document keys. Signatures are memory-mapped,
+    and only the sorted key index is held in memory (16 bytes per document).
+
+    Example usage:
+    ```
+    store = SignatureStore(store_dir)
+    store.add("part0", minhash_list)
+    sims = store.similarity(minhash.hashvalues, candidate_keys) # estimated Jaccard against each candidate
+    ```
+    """
+    def __init__(self, store_dir: str):
+        """
+        store_dir: directory of the store, created if missing, signatures already in it are loaded
+        """
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+        self.names: List[Optional[str]] = []
+        self.signatures: List[np.ndarray] = []
+        # sorted key index, kept as one large segment plus a few small recent ones that are merged in periodically
+        self.segments: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+
+        for f in sorted(os.listdir(store_dir)):
+            if f.endswith(KEYS_SUFFIX) and os.path.exists(os.path.join(store_dir, f[:-len(KEYS_SUFFIX)] + SIG_SUFFIX)):
+                self._open(f[:-len(KEYS_SUFFIX)])
+        self._merge_segments()
+
+    def _open(self, name: str):
+        file_id = len(self.names)
+        keys = np.load(os.path.join(self.store_dir, name + KEYS_SUFFIX))
+        self.names.append(name)
+        self.signatures.append(np.load(os.path.join(self.store_dir, name + SIG_SUFFIX), mmap_mode="r"))
+        order = np.argsort(keys, kind="stable")
+        self.segments.append((keys[order], np.full(len(keys), file_id, dtype=np.uint32), order.astype(np.uint32)))
+
+    def _merge_segments(self):
+        if len(self.segments) <= 1:
+            return
+        keys, files, rows = (np.concatenate(parts) for parts in zip(*self.segments))
+        order = np.argsort(keys, kind="stable")
+        self.segments = [(keys[order], files[order], rows[order])]
+
+    def add(self, name: str, minhash_list: List[Tuple]):
+        """
+        Add the signatures of one file, replacing any earlier version stored under the same name
+
+        name - unique name of the file in the store, e.g. the path of the signature file without extension (any
+        character other than letters, digits, "." and "-" is replaced)
+        minhash_list - list of (key, minhash) tuples
+        """
+        name = re.sub(r"[^\w.-]", "_", name)
+        if name in self.names:
+            # the old arrays stay mapped, their index entries are simply dropped
+            file_id = self.names.index(name)
+            self.segments = [(k[f != file_id], f[f != file_id], r[f != file_id]) for k, f, r in self.segments]
+            self.names[file_id] = None
+        keys = np.array([key_hash(key) for key, _ in minhash_list], dtype=np.uint64)
+        for suffix, arr in ((SIG_SUFFIX, signature_matrix(minhash_list)), (KEYS_SUFFIX, keys)):
+            path = os.path.join(self.store_dir, name + suffix)
+            with open(f"{path}.tmp{os.getpid()}", "wb") as fout:
+                np.save(fout, arr)
+            os.replace(f"{path}.tmp{os.getpid()}", path)
+        self._open(name)
+        # merge small segments into the large one once they add up to a tenth of it
+        if len(self.segments) > 2 and sum(len(s[0]) for s in self.segments[1:]) * 10 > len(self.segments[0][0]):
+            self._merge_segments()
+
+    def lookup(self, keys: List[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Locate documents by key
+
+        returns arrays (found, files, rows) with the file id and row of every key found in the store
+        """
+        ids = np.array([key_hash(key) for key in keys], dtype=np.uint64)
+        found = np.zeros(len(ids), dtype=bool)
+        files = np.zeros(len(ids), dtype=np.uint32)
+        rows = np.zeros(len(ids), dtype=np.uint32)
+        # later segments hold newer versions, so they take precedence
+        for seg_keys, seg_files, seg_rows in self.segments:
+            if not len(seg_keys):
+                continue
+            pos = np.minimum(np.searchsorted(seg_keys, ids), len(seg_keys) - 1)
+            hit = seg_keys[pos] == ids
+            found |= hit
+            files[hit], rows[hit] = seg_files[pos[hit]], seg_rows[pos[hit]]
+        return found, files, rows
+
+    def get(self, keys: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        returns a tuple (found, signatures), rows of keys that are not in the store are zero
+        """
+        found, files, rows = self.lookup(keys)
+        sigs = gather(self.signatures, files[found], rows[found])
+        out = np.zeros((len(keys), sigs.shape[1]), dtype=np.uint64)
+        out[found] = sigs
+        return found, out
+
+    def similarity(self, hashvalues: np.ndarray, keys: List[str]) -> np.ndarray:
+        """
+        Estimated Jaccard similarity of one signature to each of the documents in keys, NaN for keys not in the store
+        """
+        found, sigs = self.get(keys)
+        sims = np.full(len(keys), np.nan)
+        sims[found] = estimate_jaccard(sigs[found], np.broadcast_to(hashvalues, sigs[found].shape))
+        return sims
+
+    def verify_pairs(self, keys: List[str], dup_keys: List[str]) -> np.ndarray:
+        """
+        Estimated Jaccard similarity of a whole batch of (key, dup_key) pairs, NaN where either key is not in the store
+        """
+        found_a, sigs_a = self.get(keys)
+        found_b, sigs_b = self.get(dup_keys)
+        found = found_a & found_b
+        sims = np.full(len(keys), np.nan)
+        sims[found] = estimate_jaccard(sigs_a[found], sigs_b[found])
+        return sims
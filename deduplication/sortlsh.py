@@ -0,0 +1,438 @@
+from tqdm.autonotebook import tqdm
+from multiprocessing import Pool
+from datasketch.lsh import _optimal_param
+from deduplication.signatures import signature_matrix, gather, estimate_jaccard
+from deduplication.memory import pool_size
+from collections import OrderedDict, deque
+from typing import List, Tuple, Dict, Iterator, Optional, Callable
+import numpy as np
+import tempfile
+import resource
+import shutil
+import pickle
+import math
+import os
+
+# one record per (document, band): a 64-bit hash of the band id and the band's hashvalues, and the global doc id
+RECORD = np.dtype([("hash", "<u8"), ("doc", "<u8")])
+# one record per duplicate: the duplicate doc id and the id of the earlier document it collided with
+PAIR = np.dtype([("doc", "<u8"), ("first", "<u8")])
+
+# with verify, every document is checked against up to this many of the earliest documents of each band it shares,
+# so that a run of a band hash shared by very many documents does not produce a quadratic number of pairs
+VERIFY_DEPTH = 16
+
+# file descriptors left to the rest of the process (signature files, pool pipes) besides the spill files, plus per worker
+_RESERVED_FILES = 64
+_RESERVED_FILES_PER_WORKER = 4
+
+_PRIME = np.uint64(0x100000001B3)
+_MIX1 = np.uint64(0xFF51AFD7ED558CCD)
+_MIX2 = np.uint64(0xC4CEB9FE1A85EC53)
+
+
+def band_hashes(hashvalues: np.ndarray, b: int, r: int) -> np.ndarray:
+    """
+    Hash every band of a batch of signatures to a single 64-bit value, the band id is mixed in
+    so that equal values in different bands do not collide
+
+    hashvalues - array of shape (n_docs, num_perm)
+
+    returns an array of shape (n_docs, b)
+    """
+    hashvalues = hashvalues.astype(np.uint64, copy=False)
+    out = np.empty((hashvalues.shape[0], b), dtype=np.uint64)
+    for i in range(b):
+        h = np.full(hashvalues.shape[0], i + 1, dtype=np.uint64) * _MIX1
+        for j in range(i * r, (i + 1) * r):
+            h ^= hashvalues[:, j]
+            h *= _PRIME
+        # finalizer so that the low bits used for partitioning are well mixed
+        h ^= h >> np.uint64(33)
+        h *= _MIX2
+        h ^= h >> np.uint64(33)
+        out[:, i] = h
+    return out
+
+
+def _emit(params: Tuple) -> Tuple[int, List[str], List[np.ndarray]]:
+    """
+    Load one signature file and compute its band records, split by partition
+
+    params - tuple (file_idx, minhashfile, b, r, n_partitions, sig_path) where sig_path is None or a path
+    to save the file's signature matrix to, for verification
+
+    returns a tuple (file_idx, keys, records, bounds) where records[bounds[p]:bounds[p + 1]] are the records
+    of partition p, doc ids are numbered from 0 within the file
+    """
+    file_idx, minhashfile, b, r, n_partitions, sig_path = params
+    with open(minhashfile, "rb") as fin:
+        minhash_list = pickle.load(fin)
+    keys = [key for key, _ in minhash_list]
+    if sig_path is not None:
+        np.save(sig_path, signature_matrix(minhash_list))
+    if not minhash_list:
+        return file_idx, keys, np.empty(0, dtype=RECORD), np.zeros(n_partitions + 1, dtype=np.int64)
+
+    hashes = band_hashes(np.stack([m.hashvalues for _, m in minhash_list]), b, r)
+    records = np.empty(hashes.size, dtype=RECORD)
+    records["hash"] = hashes.ravel()
+    records["doc"] = np.repeat(np.arange(len(keys), dtype=np.uint64), b)
+
+    part = records["hash"] % np.uint64(n_partitions)
+    order = np.argsort(part, kind="stable")
+    bounds = np.searchsorted(part[order], np.arange(n_partitions + 1))
+    return file_idx, keys, records[order], bounds
+
+
+def max_open_files(num_workers: int = 1) -> int:
+    """
+    Number of spill files that may be open at once, within the soft limit on open files of the process
+    """
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        soft = 1 << 16
+    return max(soft - _RESERVED_FILES - _RESERVED_FILES_PER_WORKER * num_workers, 16)
+
+
+class SpillFiles:
+    """
+    n spill files that records are appended to in chunks, with at most max_open of them open at a time
+
+    Up to max_open files are written directly. Beyond that, records go to one group file per max_open consecutive
+    spill files first, and on close every group file is read back in chunks and split into its spill files, a second
+    sequential pass over the records instead of more open files than the process may have.
+    """
+    def __init__(self, work_dir: str, prefix: str, n: int, dtype: np.dtype, which: Callable[[np.ndarray], np.ndarray],
+                 max_open: int, chunk_bytes: int = 64 << 20):
+        """
+        prefix: spill file i is work_dir/{prefix}-{i}.bin
+        which: spill file index of every record of an array, only used to split group files
+        chunk_bytes: size of the chunks group files are split in
+        """
+        self.work_dir = work_dir
+        self.prefix = prefix
+        self.n = n
+        self.dtype = dtype
+        self.which = which
+        self.chunk_records = max(chunk_bytes // dtype.itemsize, 1)
+        self.group_size = min(n, max_open)
+        n_groups = math.ceil(n / self.group_size)
+        assert n_groups <= max_open, f"{n:,} spill files need more than two passes with {max_open} open files, raise the limit on open files (ulimit -n)"
+        self.grouped = n_groups > 1
+        names = [f"group-{prefix}-{g}" for g in range(n_groups)] if self.grouped else [f"{prefix}-{i}" for i in range(n)]
+        self.files = [open(os.path.join(work_dir, f"{name}.bin"), "wb") for name in names]
+
+    def path(self, i: int) -> str:
+        return os.path.join(self.work_dir, f"{self.prefix}-{i}.bin")
+
+    def write(self, records: np.ndarray, bounds: np.ndarray):
+        """
+        Append records[bounds[i]:bounds[i + 1]] to spill file i, for every i
+        """
+        step = self.group_size if self.grouped else 1
+        for j, f in enumerate(self.files):
+            lo, hi = bounds[j * step], bounds[min((j + 1) * step, self.n)]
+            if hi > lo:
+                records[lo:hi].tofile(f)
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+    def finish(self):
+        """
+        Close the files once all records are written, splitting the group files if any
+        """
+        self.close()
+        if not self.grouped:
+            return
+        for g in range(len(self.files)):
+            group_path = os.path.join(self.work_dir, f"group-{self.prefix}-{g}.bin")
+            first, last = g * self.group_size, min((g + 1) * self.group_size, self.n)
+            outs = [open(self.path(i), "wb") for i in range(first, last)]
+            try:
+                with open(group_path, "rb") as fin:
+                    while True:
+                        chunk = np.fromfile(fin, dtype=self.dtype, count=self.chunk_records)
+                        if not len(chunk):
+                            break
+                        which = self.which(chunk)
+                        order = np.argsort(which, kind="stable")
+                        bounds = np.searchsorted(which[order], np.arange(first, last + 1))
+                        chunk = chunk[order]
+                        for i, f in enumerate(outs):
+                            if bounds[i + 1] > bounds[i]:
+                                chunk[bounds[i]:bounds[i + 1]].tofile(f)
+            finally:
+                for f in outs:
+                    f.close()
+            os.remove(group_path)
+
+
+def _collide(params: Tuple[str, bool]) -> np.ndarray:
+    """
+    Sort one partition by (band hash, doc id) and read the collisions off the sorted run: every document in a run
+    of equal band hashes except the first collides with the first one, or if reduce is not set (for verification)
+    with each of the up to VERIFY_DEPTH earliest documents before it in the run
+
+    params - tuple (partfile, reduce)
+
+    returns an array of PAIR records, if reduce is set at most one per document (the earliest document it collides with)
+    """
+    partfile, reduce = params
+    records = np.fromfile(partfile, dtype=RECORD)
+    os.remove(partfile)
+    if not len(records):
+        return np.empty(0, dtype=PAIR)
+    order = np.lexsort((records["doc"], records["hash"]))
+    hashes, docs = records["hash"][order], records["doc"][order]
+    del records, order
+
+    run_start = np.empty(len(hashes), dtype=bool)
+    run_start[0] = True
+    np.not_equal(hashes[1:], hashes[:-1], out=run_start[1:])
+    first = docs[run_start][np.cumsum(run_start) - 1]
+    dup = docs != first
+
+    if reduce:
+        return _earliest(docs[dup], first[dup])
+    # the earliest document of a run may not pass verification, pair each document with the j-th one of its run too
+    starts = np.flatnonzero(run_start)[np.cumsum(run_start) - 1]
+    position = np.arange(len(docs)) - starts
+    chunks = []
+    for j in range(VERIFY_DEPTH):
+        later = np.flatnonzero(position > j)
+        if not len(later):
+            break
+        earlier = docs[starts[later] + j]
+        # a document may repeat in a run if two of its bands hash alike
+        keep = docs[later] != earlier
+        pairs = np.empty(int(keep.sum()), dtype=PAIR)
+        pairs["doc"], pairs["first"] = docs[later][keep], earlier[keep]
+        chunks.append(pairs)
+    return np.concatenate(chunks) if chunks else np.empty(0, dtype=PAIR)
+
+
+def _earliest_index(docs: np.ndarray, first: np.ndarray) -> np.ndarray:
+    """
+    Indices of the (doc, first) pairs that hold the smallest first of each doc, in doc order
+    """
+    order = np.lexsort((first, docs))
+    keep = np.empty(len(docs), dtype=bool)
+    keep[:1] = True
+    np.not_equal(docs[order][1:], docs[order][:-1], out=keep[1:])
+    return order[keep]
+
+
+def _earliest(docs: np.ndarray, first: np.ndarray) -> np.ndarray:
+    """
+    Reduce (doc, first) pairs to a single pair per doc holding its smallest first, sorted by doc
+    """
+    index = _earliest_index(docs, first)
+    pairs = np.empty(len(index), dtype=PAIR)
+    pairs["doc"], pairs["first"] = docs[index], first[index]
+    return pairs
+
+
+class SortLSH:
+    """
+    Offline MinHash LSH deduplication of a fixed set of corpora by sorting band hashes rather than
+    querying an online index, so there is no Redis server or Bloom filter to maintain.
+
+    1. emit: every signature file is turned into (band hash, doc id) records in parallel, which are hash partitioned
+       and appended to spill files on local disk
+    2. collide: every partition is sorted in parallel and collisions are read off runs of equal band hashes
+    3. resolve: duplicate pairs are gathered by doc id range and written out in document order
+
+    Documents are numbered in the order the online indexes would see them (corpora in the order given, signature files
+    in sorted order, documents in file order). Keep-first rule: a document is a duplicate if it shares a band with any
+    earlier document, and it is reported against the earliest such document. Unlike the online indexes, a document
+    that shares a band only with earlier duplicates is also reported, so the result does not depend on the
+    order in which colliding pairs are discovered.
+
+    With verify set, the signatures are kept next to the spill files and each colliding pair is checked in bulk
+    by estimating the Jaccard similarity of the two signatures. A document is paired with every earlier document it
+    shares a band with, up to the VERIFY_DEPTH earliest documents of each band, and is reported against the earliest
+    of them it is at least threshold similar to, along with that similarity.
+
+    All I/O on the spill files is sequential. Partitions are sized so that sorting one of them on every worker stays
+    within memory_budget, if there are more of them than the process may keep open they are written in two passes
+    (see SpillFiles).
+
+    Example usage:
+    ```
+    lsh_params = {"threshold": 0.8, "num_perm": 128}
+    engine = SortLSH([minhash_dir_a, minhash_dir_b], lsh_params, spill_dir="/local/scratch", memory_budget=16 << 30, num_workers=32)
+    for corpus_idx, key, dup_key in engine.deduplicate():
+        ...
+    ```
+    """
+    def __init__(
+        self,
+        minhash_dirs: List[str],
+        lsh_params: Dict,
+        spill_dir: Optional[str] = None,
+        memory_budget: int = 4 << 30,
+        num_workers: int = 1,
+        minhash_files: Optional[List[List[str]]] = None,
+        verify: bool = False,
+    ):
+        """
+        minhash_dirs: paths to the directories of pickled minhash signatures, one per corpus
+        lsh_params: dict with the threshold and num_perm (and optionally weights or params) as for MinHashLSH
+        spill_dir: local directory for the intermediate files, defaults to the system temp dir
+        memory_budget: approximate upper bound in bytes on the memory used by all workers together
+        num_workers: number of worker processes
+        minhash_files: optional explicit list of signature files per corpus instead of every file in minhash_dirs
+        verify: verify colliding pairs against the threshold, see above
+        """
+        self.minhash_dirs = minhash_dirs
+        num_perm = lsh_params.get("num_perm", 128)
+        if lsh_params.get("params") is not None:
+            self.b, self.r = lsh_params["params"]
+        else:
+            self.b, self.r = _optimal_param(lsh_params.get("threshold", 0.9), num_perm, *lsh_params.get("weights", (0.5, 0.5)))
+        self.spill_dir = spill_dir
+        self.memory_budget = memory_budget
+        self.num_workers = max(num_workers, 1)
+        self.threshold = lsh_params.get("threshold", 0.9)
+        self.verify = verify
+
+        if minhash_files is None:
+            minhash_files = [
+                sorted(os.path.join(d, f) for f in os.listdir(d) if f.endswith(".pkl"))
+                for d in minhash_dirs
+            ]
+        self.files = [(corpus_idx, f) for corpus_idx, files in enumerate(minhash_files) for f in files]
+
+    def _n_partitions(self) -> int:
+        # pickled signatures hold at least num_perm 8 byte hashvalues per document, each document emits b 16 byte records
+        total_bytes = sum(os.path.getsize(f) for _, f in self.files)
+        est_bytes = total_bytes * RECORD.itemsize * self.b / (8 * self.b * self.r)
+        # sorting a partition takes about three times its size (records, permutation, sorted columns)
+        per_partition = max(self.memory_budget // (3 * self.num_workers), 1 << 20)
+        return max(self.num_workers, math.ceil(est_bytes / per_partition))
+
+    def deduplicate(self) -> Iterator[Tuple]:
+        """
+        Run all three stages, the spill files are removed afterwards
+
+        yields tuples (corpus_idx, key, dup_key) in document order, or (corpus_idx, key, dup_key, similarity) with verify
+        """
+        os.makedirs(self.spill_dir or tempfile.gettempdir(), exist_ok=True)
+        work_dir = tempfile.mkdtemp(prefix="sortlsh-", dir=self.spill_dir)
+        try:
+            with Pool(pool_size(self.num_workers)) as p:
+                file_starts = self._emit_all(p, work_dir)
+                n_ranges = self._collide_all(p, work_dir, file_starts[-1])
+            yield from self._resolve(work_dir, file_starts, n_ranges)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def _emit_all(self, p: Pool, work_dir: str) -> List[int]:
+        """
+        Stage 1, returns the first doc id of every signature file followed by the total number of documents
+        """
+        self.n_partitions = self._n_partitions()
+        n_partitions = np.uint64(self.n_partitions)
+        parts = SpillFiles(work_dir, "part", self.n_partitions, RECORD, lambda records: records["hash"] % n_partitions, max_open_files(self.num_workers))
+        file_starts = [0]
+        try:
+            # results are consumed in file order, doc ids are offset by the number of documents in earlier files
+            in_flight = deque()
+            pending = iter(enumerate(self.files))
+            with tqdm(total=len(self.files), desc="emit", disable=None) as pbar:
+                # keep at most 2 * num_workers files in flight so that results do not pile up in memory
+                while True:
+                    while len(in_flight) < 2 * self.num_workers:
+                        item = next(pending, None)
+                        if item is None:
+                            break
+                        file_idx, (_, minhashfile) = item
+                        sig_path = os.path.join(work_dir, f"sig-{file_idx}.npy") if self.verify else None
+                        in_flight.append(p.apply_async(_emit, ((file_idx, minhashfile, self.b, self.r, self.n_partitions, sig_path),)))
+                    if not in_flight:
+                        break
+                    file_idx, keys, records, bounds = in_flight.popleft().get()
+                    records["doc"] += np.uint64(file_starts[-1])
+                    parts.write(records, bounds)
+                    with open(os.path.join(work_dir, f"keys-{file_idx}.txt"), "w") as fout:
+                        fout.write("\n".join(keys))
+                    file_starts.append(file_starts[-1] + len(keys))
+                    pbar.update()
+            parts.finish()
+        finally:
+            parts.close()
+        return file_starts
+
+    def _collide_all(self, p: Pool, work_dir: str, n_docs: int) -> int:
+        """
+        Stage 2, pairs from each partition are appended to range files by doc id so that stage 3 can
+        resolve them in document order one range at a time
+
+        returns the number of range files
+        """
+        n_ranges = self.n_partitions
+
+        def range_of(pairs: np.ndarray) -> np.ndarray:
+            return (pairs["doc"] * np.uint64(n_ranges)) // np.uint64(max(n_docs, 1))
+
+        ranges = SpillFiles(work_dir, "pairs", n_ranges, PAIR, range_of, max_open_files(self.num_workers))
+        # with verify every colliding pair (up to VERIFY_DEPTH per band) is kept, the earliest one may not pass verification
+        partfiles = [(os.path.join(work_dir, f"part-{i}.bin"), not self.verify) for i in range(self.n_partitions)]
+        try:
+            for pairs in tqdm(p.imap_unordered(_collide, partfiles), total=len(partfiles), desc="collide", disable=None):
+                which = range_of(pairs)
+                order = np.argsort(which, kind="stable")
+                ranges.write(pairs[order], np.searchsorted(which[order], np.arange(n_ranges + 1)))
+            ranges.finish()
+        finally:
+            ranges.close()
+        return n_ranges
+
+    def _resolve(self, work_dir: str, file_starts: List[int], n_ranges: int) -> Iterator[Tuple]:
+        """
+        Stage 3, verify pairs if requested and map doc ids back to document keys
+        """
+        starts = np.asarray(file_starts[:-1], dtype=np.uint64)
+        cache = OrderedDict()
+        if self.verify:
+            sigs = [np.load(os.path.join(work_dir, f"sig-{i}.npy"), mmap_mode="r") for i in range(len(self.files))]
+
+        def locate(docs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+            files = np.searchsorted(starts, docs, side="right") - 1
+            return files, docs - starts[files]
+
+        def key_of(doc: int) -> Tuple[int, str]:
+            file_idx = int(np.searchsorted(starts, np.uint64(doc), side="right")) - 1
+            if file_idx not in cache:
+                with open(os.path.join(work_dir, f"keys-{file_idx}.txt")) as fin:
+                    cache[file_idx] = fin.read().split("\n")
+                if len(cache) > 64:
+                    cache.popitem(last=False)
+            cache.move_to_end(file_idx)
+            return file_idx, cache[file_idx][doc - file_starts[file_idx]]
+
+        for i in range(n_ranges):
+            rangefile = os.path.join(work_dir, f"pairs-{i}.bin")
+            pairs = np.fromfile(rangefile, dtype=PAIR)
+            os.remove(rangefile)
+            if self.verify:
+                # one vectorized similarity estimate for every colliding pair in the range
+                sims = estimate_jaccard(gather(sigs, *locate(pairs["doc"])), gather(sigs, *locate(pairs["first"])))
+                passed = sims >= self.threshold
+                pairs, sims = pairs[passed], sims[passed]
+                index = _earliest_index(pairs["doc"], pairs["first"])
+                pairs, sims = pairs[index], sims[index]
+                for doc, first, sim in zip(pairs["doc"].tolist(), pairs["first"].tolist(), sims.tolist()):
+                    file_idx, key = key_of(doc)
+                    _, dup_key = key_of(first)
+                    yield self.files[file_idx][0], key, dup_key, f"{sim:.4f}"
+                continue
+            # a document collides in several partitions if several of its bands match
+            pairs = _earliest(pairs["doc"], pairs["first"])
+            for doc, first in zip(pairs["doc"].tolist(), pairs["first"].tolist()):
+                file_idx, key = key_of(doc)
+                _, dup_key = key_of(first)
+                yield self.files[file_idx][0], key, dup_key
@@ -0,0 +1,48 @@
+from deduplication.dryrun import dry_run, time_index
+from datasketch import MinHash
+import numpy as np
+import pickle
+import json
+import os
+
+
+def write_random_signatures(minhash_dir: str, docs: int, num_perm: int = 128, seed: int = 0):
+    # unrelated documents, no pair is anywhere near the threshold
+    rng = np.random.default_rng(seed)
+    os.makedirs(minhash_dir)
+    minhash_list = []
+    for i in range(docs):
+        m = MinHash(num_perm=num_perm)
+        m.update_batch([str(token).encode("utf8") for token in rng.integers(0, 1 << 40, 50)])
+        minhash_list.append((f"part-00000.jsonl-{i + 1}", m))
+    with open(os.path.join(minhash_dir, "part-00000.pkl"), "wb") as fout:
+        pickle.dump(minhash_list, fout)
+
+
+def test_bloom_false_positives_are_not_counted_as_duplicates(tmp_path):
+    minhash_dir = str(tmp_path / "minhash")
+    write_random_signatures(minhash_dir, 10000)
+
+    # a large fp makes the filters flag plenty of documents with no earlier partner
+    index = time_index("bloom", minhash_dir, str(tmp_path / "index"), 0.8, 128, 10000, 0.01, None, 6379)
+
+    assert index["false_positives"] > 0
+    # so nothing is scaled up by dry_run, however small the sampled share
+    assert index["duplicates"] == 0
+
+
+def test_dry_run_without_duplicates(tmp_path):
+    rng = np.random.default_rng(1)
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for part in range(2):
+        with open(input_dir / f"part-{part:05d}.jsonl", "w") as fout:
+            for _ in range(2000):
+                fout.write(json.dumps({"text": " ".join(str(token) for token in rng.integers(0, 1 << 40, 50))}) + "\n")
+
+    estimate = dry_run(["c"], [str(input_dir)], "bloom", 0.8, fp=0.001, sample_size=400, spill_dir=str(tmp_path))
+
+    index = estimate["indexes"][0]
+    assert index["duplicates"] == 0
+    assert index["duplicate_fraction"] == index["false_positive_fraction"] < 0.01
+    assert abs(estimate["documents"] - 4000) < 400
@@ -0,0 +1,49 @@
+from deduplication.sortlsh import SortLSH
+from deduplication import sortlsh
+from datasketch import MinHash
+import numpy as np
+import pytest
+import pickle
+import os
+
+
+def write_signatures(minhash_dir: str, files: int = 4, docs: int = 200, seed: int = 0):
+    # every tenth document repeats an earlier one with a few of its tokens replaced
+    rng = np.random.default_rng(seed)
+    os.makedirs(minhash_dir)
+    token_sets = []
+    for f in range(files):
+        minhash_list = []
+        for i in range(docs):
+            if token_sets and i % 10 == 9:
+                tokens = token_sets[rng.integers(len(token_sets))].copy()
+                tokens[:3] = rng.integers(0, 1 << 40, 3)
+            else:
+                tokens = rng.integers(0, 1 << 40, 100)
+            token_sets.append(tokens)
+            m = MinHash(num_perm=128)
+            m.update_batch([str(token).encode("utf8") for token in tokens])
+            minhash_list.append((f"part-{f:05d}.jsonl-{i + 1}", m))
+        with open(os.path.join(minhash_dir, f"part-{f:05d}.pkl"), "wb") as fout:
+            pickle.dump(minhash_list, fout)
+
+
+def run(minhash_dir: str, spill_dir: str, verify: bool):
+    engine = SortLSH([minhash_dir], {"threshold": 0.8, "num_perm": 128}, spill_dir=spill_dir, verify=verify)
+    return list(engine.deduplicate())
+
+
+@pytest.mark.parametrize("verify", [False, True])
+def test_more_partitions_than_open_files(tmp_path, monkeypatch, verify):
+    minhash_dir = str(tmp_path / "minhash")
+    write_signatures(minhash_dir)
+    monkeypatch.setattr(SortLSH, "_n_partitions", lambda self: 50)
+    direct = run(minhash_dir, str(tmp_path), verify)
+    assert len(direct) >= 70
+
+    # the 50 partitions and 50 ranges go through 4 group files of up to 16 spill files each
+    groups = []
+    monkeypatch.setattr(sortlsh, "max_open_files", lambda num_workers=1: 16)
+    monkeypatch.setattr(sortlsh.SpillFiles, "finish", lambda self, finish=sortlsh.SpillFiles.finish: (groups.append(len(self.files)), finish(self)))
+    assert sorted(run(minhash_dir, str(tmp_path), verify)) == sorted(direct)
+    assert groups == [4, 4]
@@ -0,0 +1,27 @@
+from deduplication.bench.stages import HEAVY_MODULES
+import subprocess
+import pytest
+import json
+import sys
+
+# runs the command like python -m deduplication does and records the top-level packages loaded once it exits
+RUN_COMMAND = """
+import runpy, json, sys
+out, sys.argv = sys.argv[1], ["deduplication"] + sys.argv[2:]
+try:
+    runpy.run_module("deduplication", run_name="__main__", alter_sys=True)
+finally:
+    with open(out, "w") as fout:
+        json.dump(sorted({name.split(".")[0] for name in sys.modules}), fout)
+"""
+
+
+@pytest.mark.parametrize("command", [[], ["query"], ["minhash"], ["evaluate"], ["bench"]])
+def test_help_imports_no_index_backend(tmp_path, command):
+    modules_file = str(tmp_path / "modules.json")
+    proc = subprocess.run([sys.executable, "-c", RUN_COMMAND, modules_file] + command + ["--help"], capture_output=True, text=True)
+    assert proc.returncode == 0, proc.stderr
+    with open(modules_file) as fin:
+        modules = set(json.load(fin))
+    assert "deduplication" in modules
+    assert not modules & set(HEAVY_MODULES)
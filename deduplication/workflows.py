@@ -1,24 +1,113 @@
-from deduplication.minhash import MinHasher
-from deduplication.lsh import LSHIndex
-from deduplication.lshbloom import LSHBloom
-from deduplication.writers import write_duplicates_to_csv
-from typing import List
+from deduplication.planner import PLAN_NAME, apply_plan, load_plan, save_plan
+from deduplication.exact import ExactFilter, read_exact_duplicates, read_exact_file
+from deduplication.writers import DuplicateWriter, write_duplicates_to_csv, read_duplicate_rows, BINARY_SUFFIX
+from deduplication.checkpoint import ProgressJournal, JOURNAL_NAME
+from deduplication.leases import LeaseQueue
+from deduplication.memory import pool_size
+from deduplication.inputs import input_stem
+from multiprocessing import Pool
+from contextlib import nullcontext
+from typing import TYPE_CHECKING, List, Dict, Optional, Tuple, Union
+import shutil
+import logging
 import os
 
+# the index backends (and datasketch) are imported by the workflows that use them, so a run only loads its own
+if TYPE_CHECKING:
+    from deduplication.minhash import MinHasher
+    from deduplication.sortlsh import SortLSH
+    from deduplication.multithreshold import MultiThresholdIndex
+
+logger = logging.getLogger(__name__)
+
+# <<< Multiple thresholds >>>
+
+def dedup_thresholds(
+    index: "MultiThresholdIndex",
+    input_dir: str,
+    minhash_dir: str,
+    n_hash_funcs: int,
+    compute_minhashes: bool,
+    stream: bool,
+    save_minhashes: bool,
+    exact: Optional[ExactFilter] = None,
+    out: Optional[DuplicateWriter] = None,
+) -> Tuple[List[Tuple], List[Tuple[str, str]]]:
+    from deduplication.minhash import MinHasher
+    # every signature file is read once and deduplicated against the index of each threshold
+    m = None
+    if compute_minhashes and stream:
+        m = MinHasher(input_dir, minhash_dir, n_hash_funcs, exact=exact)
+        duplicates = index.deduplicate_stream(m.stream(save=save_minhashes), out)
+    else:
+        if compute_minhashes:
+            m = MinHasher(input_dir, minhash_dir, n_hash_funcs, exact=exact)
+            m.process()
+        duplicates = index.deduplicate_corpus(out)
+    return duplicates, exact_repeats(m, minhash_dir)
+
+
+def exact_repeats(m: Optional["MinHasher"], minhash_dir: str) -> List[Tuple[str, str]]:
+    # exact repeats get no signature, so the index never sees them and they are reported from the minhash stage,
+    # either as just found by m or as recorded next to the signatures when those were computed
+    return m.exact_duplicates if m is not None else read_exact_duplicates(minhash_dir)
+
+
+def threshold_save_dir(save_dir: str, threshold: float) -> str:
+    # each threshold has its own band layout and thus its own Bloom filters
+    return os.path.join(save_dir, f"threshold-{threshold}")
+
+
+def threshold_lsh_params(lsh_params: dict, threshold: float) -> dict:
+    # likewise its own Redis hash tables
+    storage_config = dict(lsh_params["storage_config"], basename=lsh_params["storage_config"]["basename"] + f"-{threshold}".encode())
+    return dict(lsh_params, threshold=threshold, storage_config=storage_config)
+
+
+def threshold_bloom_params(lsh_params: dict, threshold: float) -> dict:
+    save_dir = threshold_save_dir(lsh_params["save_dir"], threshold)
+    os.makedirs(save_dir, exist_ok=True)
+    return dict(lsh_params, threshold=threshold, save_dir=save_dir)
+
 # <<< MinHashLSH >>>
 
+def lsh_index_plan(plan_file: str, threshold: float, n_hash_funcs: int, plan: Optional[Dict] = None) -> Optional[Dict]:
+    # the Redis index has no directory of its own, the plan it was created with is kept in plan_file (by default next to
+    # the output file) and applies to every later run on the index, with --auto-tune or without
+    stored = load_plan(plan_file)
+    if stored is None:
+        if plan is not None:
+            save_plan(plan_file, plan)
+        return plan
+    assert stored["kind"] == "lsh" and stored["threshold"] == threshold and stored["num_perm"] == n_hash_funcs, \
+        f"{plan_file} plans a {stored['kind']} index for threshold {stored['threshold']} and {stored['num_perm']} permutations, " \
+        f"not an lsh index for threshold {threshold} and {n_hash_funcs}, delete it along with the Redis index to change the layout"
+    return stored
+
+
 # workflow for deduping single corpus against the LSH Index
 def dedup_single_lsh(
     input_dir: str,
     minhash_dir: str,
     csvfile: str,
     corpus_name: str,
-    sim_threshold: float = 0.8,
+    sim_threshold: Union[float, List[float]] = 0.8,
     n_hash_funcs: int = 128,
     redis_name: str = b"tpc",
     redis_port: int = 6379,
     compute_minhashes: bool = True,
+    stream: bool = False,
+    save_minhashes: bool = True,
+    local_dedup_workers: int = 0,
+    signature_dir: Optional[str] = None,
+    plan: Optional[Dict] = None,
+    exact: Optional[ExactFilter] = None,
+    plan_file: Optional[str] = None,
 ):
+    from deduplication.multithreshold import MultiThresholdIndex
+    from deduplication.signatures import SignatureStore
+    from deduplication.minhash import MinHasher
+    from deduplication.lsh import LSHIndex
     lsh_params = {
         "threshold": sim_threshold,
         "num_perm": n_hash_funcs,
@@ -28,14 +117,37 @@ def dedup_single_lsh(
             "redis": {"host": "localhost", "port": redis_port},
         },
     }
+    if not isinstance(sim_threshold, list):
+        plan = lsh_index_plan(plan_file or os.path.join(os.path.dirname(csvfile), PLAN_NAME), sim_threshold, n_hash_funcs, plan)
+    lsh_params = apply_plan(lsh_params, plan)
 
-    if compute_minhashes:
-        m = MinHasher(input_dir, minhash_dir, n_hash_funcs)
-        m.process()
+    if isinstance(sim_threshold, list):
+        assert not (local_dedup_workers or signature_dir or plan), "Multiple thresholds are not supported together with a local deduplication pass, verification or auto-tuning"
+        indexes = [(t, LSHIndex(minhash_dir, threshold_lsh_params(lsh_params, t))) for t in sim_threshold]
+        with DuplicateWriter(csvfile, corpus_name, header=["corpus", "threshold", "key", "dup_key"]) as writer:
+            _, repeats = dedup_thresholds(MultiThresholdIndex(minhash_dir, indexes), input_dir, minhash_dir, n_hash_funcs, compute_minhashes, stream, save_minhashes, exact, writer)
+            writer.extend((t,) + repeat for t in sim_threshold for repeat in repeats)
+        return
 
-    index = LSHIndex(minhash_dir, lsh_params)
-    duplicates = index.deduplicate_corpus()
-    write_duplicates_to_csv(duplicates, csvfile, corpus_name, header=["corpus", "key", "dup_key"])
+    # verify candidates against the signatures of every corpus indexed so far
+    store = SignatureStore(signature_dir) if signature_dir else None
+    index = LSHIndex(minhash_dir, lsh_params, store)
+    m = None
+    # duplicates go to the csv as they are found rather than once the corpus is done
+    with DuplicateWriter(csvfile, corpus_name, header=["corpus", "key", "dup_key"] + (["similarity"] if store else [])) as writer:
+        if compute_minhashes and stream:
+            # index consumes each file's signatures while the following files are still being hashed
+            m = MinHasher(input_dir, minhash_dir, n_hash_funcs, exact=exact)
+            if local_dedup_workers:
+                index.deduplicate_hierarchical(m.stream(save=save_minhashes), local_dedup_workers, writer)
+            else:
+                index.deduplicate_stream(m.stream(save=save_minhashes), writer)
+        else:
+            if compute_minhashes:
+                m = MinHasher(input_dir, minhash_dir, n_hash_funcs, exact=exact)
+                m.process()
+            index.deduplicate_corpus(local_workers=local_dedup_workers, out=writer)
+        writer.extend(repeat + (("1.0000",) if store else ()) for repeat in exact_repeats(m, minhash_dir))
 
 
 # workflow for deduping many corpora at once
@@ -44,27 +156,54 @@ def dedup_multi_lsh(
     minhash_dirs: List[str],
     csvfile: str,
     corpus_names: List[str],
-    sim_threshold: float = 0.8,
+    sim_threshold: Union[float, List[float]] = 0.8,
     n_hash_funcs: int = 128,
     redis_name: str = b"tpc",
     redis_port: int = 6379,
     compute_minhashes: bool = True,
+    stream: bool = False,
+    save_minhashes: bool = True,
+    prefetch: int = 0,
+    prefetch_bytes: Optional[int] = None,
+    local_dedup_workers: int = 0,
+    signature_dir: Optional[str] = None,
+    plan: Optional[Dict] = None,
+    exact: Optional[ExactFilter] = None,
+    plan_file: Optional[str] = None,
 ):
+    from deduplication.scheduler import MinhashPrefetcher
     assert len(input_dirs) == len(minhash_dirs) == len(corpus_names), \
         f"Expected len(input_dirs) == len(minhash_dirs) == len(corpus_names), got {len(input_dirs)}, {len(minhash_dirs)}, {len(corpus_names)}"
 
-    for i in range(len(input_dirs)):
-        dedup_single_lsh(
-            input_dirs[i],
-            minhash_dirs[i],
-            csvfile,
-            corpus_names[i],
-            sim_threshold,
-            n_hash_funcs,
-            redis_name,
-            redis_port,
-            compute_minhashes,
-        )
+    # hash upcoming corpora in the background while the current one is being indexed
+    prefetcher = None
+    if compute_minhashes and prefetch:
+        prefetcher = MinhashPrefetcher(input_dirs, minhash_dirs, n_hash_funcs, depth=prefetch, max_bytes=prefetch_bytes, delete_released=not save_minhashes, exact=exact)
+
+    with prefetcher or nullcontext():
+        for i in range(len(input_dirs)):
+            if prefetcher is not None:
+                prefetcher.wait(i)
+            dedup_single_lsh(
+                input_dirs[i],
+                minhash_dirs[i],
+                csvfile,
+                corpus_names[i],
+                sim_threshold,
+                n_hash_funcs,
+                redis_name,
+                redis_port,
+                compute_minhashes and prefetcher is None,
+                stream,
+                save_minhashes,
+                local_dedup_workers,
+                signature_dir,
+                plan,
+                exact,
+                plan_file,
+            )
+            if prefetcher is not None:
+                prefetcher.release(i)
 
 
 def dedup_single_file_lsh(
@@ -72,12 +211,20 @@ def dedup_single_file_lsh(
     minhash_dir: str,
     csvfile: str,
     corpus_name: str,
-    sim_threshold: float = 0.8,
+    sim_threshold: Union[float, List[float]] = 0.8,
     n_hash_funcs: int = 128,
     redis_name: str = b"tpc",
     redis_port: int = 6379,
     compute_minhashes: bool = True,
+    signature_dir: Optional[str] = None,
+    plan: Optional[Dict] = None,
+    exact: Optional[ExactFilter] = None,
+    plan_file: Optional[str] = None,
 ):
+    from deduplication.multithreshold import MultiThresholdIndex
+    from deduplication.signatures import SignatureStore
+    from deduplication.minhash import MinHasher
+    from deduplication.lsh import LSHIndex
     lsh_params = {
         "threshold": sim_threshold,
         "num_perm": n_hash_funcs,
@@ -87,25 +234,74 @@ def dedup_single_file_lsh(
             "redis": {"host": "localhost", "port": redis_port},
         },
     }
+    if not isinstance(sim_threshold, list):
+        plan = lsh_index_plan(plan_file or os.path.join(os.path.dirname(csvfile), PLAN_NAME), sim_threshold, n_hash_funcs, plan)
+    lsh_params = apply_plan(lsh_params, plan)
 
+    fname = input_file.split("/")[-1]
+    minhash_file = f"{minhash_dir}/{input_stem(fname)}.pkl"
     if compute_minhashes:
-        m = MinHasher(None, minhash_dir, n_hash_funcs)
+        m = MinHasher(None, minhash_dir, n_hash_funcs, exact=exact)
         m.compute_minhash_for_file(input_file)
+        repeats = m.exact_duplicates
+    else:
+        repeats = read_exact_file(minhash_file)
 
-    fname = input_file.split("/")[-1]
-    minhash_file = f"{minhash_dir}/{fname[:-6]}.pkl"
-    index = LSHIndex(minhash_dir, lsh_params)
-    duplicates = index.deduplicate_minhash_file(minhash_file)
-    write_duplicates_to_csv(duplicates, csvfile, corpus_name, header=["key", "dup_key"])
+    if isinstance(sim_threshold, list):
+        assert not (signature_dir or plan), "Multiple thresholds are not supported together with verification or auto-tuning"
+        indexes = [(t, LSHIndex(minhash_dir, threshold_lsh_params(lsh_params, t))) for t in sim_threshold]
+        with DuplicateWriter(csvfile, corpus_name, header=["threshold", "key", "dup_key"]) as writer:
+            MultiThresholdIndex(minhash_dir, indexes).deduplicate_minhash_file(minhash_file, writer)
+            writer.extend((t,) + repeat for t in sim_threshold for repeat in repeats)
+        return
+    store = SignatureStore(signature_dir) if signature_dir else None
+    index = LSHIndex(minhash_dir, lsh_params, store)
+    with DuplicateWriter(csvfile, corpus_name, header=["key", "dup_key"] + (["similarity"] if store else [])) as writer:
+        index.deduplicate_minhash_file(minhash_file, writer)
+        writer.extend(repeat + (("1.0000",) if store else ()) for repeat in repeats)
 
 
 # <<< LSHBloom >>>
 
 def clear_dir(save_dir):
+    from deduplication.forest import FOREST_META
     if os.path.exists(save_dir):
-        rm_files = [os.path.join(save_dir, f) for f in os.listdir(save_dir) if ".bf" in f or '.csv' in f]
+        rm_files = [os.path.join(save_dir, f) for f in os.listdir(save_dir) if ".bf" in f or '.csv' in f or f.endswith(BINARY_SUFFIX) or f in (JOURNAL_NAME, FOREST_META, PLAN_NAME)]
         for f in rm_files:
             os.remove(f)
+        # forest segments
+        for f in os.listdir(save_dir):
+            if f.startswith("segment-") and os.path.isdir(os.path.join(save_dir, f)):
+                shutil.rmtree(os.path.join(save_dir, f))
+            # per-threshold Bloom filters
+            elif f.startswith("threshold-") and os.path.isdir(os.path.join(save_dir, f)):
+                clear_dir(os.path.join(save_dir, f))
+
+
+def index_plan(save_dir: str, plan: Optional[Dict] = None) -> Optional[Dict]:
+    # the plan an index was created with is kept next to its filters, a new plan only applies to a new index
+    path = os.path.join(save_dir, PLAN_NAME)
+    stored = load_plan(path)
+    if stored is not None:
+        return stored
+    if plan is not None:
+        if os.path.isdir(save_dir) and any(f.endswith(".bf") for f in os.listdir(save_dir)):
+            logger.info(f"Ignoring the index plan, {save_dir} already holds Bloom filters built without one")
+            return None
+        save_plan(path, plan)
+    return plan
+
+
+def open_journal(save_dir, csvfile, corpus_name, checkpoint_every, resume):
+    # journal is only used if checkpointing was requested, resuming without an interval uses the default one
+    if not checkpoint_every and not resume:
+        return None
+    journal = ProgressJournal(save_dir, csvfile, corpus_name, header=["dup_key"], checkpoint_every=checkpoint_every or 100000)
+    if resume:
+        journal.load()
+    else:
+        journal.reset()
+    return journal
 
 
 # workflow for deduping single corpus against the Bloom Index
@@ -116,14 +312,31 @@ def dedup_single_bloom(
     false_positive_rate: float,
     csvfile: str,
     corpus_name: str,
-    sim_threshold: float = 0.8,
+    sim_threshold: Union[float, List[float]] = 0.8,
     n_hash_funcs: int = 128,
     save_dir: str = "./",
     compute_minhashes: bool = True,
     clear: bool = False,
+    checkpoint_every: int = 0,
+    resume: bool = False,
+    stream: bool = False,
+    save_minhashes: bool = True,
+    local_dedup_workers: int = 0,
+    plan: Optional[Dict] = None,
+    exact: Optional[ExactFilter] = None,
 ):
+    from deduplication.multithreshold import MultiThresholdIndex
+    from deduplication.minhash import MinHasher
+    from deduplication.lshbloom import LSHBloom
+    assert not (local_dedup_workers and (checkpoint_every or resume)), "Checkpointing is not supported together with a local deduplication pass"
+    assert not (exact and (checkpoint_every or resume)), "Checkpointing is not supported together with exact deduplication"
     if clear:
         clear_dir(save_dir)
+
+    journal = open_journal(save_dir, csvfile, corpus_name, checkpoint_every, resume)
+    if journal is not None and journal.corpus_done(minhash_dir):
+        logger.info(f"Skipping {corpus_name}, already deduplicated according to {journal.path}")
+        return
     
     lsh_params = {
         "threshold": sim_threshold,
@@ -133,13 +346,33 @@ def dedup_single_bloom(
         "save_dir": save_dir
     }
 
-    if compute_minhashes:
-        m = MinHasher(input_dir, minhash_dir, n_hash_funcs)
-        m.process()
+    if isinstance(sim_threshold, list):
+        assert not local_dedup_workers and journal is None and plan is None, "Multiple thresholds are not supported together with checkpointing, a local deduplication pass or auto-tuning"
+        indexes = [(t, LSHBloom(minhash_dir, threshold_bloom_params(lsh_params, t))) for t in sim_threshold]
+        with DuplicateWriter(csvfile, corpus_name, header=["corpus", "threshold", "dup_key"]) as writer:
+            _, repeats = dedup_thresholds(MultiThresholdIndex(minhash_dir, indexes), input_dir, minhash_dir, n_hash_funcs, compute_minhashes, stream, save_minhashes, exact, writer)
+            writer.extend((t, key) for t in sim_threshold for key, _ in repeats)
+        return
 
-    index = LSHBloom(minhash_dir, lsh_params)
-    duplicates = index.deduplicate_corpus()
-    write_duplicates_to_csv(duplicates, csvfile, corpus_name, header=["dup_key"])
+    index = LSHBloom(minhash_dir, apply_plan(lsh_params, index_plan(save_dir, plan)))
+    m = None
+    # with a journal, duplicates are appended to the csv as each window commits instead
+    writer = DuplicateWriter(csvfile, corpus_name, header=["dup_key"]) if journal is None else None
+    with writer if writer is not None else nullcontext():
+        if compute_minhashes and stream:
+            # index consumes each file's signatures while the following files are still being hashed
+            m = MinHasher(input_dir, minhash_dir, n_hash_funcs, exact=exact)
+            if local_dedup_workers:
+                index.deduplicate_hierarchical(m.stream(save=save_minhashes), local_dedup_workers, writer)
+            else:
+                index.deduplicate_stream(m.stream(save=save_minhashes), journal=journal, out=writer)
+        else:
+            if compute_minhashes:
+                m = MinHasher(input_dir, minhash_dir, n_hash_funcs, exact=exact)
+                m.process()
+            index.deduplicate_corpus(journal=journal, local_workers=local_dedup_workers, out=writer)
+        if writer is not None:
+            writer.extend((key,) for key, _ in exact_repeats(m, minhash_dir))
 
 
 # workflow for deduping many corpora against the Bloom Index at once
@@ -150,63 +383,511 @@ def dedup_multi_bloom(
     false_positive_rate: float,
     csvfile: str,
     corpus_names: List[str],
-    sim_threshold: float = 0.8,
+    sim_threshold: Union[float, List[float]] = 0.8,
     n_hash_funcs: int = 128,
     save_dir: str = "./",
     compute_minhashes: bool = True,
     clear: bool = False,
+    checkpoint_every: int = 0,
+    resume: bool = False,
+    stream: bool = False,
+    save_minhashes: bool = True,
+    prefetch: int = 0,
+    prefetch_bytes: Optional[int] = None,
+    local_dedup_workers: int = 0,
+    plan: Optional[Dict] = None,
+    exact: Optional[ExactFilter] = None,
 ):
+    from deduplication.scheduler import MinhashPrefetcher
     assert len(input_dirs) == len(minhash_dirs) == len(corpus_names), \
         f"Expected len(input_dirs) == len(minhash_dirs) == len(corpus_names), got {len(input_dirs)}, {len(minhash_dirs)}, {len(corpus_names)}"
 
     if clear:
         clear_dir(save_dir)
 
+    if checkpoint_every and not resume:
+        # start one fresh journal for the whole run, each corpus then continues it
+        open_journal(save_dir, csvfile, None, checkpoint_every, resume=False)
+        resume = True
+
+    # hash upcoming corpora in the background while the current one is being indexed
+    prefetcher = None
+    if compute_minhashes and prefetch:
+        # corpora already indexed by an interrupted run need not be hashed again
+        journal = open_journal(save_dir, csvfile, None, checkpoint_every, resume)
+        skip = [journal is not None and journal.corpus_done(d) for d in minhash_dirs]
+        prefetcher = MinhashPrefetcher(input_dirs, minhash_dirs, n_hash_funcs, depth=prefetch, max_bytes=prefetch_bytes, skip=skip, delete_released=not save_minhashes, exact=exact)
+
+    with prefetcher or nullcontext():
+        for i in range(len(input_dirs)):
+            if prefetcher is not None:
+                prefetcher.wait(i)
+            dedup_single_bloom(
+                input_dirs[i],
+                minhash_dirs[i],
+                corpus_size,
+                false_positive_rate,
+                csvfile,
+                corpus_names[i],
+                sim_threshold,
+                n_hash_funcs,
+                save_dir,
+                compute_minhashes and prefetcher is None,
+                clear=False,
+                checkpoint_every=checkpoint_every,
+                resume=resume,
+                stream=stream,
+                save_minhashes=save_minhashes,
+                local_dedup_workers=local_dedup_workers,
+                plan=plan,
+                exact=exact,
+            )
+            if prefetcher is not None:
+                prefetcher.release(i)
+
+def dedup_single_file_bloom(
+    input_file: str,
+    minhash_dir: str,
+    corpus_size: int,
+    false_positive_rate: float,
+    csvfile: str,
+    corpus_name: str,
+    sim_threshold: Union[float, List[float]] = 0.8,
+    n_hash_funcs: int = 128,
+    save_dir: str = "./",
+    compute_minhashes: bool = True,
+    clear: bool = False,
+    checkpoint_every: int = 0,
+    resume: bool = False,
+    plan: Optional[Dict] = None,
+    exact: Optional[ExactFilter] = None,
+):
+    from deduplication.multithreshold import MultiThresholdIndex
+    from deduplication.minhash import MinHasher
+    from deduplication.lshbloom import LSHBloom
+    assert not (exact and (checkpoint_every or resume)), "Checkpointing is not supported together with exact deduplication"
+    if clear:
+        clear_dir(save_dir)
+
+    journal = open_journal(save_dir, csvfile, corpus_name, checkpoint_every, resume)
+
+    lsh_params = {
+        "threshold": sim_threshold,
+        "num_perm": n_hash_funcs,
+        "n": corpus_size,
+        "fp": false_positive_rate,
+        "save_dir": save_dir
+    }
+
+    fname = input_file.split("/")[-1]
+    minhash_file = f"{minhash_dir}/{input_stem(fname)}.pkl"
+    if compute_minhashes:
+        m = MinHasher(None, minhash_dir, n_hash_funcs, exact=exact)
+        m.compute_minhash_for_file(input_file)
+        repeats = m.exact_duplicates
+    else:
+        repeats = read_exact_file(minhash_file)
+
+    if isinstance(sim_threshold, list):
+        assert journal is None and plan is None, "Multiple thresholds are not supported together with checkpointing or auto-tuning"
+        indexes = [(t, LSHBloom(minhash_dir, threshold_bloom_params(lsh_params, t))) for t in sim_threshold]
+        with DuplicateWriter(csvfile, corpus_name, header=["threshold", "dup_key"]) as writer:
+            MultiThresholdIndex(minhash_dir, indexes).deduplicate_minhash_file(minhash_file, writer)
+            writer.extend((t, key) for t in sim_threshold for key, _ in repeats)
+        return
+    index = LSHBloom(minhash_dir, apply_plan(lsh_params, index_plan(save_dir, plan)))
+    if journal is not None:
+        index.deduplicate_minhash_file_checkpointed(minhash_file, journal)
+    else:
+        with DuplicateWriter(csvfile, corpus_name, header=["dup_key"]) as writer:
+            index.deduplicate_minhash_file(minhash_file, writer)
+            writer.extend((key,) for key, _ in repeats)
+
+
+# workflow for checking a single corpus against an existing Bloom Index without modifying it
+def query_single_bloom(
+    input_dir: str,
+    minhash_dir: str,
+    csvfile: str,
+    corpus_name: str,
+    sim_threshold: float = 0.8,
+    n_hash_funcs: int = 128,
+    save_dir: str = "./",
+    compute_minhashes: bool = True,
+    num_workers: int = 1,
+):
+    from deduplication.minhash import MinHasher
+    from deduplication.lshbloom import LSHBloom
+    lsh_params = {
+        "threshold": sim_threshold,
+        "num_perm": n_hash_funcs,
+        "save_dir": save_dir
+    }
+    # the filters keep the band layout they were built with
+    lsh_params = apply_plan(lsh_params, index_plan(save_dir))
+
+    if compute_minhashes:
+        m = MinHasher(input_dir, minhash_dir, n_hash_funcs)
+        m.process()
+
+    index = LSHBloom(minhash_dir, lsh_params, read_only=True)
+    with DuplicateWriter(csvfile, corpus_name, header=["dup_key"]) as writer:
+        index.query_corpus(num_workers, writer)
+
+
+# workflow for checking many corpora against an existing Bloom Index without modifying it
+def query_multi_bloom(
+    input_dirs: List[str],
+    minhash_dirs: List[str],
+    csvfile: str,
+    corpus_names: List[str],
+    sim_threshold: float = 0.8,
+    n_hash_funcs: int = 128,
+    save_dir: str = "./",
+    compute_minhashes: bool = True,
+    num_workers: int = 1,
+):
+    assert len(input_dirs) == len(minhash_dirs) == len(corpus_names), \
+        f"Expected len(input_dirs) == len(minhash_dirs) == len(corpus_names), got {len(input_dirs)}, {len(minhash_dirs)}, {len(corpus_names)}"
+
     for i in range(len(input_dirs)):
-        dedup_single_bloom(
+        query_single_bloom(
             input_dirs[i],
             minhash_dirs[i],
-            corpus_size,
-            false_positive_rate,
             csvfile,
             corpus_names[i],
             sim_threshold,
             n_hash_funcs,
             save_dir,
             compute_minhashes,
-            clear=False
+            num_workers,
         )
 
-def dedup_single_file_bloom(
+
+def query_single_file_bloom(
     input_file: str,
     minhash_dir: str,
-    corpus_size: int,
-    false_positive_rate: float,
     csvfile: str,
     corpus_name: str,
     sim_threshold: float = 0.8,
     n_hash_funcs: int = 128,
     save_dir: str = "./",
     compute_minhashes: bool = True,
-    clear: bool = False,
 ):
-    if clear:
-        clear_dir(save_dir)
-
+    from deduplication.minhash import MinHasher
+    from deduplication.lshbloom import LSHBloom
     lsh_params = {
         "threshold": sim_threshold,
         "num_perm": n_hash_funcs,
-        "n": corpus_size,
-        "fp": false_positive_rate,
         "save_dir": save_dir
     }
+    # the filters keep the band layout they were built with
+    lsh_params = apply_plan(lsh_params, index_plan(save_dir))
 
     if compute_minhashes:
         m = MinHasher(None, minhash_dir, n_hash_funcs)
         m.compute_minhash_for_file(input_file)
 
     fname = input_file.split("/")[-1]
-    minhash_file = f"{minhash_dir}/{fname[:-6]}.pkl"
-    index = LSHBloom(minhash_dir, lsh_params)
-    duplicates = index.deduplicate_minhash_file(minhash_file)
+    minhash_file = f"{minhash_dir}/{input_stem(fname)}.pkl"
+    index = LSHBloom(minhash_dir, lsh_params, read_only=True)
+    duplicates = index.query_minhash_file(minhash_file)
     write_duplicates_to_csv(duplicates, csvfile, corpus_name, header=["dup_key"])
+
+
+# <<< Sort >>>
+
+def write_sorted_duplicates(engine: "SortLSH", csvfile: str, corpus_names: List[str], batch_size: int = 100000):
+    header = ["corpus", "key", "dup_key"] + (["similarity"] if engine.verify else [])
+    # rows arrive in document order, so each corpus' duplicates are contiguous
+    writer, writer_corpus = None, None
+    try:
+        for corpus_idx, *row in engine.deduplicate():
+            if writer is None or corpus_idx != writer_corpus:
+                if writer is not None:
+                    writer.close()
+                writer, writer_corpus = DuplicateWriter(csvfile, corpus_names[corpus_idx], header=header, buffer_rows=batch_size), corpus_idx
+            writer.append(tuple(row))
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+# workflow for deduping one or many corpora at once with the offline sort engine, without an online index
+def dedup_sort(
+    input_dirs: List[str],
+    minhash_dirs: List[str],
+    csvfile: str,
+    corpus_names: List[str],
+    sim_threshold: float = 0.8,
+    n_hash_funcs: int = 128,
+    spill_dir: Optional[str] = None,
+    memory_budget: int = 4 << 30,
+    num_workers: int = 1,
+    compute_minhashes: bool = True,
+    verify: bool = False,
+):
+    from deduplication.minhash import MinHasher
+    from deduplication.sortlsh import SortLSH
+    assert len(input_dirs) == len(minhash_dirs) == len(corpus_names), \
+        f"Expected len(input_dirs) == len(minhash_dirs) == len(corpus_names), got {len(input_dirs)}, {len(minhash_dirs)}, {len(corpus_names)}"
+
+    lsh_params = {
+        "threshold": sim_threshold,
+        "num_perm": n_hash_funcs,
+    }
+
+    if compute_minhashes:
+        for input_dir, minhash_dir in zip(input_dirs, minhash_dirs):
+            m = MinHasher(input_dir, minhash_dir, n_hash_funcs)
+            m.process()
+
+    engine = SortLSH(minhash_dirs, lsh_params, spill_dir, memory_budget, num_workers, verify=verify)
+    write_sorted_duplicates(engine, csvfile, corpus_names)
+
+
+def dedup_single_file_sort(
+    input_file: str,
+    minhash_dir: str,
+    csvfile: str,
+    corpus_name: str,
+    sim_threshold: float = 0.8,
+    n_hash_funcs: int = 128,
+    spill_dir: Optional[str] = None,
+    memory_budget: int = 4 << 30,
+    num_workers: int = 1,
+    compute_minhashes: bool = True,
+    verify: bool = False,
+):
+    from deduplication.minhash import MinHasher
+    from deduplication.sortlsh import SortLSH
+    lsh_params = {
+        "threshold": sim_threshold,
+        "num_perm": n_hash_funcs,
+    }
+
+    if compute_minhashes:
+        m = MinHasher(None, minhash_dir, n_hash_funcs)
+        m.compute_minhash_for_file(input_file)
+
+    fname = input_file.split("/")[-1]
+    minhash_file = f"{minhash_dir}/{input_stem(fname)}.pkl"
+    engine = SortLSH([minhash_dir], lsh_params, spill_dir, memory_budget, num_workers, minhash_files=[[minhash_file]], verify=verify)
+    write_sorted_duplicates(engine, csvfile, [corpus_name])
+
+
+# <<< LSH Forest >>>
+
+# workflow for deduping a single corpus against a persistent LSH Forest with top-k queries
+def dedup_single_forest(
+    input_dir: str,
+    minhash_dir: str,
+    csvfile: str,
+    corpus_name: str,
+    sim_threshold: float = 0.8,
+    n_hash_funcs: int = 128,
+    save_dir: str = "./",
+    compute_minhashes: bool = True,
+    clear: bool = False,
+    num_workers: int = 1,
+    top_k: int = 5,
+    num_trees: int = 8,
+    query_only: bool = False,
+    minhash_files: Optional[List[str]] = None,
+):
+    from deduplication.forest import ForestIndex, query_forest
+    from deduplication.minhash import MinHasher
+    if clear:
+        clear_dir(save_dir)
+
+    if compute_minhashes:
+        m = MinHasher(input_dir, minhash_dir, n_hash_funcs)
+        m.process()
+
+    if minhash_files is None:
+        minhash_files = sorted(os.path.join(minhash_dir, f) for f in os.listdir(minhash_dir) if f.endswith(".pkl"))
+    # the corpus is added first so documents are also matched against earlier documents of the same corpus
+    if not query_only:
+        os.makedirs(save_dir, exist_ok=True)
+        ForestIndex(save_dir, n_hash_funcs, num_trees).add(minhash_files)
+    with DuplicateWriter(csvfile, corpus_name, header=["corpus", "key", "dup_key", "similarity"]) as writer:
+        query_forest(save_dir, minhash_files, top_k, sim_threshold, num_workers, keep_first=not query_only, out=writer)
+
+
+# workflow for deduping many corpora against a persistent LSH Forest
+def dedup_multi_forest(
+    input_dirs: List[str],
+    minhash_dirs: List[str],
+    csvfile: str,
+    corpus_names: List[str],
+    sim_threshold: float = 0.8,
+    n_hash_funcs: int = 128,
+    save_dir: str = "./",
+    compute_minhashes: bool = True,
+    clear: bool = False,
+    num_workers: int = 1,
+    top_k: int = 5,
+    num_trees: int = 8,
+    query_only: bool = False,
+):
+    assert len(input_dirs) == len(minhash_dirs) == len(corpus_names), \
+        f"Expected len(input_dirs) == len(minhash_dirs) == len(corpus_names), got {len(input_dirs)}, {len(minhash_dirs)}, {len(corpus_names)}"
+
+    if clear:
+        clear_dir(save_dir)
+
+    for i in range(len(input_dirs)):
+        dedup_single_forest(
+            input_dirs[i],
+            minhash_dirs[i],
+            csvfile,
+            corpus_names[i],
+            sim_threshold,
+            n_hash_funcs,
+            save_dir,
+            compute_minhashes,
+            clear=False,
+            num_workers=num_workers,
+            top_k=top_k,
+            num_trees=num_trees,
+            query_only=query_only,
+        )
+
+
+def dedup_single_file_forest(
+    input_file: str,
+    minhash_dir: str,
+    csvfile: str,
+    corpus_name: str,
+    sim_threshold: float = 0.8,
+    n_hash_funcs: int = 128,
+    save_dir: str = "./",
+    compute_minhashes: bool = True,
+    clear: bool = False,
+    top_k: int = 5,
+    num_trees: int = 8,
+    query_only: bool = False,
+):
+    from deduplication.minhash import MinHasher
+    if compute_minhashes:
+        m = MinHasher(None, minhash_dir, n_hash_funcs)
+        m.compute_minhash_for_file(input_file)
+
+    fname = input_file.split("/")[-1]
+    minhash_file = f"{minhash_dir}/{input_stem(fname)}.pkl"
+    dedup_single_forest(input_file, minhash_dir, csvfile, corpus_name, sim_threshold, n_hash_funcs, save_dir, False,
+                        clear=clear, top_k=top_k, num_trees=num_trees, query_only=query_only, minhash_files=[minhash_file])
+
+
+# <<< Distributed >>>
+
+# workflow for minhashing many corpora with any number of workers sharing work_dir,
+# returns once every input file has been hashed by some worker
+def distributed_minhash(
+    input_dirs: List[str],
+    minhash_dirs: List[str],
+    work_dir: str,
+    n_hash_funcs: int = 128,
+    worker_id: Optional[str] = None,
+    lease_ttl: float = 600,
+):
+    from deduplication.minhash import MinHasher, compute_minhash_for_file
+    assert len(input_dirs) == len(minhash_dirs), \
+        f"Expected len(input_dirs) == len(minhash_dirs), got {len(input_dirs)}, {len(minhash_dirs)}"
+
+    queue = LeaseQueue(os.path.join(work_dir, "minhash"), worker_id, lease_ttl)
+    queue.plan([
+        {"path": infile, "minhash_dir": minhash_dir, "size": os.path.getsize(infile)}
+        for input_dir, minhash_dir in zip(input_dirs, minhash_dirs)
+        for infile in MinHasher(input_dir, minhash_dir, n_hash_funcs).input_files()
+    ])
+
+    with Pool(pool_size(32)) as p, queue:
+        for item in queue:
+            compute_minhash_for_file(item["path"], item["minhash_dir"], n_hash_funcs, p)
+            queue.complete(item)
+
+
+# runs fn on exactly one of the workers sharing work_dir, the others wait until it is done
+# and take over (calling fn(takeover=True)) if the worker running it dies
+def run_exclusive(work_dir: str, stage: str, fn, worker_id: Optional[str] = None, lease_ttl: float = 600):
+    queue = LeaseQueue(os.path.join(work_dir, stage), worker_id, lease_ttl)
+    queue.plan([{"stage": stage, "size": 0}])
+    with queue:
+        for item in queue:
+            fn(takeover=item["reclaimed"])
+            queue.complete(item)
+
+
+# workflow for checking many corpora against an existing Bloom Index with any number of workers sharing work_dir,
+# every worker queries whole signature files and the worker that finishes last merges the results in input order
+def distributed_query_bloom(
+    minhash_dirs: List[str],
+    csvfile: str,
+    corpus_names: List[str],
+    work_dir: str,
+    sim_threshold: float = 0.8,
+    n_hash_funcs: int = 128,
+    save_dir: str = "./",
+    worker_id: Optional[str] = None,
+    lease_ttl: float = 600,
+):
+    from deduplication.lshbloom import LSHBloom
+    assert len(minhash_dirs) == len(corpus_names), \
+        f"Expected len(minhash_dirs) == len(corpus_names), got {len(minhash_dirs)}, {len(corpus_names)}"
+
+    lsh_params = {
+        "threshold": sim_threshold,
+        "num_perm": n_hash_funcs,
+        "save_dir": save_dir
+    }
+    # the filters keep the band layout they were built with
+    lsh_params = apply_plan(lsh_params, index_plan(save_dir))
+    results_dir = os.path.join(work_dir, "query", "results")
+    os.makedirs(results_dir, exist_ok=True)
+
+    queue = LeaseQueue(os.path.join(work_dir, "query"), worker_id, lease_ttl)
+    items = [
+        {"path": os.path.join(minhash_dir, f), "minhash_dir": minhash_dir, "corpus": corpus_name, "size": os.path.getsize(os.path.join(minhash_dir, f))}
+        for minhash_dir, corpus_name in zip(minhash_dirs, corpus_names)
+        for f in sorted(os.listdir(minhash_dir)) if f.endswith(".pkl")
+    ]
+    # remember the input order, the plan itself is ordered by size
+    for i, item in enumerate(items):
+        item["order"] = i
+    items = queue.plan(items)
+
+    index = None
+    with queue:
+        for item in queue:
+            if index is None:
+                index = LSHBloom(item["minhash_dir"], lsh_params, read_only=True)
+            duplicates = index.query_minhash_file(item["path"])
+            write_duplicates_to_csv(duplicates, os.path.join(results_dir, f"{item['order']:08d}.csv"), item["corpus"], sync=True)
+            queue.complete(item, {"duplicates": len(duplicates)})
+
+    # the output may already hold rows of earlier runs, the size it had before the merge is kept so that a merge
+    # that died half way can be cut back to it
+    size_file = os.path.join(work_dir, "query", "merge.size")
+
+    def merge(takeover):
+        if os.path.exists(size_file):
+            with open(size_file) as fin:
+                start = int(fin.read())
+        else:
+            start = os.path.getsize(csvfile) if os.path.exists(csvfile) else 0
+            with open(size_file + ".tmp", "w") as fout:
+                fout.write(str(start))
+                fout.flush()
+                os.fsync(fout.fileno())
+            os.replace(size_file + ".tmp", size_file)
+        if os.path.exists(csvfile) and os.path.getsize(csvfile) > start:
+            with open(csvfile, "r+") as fout:
+                fout.truncate(start)
+        for item in sorted(items, key=lambda item: item["order"]):
+            part = os.path.join(results_dir, f"{item['order']:08d}.csv")
+            with DuplicateWriter(csvfile, item["corpus"], header=["dup_key"]) as writer:
+                if os.path.exists(part):
+                    writer.extend(tuple(row[1:]) for row in read_duplicate_rows(part))
+
+    run_exclusive(work_dir, "merge", merge, worker_id, lease_ttl)
@@ -1,20 +1,223 @@
+from deduplication.metrics import get_metrics
+from typing import List, Dict, Iterator, Optional, Tuple
+import numpy as np
+import fcntl
+import json
 import csv
+import logging
+import io
 import os
 
+logger = logging.getLogger(__name__)
 
-def write_duplicates_to_csv(duplicates, csvpath, corpus_name, header=None):
+# output files with this suffix are written in the binary columnar format, anything else as csv
+BINARY_SUFFIX = ".dups"
+
+# every block of a binary duplicate file starts with this, followed by the length of its json metadata
+BLOCK_MAGIC = b"DDUP"
+
+# rows held in memory before they are appended to the file
+BUFFER_ROWS = 65536
+
+
+def key_id(key: str, file_ids: Dict[str, int], fnames: List[str]) -> int:
+    """
+    Integer id of a document key "<file name>-<line number>", (file index << 32) | line number,
+    file names are numbered in order of appearance in fnames
+    """
+    fname, lineNo = key.rsplit("-", 1)
+    if fname not in file_ids:
+        file_ids[fname] = len(fnames)
+        fnames.append(fname)
+    return (file_ids[fname] << 32) | int(lineNo)
+
+
+def _is_number(value) -> bool:
+    # an empty value is a similarity that could not be estimated
+    if not isinstance(value, str) or value == "":
+        return True
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+
+def encode_block(rows: List[Tuple], corpus_name: str, header: Optional[List[str]] = None) -> bytes:
+    """
+    Binary columnar encoding of duplicate rows: a json header naming the corpus, the column types and the file names
+    the document keys refer to, followed by one array per column. Document keys are stored as int64 ids (see key_id)
+    and all other columns (thresholds, similarities) as float64, with NaN for an empty value.
+    Every block is self-contained, so blocks of any number of writers can be appended to the same file.
     """
-    Append a list of duplicates to a csv file
+    # a column holds document keys unless its first value is a number
+    types = ["float" if _is_number(value) else "key" for value in rows[0]]
+    file_ids, fnames = {}, []
+    columns = []
+    for i, kind in enumerate(types):
+        if kind == "key":
+            columns.append(np.array([key_id(row[i], file_ids, fnames) for row in rows], dtype=np.int64))
+        else:
+            columns.append(np.array([float(row[i]) if row[i] != "" else np.nan for row in rows], dtype=np.float64))
+    meta = json.dumps({"corpus": corpus_name, "rows": len(rows), "types": types, "files": fnames, "header": header}).encode("utf8")
+    return b"".join([BLOCK_MAGIC, len(meta).to_bytes(4, "little"), meta] + [column.tobytes() for column in columns])
+
+
+def read_duplicate_blocks(path: str) -> Iterator[Tuple[Dict, List[np.ndarray]]]:
+    """
+    Blocks of a binary duplicate file
+
+    yields tuples (meta, columns), meta holds the corpus name, column types and file names of the block,
+    columns one array per column (int64 key ids or float64 values)
+    """
+    with open(path, "rb") as fin:
+        while True:
+            magic = fin.read(len(BLOCK_MAGIC))
+            if not magic:
+                return
+            if magic != BLOCK_MAGIC:
+                raise ValueError(f"Corrupt duplicate file {path} at byte {fin.tell() - len(magic)}")
+            meta = json.loads(fin.read(int.from_bytes(fin.read(4), "little")))
+            columns = [
+                np.frombuffer(fin.read(8 * meta["rows"]), dtype=np.int64 if kind == "key" else np.float64)
+                for kind in meta["types"]
+            ]
+            yield meta, columns
+
+
+def is_binary(path: str) -> bool:
+    """
+    Whether a duplicate file is in the binary columnar format, judged by its content rather than its name
+    """
+    with open(path, "rb") as fin:
+        return fin.read(len(BLOCK_MAGIC)) == BLOCK_MAGIC
+
+
+def read_duplicate_rows(path: str) -> Iterator[List[str]]:
     """
-    # just in case, make output dir
-    dirname = os.path.dirname(csvpath)
-    os.makedirs(dirname, exist_ok=True)
-    # prepend corpus name to each csv row for organization
-    dups = [(corpus_name,) + d for d in duplicates]
-    with open(csvpath, "a+") as fout:
-        writer = csv.writer(fout)
+    Rows of a duplicate file in either format, as csv.reader would return them (binary files have no header row),
+    key ids are turned back into document keys
+    """
+    if not is_binary(path):
+        with open(path, newline="") as fin:
+            yield from csv.reader(fin)
+        return
+    for meta, columns in read_duplicate_blocks(path):
+        fnames = meta["files"]
+        values = [
+            [f"{fnames[i >> 32]}-{i & 0xFFFFFFFF}" for i in column.tolist()] if kind == "key"
+            else ["" if v != v else str(v) for v in column.tolist()]
+            for kind, column in zip(meta["types"], columns)
+        ]
+        for row in zip(*values):
+            yield [meta["corpus"]] + list(row)
+
+
+class DuplicateWriter:
+    """
+    Appends duplicates to a csv or binary file as they are found, holding at most buffer_rows rows in memory.
+    Behaves like a list that can only be appended to, so the index classes can stream their results into it
+    in place of the list they would otherwise return.
+
+    Each flush appends whole rows (or a whole binary block) under an exclusive lock on the file, so any number of
+    writers, in this process or others, can share one output file. The header row of a csv file is written by
+    whichever writer finds the file empty.
+
+    Example usage:
+    ```
+    with DuplicateWriter(csvfile, corpus_name, header=["dup_key"]) as writer:
+        index.deduplicate_corpus(out=writer)
+    ```
+    """
+    def __init__(self, path: str, corpus_name: str, header: Optional[List[str]] = None, binary: Optional[bool] = None,
+                 buffer_rows: int = BUFFER_ROWS, sync: bool = False):
+        """
+        path: file to append to
+        corpus_name: prepended to each row (or recorded once per block in the binary format)
+        header: optional header row, written if the file is empty (binary blocks keep it in their metadata)
+        binary: whether to write the binary columnar format, by default files ending in .dups are binary
+        buffer_rows: number of rows buffered before they are appended to the file
+        sync: if set, every flush is fsync'd to disk
+        """
+        self.path = path
+        self.corpus_name = corpus_name
+        self.header = header
+        self.binary = path.endswith(BINARY_SUFFIX) if binary is None else binary
+        self.buffer_rows = buffer_rows
+        self.sync = sync
+        self.buffer = []
+        self.count = 0
+        self.flushed = False
+        self.metrics = get_metrics()
+        # just in case, make output dir
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def append(self, duplicate: Tuple):
+        self.buffer.append(duplicate)
+        self.count += 1
+        if len(self.buffer) >= self.buffer_rows:
+            self.flush()
+
+    def extend(self, duplicates):
+        for duplicate in duplicates:
+            self.append(duplicate)
+
+    def __iadd__(self, duplicates):
+        self.extend(duplicates)
+        return self
+
+    def _encode(self, empty: bool) -> bytes:
+        if self.binary:
+            return encode_block(self.buffer, self.corpus_name, self.header) if self.buffer else b""
+        out = io.StringIO()
+        writer = csv.writer(out)
         # if file is empty write header row
-        if header is not None and os.stat(csvpath).st_size == 0:
-            writer.writerow(header)
-        writer.writerows(dups)
-    print(f"Wrote {len(dups)} duplicates to {csvpath}")
+        if self.header is not None and empty:
+            writer.writerow(self.header)
+        # prepend corpus name to each csv row for organization
+        writer.writerows((self.corpus_name,) + d for d in self.buffer)
+        return out.getvalue().encode("utf8")
+
+    def flush(self):
+        """
+        Append the buffered rows to the file
+        """
+        with self.metrics.timer("write_seconds"), open(self.path, "ab") as fout:
+            fcntl.flock(fout, fcntl.LOCK_EX)
+            try:
+                data = self._encode(empty=os.fstat(fout.fileno()).st_size == 0)
+                fout.write(data)
+                fout.flush()
+                if self.sync:
+                    os.fsync(fout.fileno())
+            finally:
+                fcntl.flock(fout, fcntl.LOCK_UN)
+        self.metrics.inc("written_rows", len(self.buffer))
+        self.metrics.inc("written_bytes", len(data))
+        self.buffer = []
+        self.flushed = True
+
+    def close(self):
+        # the file (and its header) is created even if there are no duplicates
+        if self.buffer or not self.flushed:
+            self.flush()
+        logger.info(f"Wrote {self.count} duplicates to {self.path}")
+
+
+def write_duplicates_to_csv(duplicates, csvpath, corpus_name, header=None, sync=False):
+    """
+    Append a list of duplicates to a csv file (or a binary file if csvpath ends in .dups)
+
+    if sync is set the rows are fsync'd to disk before returning
+    """
+    with DuplicateWriter(csvpath, corpus_name, header=header, sync=sync) as writer:
+        writer.extend(duplicates)